@@ -0,0 +1,185 @@
+"""
+Anytime approximate MAP by simulated annealing over the map variables.
+
+The search starts from the greedy assignment of a mini-bucket pass and then repeatedly picks a map variable and
+scores all of its states at once, by summing out the non-map variables with the other map variables fixed. The
+best assignment seen so far can be returned at any moment; when the wall-clock budget runs out it is returned
+together with its probability and, using the mini-bucket upper bound, how far from optimal it can at most be.
+
+"""
+import math
+import random
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from branch_and_bound import BranchAndBoundMAP
+from numpy_factor import NumpyFactor
+
+# Result of an anytime run. gap is the relative distance (upper_bound - probability) / upper_bound, 0 means the
+# assignment is provably optimal. probability and gap are None if the budget ran out before the initial assignment
+# could be scored.
+AnytimeResult = namedtuple("AnytimeResult", ["assignment", "probability", "upper_bound", "gap", "steps"])
+
+# Relative gap below which an assignment counts as optimal, to absorb rounding differences with the bound
+OPTIMALITY_TOLERANCE = 1e-9
+
+# Default number of neighbourhood scores that are remembered during a run
+SCORE_CACHE_SIZE = 4096
+
+
+class AnytimeMAP:
+    """
+    Simulated annealing MAP solver with a time budget.
+    """
+
+    def __init__(self, network, i_bound=10, elim_heuristic="min_fill", initial_temperature=1.0, seed=None,
+                 score_cache_size=SCORE_CACHE_SIZE):
+        """
+        Args:
+            network:             the network to run queries on
+            i_bound:             i-bound of the mini-bucket pass that gives the initial assignment and upper bound
+            elim_heuristic:      greedy heuristic for the elimination orders, see GREEDY_HEURISTICS
+            initial_temperature: temperature at the start of the run, it decreases linearly to zero over the budget.
+                                 Moves are accepted based on the ratio of the probabilities, so it is scale free.
+            seed:                seed for the random number generator
+            score_cache_size:    number of neighbourhood scores to remember, the least recently used are dropped
+        """
+        self.network = network
+        self.initial_temperature = initial_temperature
+        self.score_cache_size = score_cache_size
+        self.bounds = BranchAndBoundMAP(network, i_bound=i_bound, elim_heuristic=elim_heuristic)
+        self.random = random.Random(seed)
+
+    def run(self, map_vars: list, observed: dict, time_budget=1.0):
+        """
+        Searches for the most probable assignment to the map variables until the time budget is used up. The
+        budget includes the preparation, if it runs out before the search starts the greedy assignment of the
+        mini-bucket pass is returned without its probability.
+
+        Input:
+            map_vars:    The map variables to be queried
+            observed:    A dictionary of the observed variables {variable: value}
+            time_budget: Wall-clock time in seconds the search may take
+
+        Output: An AnytimeResult with the best assignment found {variable: value}, its probability
+                P(assignment, evidence), the upper bound on the probability of the MAP assignment, the gap and the
+                number of search steps
+
+        """
+        deadline = time.perf_counter() + time_budget
+
+        self.bounds.prepare(map_vars, observed)
+        upper_bound = self.bounds.upper_bound()
+        codes = self.bounds.greedy_codes()
+        if not self.prepare_scoring(map_vars, deadline) or time.perf_counter() >= deadline:
+            assignment = {var: self.network.values[var][codes[var]] for var in map_vars}
+            return AnytimeResult(assignment, None, upper_bound, None, 0)
+
+        current = self.score(codes)
+        best_codes, best = dict(codes), current
+
+        steps = 0
+        start = time.perf_counter()
+        while map_vars and best < upper_bound * (1 - OPTIMALITY_TOLERANCE) and time.perf_counter() < deadline:
+            steps += 1
+            var = self.random.choice(map_vars)
+
+            # Scoring all states of the variable costs one elimination, the same as scoring a single neighbour
+            scores = self.neighbourhood(var, codes)
+            if scores.max() > best:
+                best = float(scores.max())
+                best_codes = {**codes, var: int(np.argmax(scores))}
+
+            cardinality = len(scores)
+            if cardinality < 2:
+                continue
+            proposal = self.random.choice([code for code in range(cardinality) if code != codes[var]])
+
+            # Metropolis acceptance on the probability ratio, with a temperature that decreases over the budget
+            temperature = self.initial_temperature * max(deadline - time.perf_counter(), 0) / (deadline - start)
+            if scores[proposal] >= current or current == 0:
+                accept = True
+            elif scores[proposal] == 0 or temperature == 0:
+                accept = False
+            else:
+                accept = self.random.random() < math.exp(math.log(scores[proposal] / current) / temperature)
+
+            if accept:
+                codes[var] = proposal
+                current = float(scores[proposal])
+
+        assignment = {var: self.network.values[var][best_codes[var]] for var in map_vars}
+        gap = (upper_bound - best) / upper_bound if upper_bound > 0 else 0.0
+        if gap < OPTIMALITY_TOLERANCE:
+            gap = 0.0
+        return AnytimeResult(assignment, best, upper_bound, gap, steps)
+
+    def prepare_scoring(self, map_vars, deadline=None):
+        """
+        Sums out, once per query, all non-map variables whose elimination does not involve a map variable. Scoring
+        an assignment then only has to eliminate the remaining non-map variables.
+
+        Returns: False if the deadline (a time.perf_counter value) passed before the preparation was finished
+        """
+        factors = list(self.bounds.factors)
+        self.remaining_sum_order = []
+        self.scores = OrderedDict()
+        for var in self.bounds.sum_order:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            to_multiply = [factor for factor in factors if var in factor.variables]
+            if not to_multiply:
+                continue
+            if any(v in map_vars for factor in to_multiply for v in factor.variables):
+                self.remaining_sum_order.append(var)
+                continue
+            result = NumpyFactor.sum_product(to_multiply, var)
+            factors = [factor for factor in factors if var not in factor.variables] + [result]
+        self.partial_factors = factors
+        return True
+
+    def neighbourhood(self, var, codes):
+        """
+        Computes the probability P(assignment, evidence) for every state of one map variable, with the other map
+        variables fixed to codes
+        """
+        key = tuple(sorted((v, c) for v, c in codes.items() if v != var)) + ((var, None),)
+        if key in self.scores:
+            self.scores.move_to_end(key)
+            return self.scores[key]
+
+        factors = []
+        for factor in self.partial_factors:
+            factor = factor.copy()
+            for v in [v for v in factor.variables if v in codes and v != var]:
+                factor.reduce(v, codes[v])
+            factors.append(factor)
+
+        for sum_var in self.remaining_sum_order:
+            to_multiply = [factor for factor in factors if sum_var in factor.variables]
+            if not to_multiply:
+                continue
+            result = NumpyFactor.sum_product(to_multiply, sum_var)
+            factors = [factor for factor in factors if sum_var not in factor.variables] + [result]
+
+        scores = np.ones(len(self.network.values[var]))
+        for factor in factors:
+            # What is left only depends on var, or on nothing at all
+            scores = scores * factor.aligned([var]).reshape(-1)
+
+        self.scores[key] = scores
+        if len(self.scores) > self.score_cache_size:
+            self.scores.popitem(last=False)
+        return scores
+
+    def score(self, codes):
+        """
+        Returns P(assignment, evidence) for a full assignment {map variable: state index}
+        """
+        if not codes:
+            # Without map variables everything was summed out while preparing, leaving P(evidence)
+            return float(np.prod([float(factor.table) for factor in self.partial_factors]))
+        var = next(iter(codes))
+        return float(self.neighbourhood(var, codes)[codes[var]])
@@ -0,0 +1,234 @@
+"""
+Command line runner that answers all MAP queries of a query file with a pool of worker processes.
+
+Query files are either in the queries.json format, which is read as a whole, or JSON Lines (.jsonl), which is read
+as a stream so workloads larger than memory can be answered. The first line of a JSON Lines file lists the networks
+and every further line is one query:
+
+    {"networks": [{"name": "alarm", "file": "alarm.bif"}]}
+    {"network": "alarm", "name": "q1", "map_vars": ["Tampering", "Report"], "evidence": {"Smoke": "1"}}
+
+Every worker loads each network at most once and keeps it for all queries it receives. With --shared the parent
+loads every network once into shared memory instead, and the workers attach to it without copying, see
+shared_network.py. Results are written as JSON Lines, one line per query in the order of the input file:
+
+    {"index": 0, "network": "alarm", "query": "q1", "result": {"Report": "0", "Tampering": "0"}, "seconds": 0.01}
+
+Usage:
+    python batch_runner.py data/queries.json results.jsonl --workers 8
+    python batch_runner.py queries.jsonl results.jsonl --workers 8
+
+"""
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from compiled_network import load_network
+from logger import logger
+from map import MAP
+from read_bayesnet import BayesNet
+from shared_network import SharedNetworkStore, attach
+
+# Per-process state of a worker, set up by init_worker
+_network_files = {}
+_networks = {}
+_options = {}
+
+
+def init_worker(network_files, options):
+    """
+    Initializes a worker process
+    Args:
+        network_files: dictionary {network name: path to .bif file}
+        options:       dictionary with the "elim_heuristic", "factor_backend" and "compiled" settings, and under
+                       "shared" a dictionary {network name: shared_network.SharedNetwork} of published networks
+    """
+    _network_files.update(network_files)
+    _options.update(options)
+
+    # Per-query information is part of the output, so keep the workers from logging every run to the console
+    logger.setLevel(logging.WARNING)
+
+
+def get_network(name):
+    """
+    Returns the network with the given name, loading it the first time it is used in this process
+    """
+    if name not in _networks:
+        if name in _options.get("shared", {}):
+            _networks[name] = attach(_options["shared"][name])
+        elif _options.get("compiled"):
+            _networks[name] = load_network(_network_files[name])
+        else:
+            _networks[name] = BayesNet(_network_files[name])
+    return _networks[name]
+
+
+def run_chunk(chunk):
+    """
+    Answers a list of queries in a worker process
+    Args:
+        chunk: list of (index, network name, query) tuples
+
+    Returns: a list with a result record per query
+    """
+    records = []
+    for index, net_name, query in chunk:
+        start = time.perf_counter()
+        record = {"index": index, "network": net_name, "query": query.get("name")}
+        try:
+            map = MAP(get_network(net_name))
+            record["result"] = map.run(query["map_vars"], query.get("evidence", {}),
+                                       elim_heuristic=_options.get("elim_heuristic"),
+                                       factor_backend=_options.get("factor_backend", "pandas"))
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["seconds"] = time.perf_counter() - start
+        records.append(record)
+    return records
+
+
+def read_query_file(query_file):
+    """
+    Reads the networks of a query file and returns them with an iterator over its queries. Queries of a JSON Lines
+    file are read one line at a time while the iterator is consumed, the file is closed when it is exhausted.
+    Args:
+        query_file: path to a queries.json style file or to a JSON Lines file with a .jsonl suffix
+
+    Returns: a list of {"name", "file"} dictionaries and an iterator of (network name, query) pairs
+    """
+    if Path(query_file).suffix != ".jsonl":
+        with open(query_file, "r") as f:
+            query_data = json.load(f)
+        queries = ((net["name"], query) for net in query_data["networks"] for query in net["queries"])
+        return query_data["networks"], queries
+
+    file = open(query_file, "r")
+    networks = json.loads(file.readline())["networks"]
+
+    def queries():
+        with file:
+            for line in file:
+                if line.strip():
+                    query = json.loads(line)
+                    yield query["network"], query
+
+    return networks, queries()
+
+
+def iter_chunks(queries, chunk_size):
+    """
+    Splits (network name, query) pairs into chunks of (index, network name, query) tuples
+    """
+    chunk = []
+    for index, (net_name, query) in enumerate(queries):
+        chunk.append((index, net_name, query))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_queries(query_file, output, network_dir=None, workers=None, chunk_size=16, elim_heuristic=None,
+                factor_backend="pandas", compiled=False, shared=False):
+    """
+    Answers all queries of a query file in a process pool and writes the results as JSON Lines. Only a bounded
+    number of queries is held in memory at once when the queries are read from a JSON Lines file.
+    Args:
+        query_file:     path to the queries file, see read_query_file
+        output:         writable text file the result lines are written to
+        network_dir:    directory containing the .bif files, defaults to ../Networks relative to the queries file
+        workers:        number of worker processes, defaults to the number of CPUs
+        chunk_size:     number of queries sent to a worker at once
+        elim_heuristic: elimination order heuristic passed to MAP.run
+        factor_backend: factor backend passed to MAP.run
+        compiled:       load networks through the compiled network cache
+        shared:         load every network once in this process and share its probabilities with the workers
+
+    Returns: the number of queries that were answered
+    """
+    query_file = Path(query_file)
+    network_dir = Path(network_dir) if network_dir is not None else query_file.parent.parent / "Networks"
+
+    networks, queries = read_query_file(query_file)
+    network_files = {net["name"]: str(network_dir / net["file"]) for net in networks}
+    options = {"elim_heuristic": elim_heuristic, "factor_backend": factor_backend, "compiled": compiled}
+
+    if compiled:
+        # Compile up front, so workers do not race to write the same cache file
+        for filename in network_files.values():
+            load_network(filename)
+
+    workers = workers or os.cpu_count() or 1
+    count = 0
+    with SharedNetworkStore() as store:
+        options = publish(store, network_files, options, shared)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(network_files, options)) as executor:
+            # Keep a bounded number of chunks in flight and write them out in submission order
+            max_pending = 4 * workers
+            pending = deque()
+            for chunk in iter_chunks(queries, chunk_size):
+                pending.append(executor.submit(run_chunk, chunk))
+                if len(pending) >= max_pending:
+                    count += write_records(pending.popleft().result(), output)
+            while pending:
+                count += write_records(pending.popleft().result(), output)
+
+    return count
+
+
+def publish(store, network_files, options, shared):
+    """
+    Loads every network into shared memory if shared is set
+    Returns: the worker options, with the handles of the published networks under "shared"
+    """
+    if not shared:
+        return options
+    load = load_network if options.get("compiled") else BayesNet
+    handles = {name: store.publish(name, load(filename)) for name, filename in network_files.items()}
+    return dict(options, shared=handles)
+
+
+def write_records(records, output):
+    """
+    Writes result records as JSON Lines and returns the number of records written
+    """
+    for record in records:
+        output.write(json.dumps(record) + "\n")
+    output.flush()
+    return len(records)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Answer MAP queries in parallel and write the results as JSON Lines")
+    parser.add_argument("queries", help="Path to queries.json or to a .jsonl query file")
+    parser.add_argument("output", help="Path to the output .jsonl file, - for standard output")
+    parser.add_argument("--network-dir", help="Directory containing the .bif files")
+    parser.add_argument("--workers", type=int, help="Number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--chunk-size", type=int, default=16, help="Number of queries sent to a worker at once")
+    parser.add_argument("--heuristic", help="Elimination order heuristic")
+    parser.add_argument("--backend", default="pandas", help="Factor backend, pandas or numpy")
+    parser.add_argument("--compiled", action="store_true", help="Load networks through the compiled network cache")
+    parser.add_argument("--shared", action="store_true", help="Share the networks with the workers in shared memory")
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.output == "-":
+        count = run_queries(args.queries, sys.stdout, args.network_dir, args.workers, args.chunk_size,
+                            args.heuristic, args.backend, args.compiled, args.shared)
+    else:
+        with open(args.output, "w") as output:
+            count = run_queries(args.queries, output, args.network_dir, args.workers, args.chunk_size,
+                                args.heuristic, args.backend, args.compiled, args.shared)
+
+    print(f"Answered {count} queries in {time.perf_counter() - start:.2f} seconds", file=sys.stderr)
@@ -0,0 +1,247 @@
+"""
+Benchmarks for network loading and MAP inference on synthetic networks.
+
+Random networks of a given size, maximum in-degree and cardinality are written as .bif files. The suite times
+loading them with BayesNet, MAP.run with every elimination heuristic and factor backend, MAP.run_batch and the
+process pool of batch_runner.py. Results are written as JSON:
+
+    {"config": {...}, "benchmarks": {"map/n30/min_fill/numpy": {"seconds": 0.012, "repeat": 3}, ...}}
+
+Passing the results of an earlier run as baseline reports every benchmark that got slower than the threshold
+allows, and makes the command exit with status 1, so performance changes show up between commits.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --output bench.json --baseline previous_bench.json --threshold 1.5
+
+"""
+import io
+import json
+import logging
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from batch_runner import run_queries
+from elim_order_cache import ElimOrderCache
+from elim_order_heuristics import GREEDY_HEURISTICS
+from logger import logger
+from map import MAP, FACTOR_BACKENDS
+from read_bayesnet import BayesNet
+
+# Heuristics MAP.run accepts, None is its default
+HEURISTICS = [None, "min_parents"] + list(GREEDY_HEURISTICS)
+
+# Benchmarks may be this many times slower than the baseline before they count as a regression
+DEFAULT_THRESHOLD = 1.5
+
+# Slowdowns smaller than this many seconds are timer noise and never count as a regression
+MIN_REGRESSION_SECONDS = 0.01
+
+
+def random_network_bif(n_nodes, max_parents=3, cardinality=2, seed=None):
+    """
+    Generates a random Bayesian network in .bif format
+    Args:
+        n_nodes:     number of variables
+        max_parents: maximum number of parents of a variable, parents are drawn from the variables before it
+        cardinality: number of states of every variable, or a (low, high) range to draw it from
+        seed:        seed for the random number generator
+
+    Returns: the contents of the .bif file
+    """
+    rng = np.random.default_rng(seed)
+    names = [f"X{i}" for i in range(n_nodes)]
+    low, high = cardinality if isinstance(cardinality, tuple) else (cardinality, cardinality)
+    states = {name: [f"s{k}" for k in range(int(rng.integers(low, high + 1)))] for name in names}
+
+    lines = [f"network random_{n_nodes}_{max_parents}_{seed} {{", "}"]
+    for name in names:
+        lines += [f"variable {name} {{",
+                  f"  type discrete [ {len(states[name])} ] {{ {', '.join(states[name])} }};",
+                  "}"]
+
+    for i, name in enumerate(names):
+        n_parents = int(rng.integers(0, min(max_parents, i) + 1))
+        parents = [names[j] for j in sorted(rng.choice(i, size=n_parents, replace=False))] if n_parents else []
+
+        if not parents:
+            lines += [f"probability ( {name} ) {{",
+                      f"  table {', '.join(repr(float(p)) for p in rng.dirichlet(np.ones(len(states[name]))))};",
+                      "}"]
+            continue
+
+        lines.append(f"probability ( {name} | {', '.join(parents)} ) {{")
+        for row in np.ndindex(*[len(states[parent]) for parent in parents]):
+            labels = ", ".join(states[parent][k] for parent, k in zip(parents, row))
+            probs = ", ".join(repr(float(p)) for p in rng.dirichlet(np.ones(len(states[name]))))
+            lines.append(f"  ({labels}) {probs};")
+        lines.append("}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_random_network(path, n_nodes, max_parents=3, cardinality=2, seed=None):
+    """
+    Writes a random network to a .bif file, see random_network_bif, and returns the path
+    """
+    path = Path(path)
+    path.write_text(random_network_bif(n_nodes, max_parents, cardinality, seed))
+    return path
+
+
+def random_queries(network: BayesNet, n_queries, n_map_vars=2, n_observed=3, seed=None):
+    """
+    Draws random MAP queries that all share the same map and observed variables, so they can also be batched
+    Returns: a list of {"name", "map_vars", "evidence"} dictionaries in the layout of queries.json
+    """
+    rng = random.Random(seed)
+    variables = rng.sample(network.nodes, n_map_vars + n_observed)
+    map_vars, observed = variables[:n_map_vars], variables[n_map_vars:]
+    return [{"name": f"q{i}",
+             "map_vars": map_vars,
+             "evidence": {var: rng.choice(network.values[var]) for var in observed}}
+            for i in range(n_queries)]
+
+
+def time_call(function, repeat=3):
+    """
+    Calls a function repeatedly and returns the fastest wall-clock time in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmarks(sizes=(20, 40), max_parents=3, cardinality=2, n_queries=8, repeat=3, workers=2,
+                   backends=None, heuristics=None, seed=0):
+    """
+    Runs the benchmark suite
+    Args:
+        sizes:       numbers of variables of the generated networks
+        max_parents: maximum in-degree of the generated networks
+        cardinality: number of states per variable, or a (low, high) range
+        n_queries:   number of queries per network for the batch and parallel benchmarks
+        repeat:      the fastest of this many runs is recorded
+        workers:     number of worker processes for the parallel benchmark
+        backends:    factor backends to time, defaults to all keys of FACTOR_BACKENDS
+        heuristics:  elimination heuristics to time, defaults to HEURISTICS
+        seed:        seed for the generated networks and queries
+
+    Returns: dictionary {"config": {...}, "benchmarks": {name: {"seconds": ..., "repeat": ...}}}
+    """
+    backends = list(FACTOR_BACKENDS) if backends is None else backends
+    heuristics = HEURISTICS if heuristics is None else heuristics
+    config = {"sizes": list(sizes), "max_parents": max_parents, "cardinality": cardinality, "n_queries": n_queries,
+              "repeat": repeat, "workers": workers, "seed": seed}
+    benchmarks = {}
+
+    def record(name, seconds):
+        benchmarks[name] = {"seconds": seconds, "repeat": repeat}
+
+    # MAP.run logs every query, which would dominate the timings
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            query_data = {"networks": []}
+
+            for n_nodes in sizes:
+                name = f"n{n_nodes}"
+                path = write_random_network(directory / f"{name}.bif", n_nodes, max_parents, cardinality, seed)
+                record(f"load/{name}", time_call(lambda: BayesNet(path), repeat))
+
+                network = BayesNet(path)
+                queries = random_queries(network, n_queries, seed=seed)
+                query_data["networks"].append({"name": name, "file": path.name, "queries": queries})
+                map_vars, evidence = queries[0]["map_vars"], queries[0]["evidence"]
+
+                for heuristic in heuristics:
+                    for backend in backends:
+                        # A fresh order cache per run, so the heuristic itself is part of the timing
+                        record(f"map/{name}/{heuristic}/{backend}",
+                               time_call(lambda: MAP(network, order_cache=ElimOrderCache()).run(
+                                   map_vars, evidence, elim_heuristic=heuristic, factor_backend=backend), repeat))
+
+                evidence_list = [query["evidence"] for query in queries]
+                record(f"sequential/{name}", time_call(lambda: [MAP(network).run(map_vars, evidence,
+                                                                                 factor_backend="numpy")
+                                                               for evidence in evidence_list], repeat))
+                record(f"batch/{name}", time_call(lambda: MAP(network).run_batch(map_vars, evidence_list), repeat))
+
+            query_file = directory / "queries.json"
+            query_file.write_text(json.dumps(query_data))
+            record("parallel", time_call(lambda: run_queries(query_file, io.StringIO(), network_dir=directory,
+                                                             workers=workers, factor_backend="numpy"), repeat))
+    finally:
+        logger.setLevel(level)
+
+    return {"config": config, "benchmarks": benchmarks}
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares benchmark results with an earlier run
+    Args:
+        results:   results of run_benchmarks
+        baseline:  results of an earlier run. It may contain a "thresholds" dictionary {benchmark name: ratio}
+                   that overrides the threshold for single benchmarks.
+        threshold: ratio of new over old time above which a benchmark counts as a regression
+
+    Returns: dictionary {benchmark name: ratio} of the benchmarks that regressed by more than MIN_REGRESSION_SECONDS
+    """
+    thresholds = baseline.get("thresholds", {})
+    regressions = {}
+    for name, entry in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        old = baseline["benchmarks"][name]["seconds"]
+        ratio = entry["seconds"] / max(old, 1e-9)
+        if ratio > thresholds.get(name, threshold) and entry["seconds"] - old > MIN_REGRESSION_SECONDS:
+            regressions[name] = ratio
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark network loading and MAP inference")
+    parser.add_argument("--output", help="Path to write the results to as JSON, defaults to standard output")
+    parser.add_argument("--baseline", help="Results of an earlier run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Slowdown ratio that counts as a regression")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 40], help="Numbers of variables")
+    parser.add_argument("--max-parents", type=int, default=3, help="Maximum number of parents per variable")
+    parser.add_argument("--cardinality", type=int, default=2, help="Number of states per variable")
+    parser.add_argument("--queries", type=int, default=8, help="Queries per network for batch and parallel runs")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per benchmark, the fastest counts")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes for the parallel benchmark")
+    parser.add_argument("--backends", nargs="+", help="Factor backends to time")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated networks and queries")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.max_parents, args.cardinality, args.queries, args.repeat, args.workers,
+                             args.backends, seed=args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        for name, ratio in sorted(regressions.items()):
+            print(f"Regression: {name} is {ratio:.2f}x slower than the baseline", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,239 @@
+"""
+Exact MAP by depth-first branch and bound over the map variables.
+
+Upper bounds come from mini-bucket elimination: buckets whose combined scope exceeds the i-bound are split into
+mini-buckets that are eliminated separately, which keeps every intermediate factor small. The largest factor the
+solver creates is therefore bounded by the i-bound instead of by the width of the constrained elimination order
+that MAP.run needs.
+
+"""
+import numpy as np
+
+from elim_order_heuristics import greedy_order
+from numpy_factor import NumpyFactor
+from read_bayesnet import BayesNet
+
+
+def reduced_factors(network: BayesNet, observed: dict):
+    """
+    Converts the CPTs of a network to numpy factors with the evidence applied
+    """
+    factors = []
+    evidence = network.encode(observed)
+    for variable in network.nodes:
+        factor = NumpyFactor.from_network(network, variable)
+        for var, code in evidence.items():
+            if var in factor.variables:
+                factor.reduce(var, code)
+        factors.append(factor)
+    return factors
+
+
+def mini_bucket_elimination(factors, order, map_vars, i_bound):
+    """
+    Runs mini-bucket elimination along an order in which all non-map variables come before the map variables.
+    Sum buckets that are split sum out their variable in the first mini-bucket and maximise it out in the others,
+    map buckets maximise in every mini-bucket, so every generated function is an upper bound.
+    Args:
+        factors:  list of numpy factors, not modified
+        order:    elimination order of all variables in the factors
+        map_vars: the map variables
+        i_bound:  maximum number of variables in the combined scope of a mini-bucket
+
+    Returns: a dictionary {variable: list of functions in its bucket}, a dictionary {variable: list of messages
+             its bucket sent}, the product of all functions without variables and whether no bucket had to be split
+             (in which case the bounds are exact)
+    """
+    position = {var: i for i, var in enumerate(order)}
+    buckets = {var: [] for var in order}
+    sent = {var: [] for var in order}
+    constant = 1.0
+    exact = True
+
+    def place(factor):
+        nonlocal constant
+        if factor.variables:
+            buckets[min(factor.variables, key=position.get)].append(factor)
+        else:
+            constant *= float(factor.table)
+
+    for factor in factors:
+        place(factor)
+
+    for var in order:
+        # Greedily fill mini-buckets, starting with the functions with the largest scopes
+        mini_buckets = []
+        for factor in sorted(buckets[var], key=lambda f: len(f.variables), reverse=True):
+            for scope, members in mini_buckets:
+                if len(scope | set(factor.variables)) <= i_bound:
+                    scope.update(factor.variables)
+                    members.append(factor)
+                    break
+            else:
+                mini_buckets.append((set(factor.variables), [factor]))
+
+        if len(mini_buckets) > 1:
+            exact = False
+
+        for k, (_, members) in enumerate(mini_buckets):
+            if var in map_vars or k > 0:
+                message = NumpyFactor.max_product(members, var)
+            else:
+                message = NumpyFactor.sum_product(members, var)
+            sent[var].append(message)
+            place(message)
+
+    return buckets, sent, constant, exact
+
+
+class BranchAndBoundMAP:
+    """
+    Exact MAP solver that searches over the map variables, pruning with mini-bucket upper bounds.
+    """
+
+    def __init__(self, network: BayesNet, i_bound=10, elim_heuristic="min_fill"):
+        """
+        Args:
+            network:        the network to run queries on
+            i_bound:        maximum number of variables in a mini-bucket, higher is tighter but uses more memory
+            elim_heuristic: greedy heuristic for the constrained elimination order, see GREEDY_HEURISTICS
+        """
+        self.network = network
+        self.i_bound = i_bound
+        self.elim_heuristic = elim_heuristic
+
+        # Statistics and result of the most recent run
+        self.nodes_expanded = 0
+        self.probability = None
+
+    def run(self, map_vars: list, observed: dict):
+        """
+        Finds the most probable assignment to the map variables given the evidence
+
+        Input:
+            map_vars: The map variables to be queried
+            observed: A dictionary of the observed variables {variable: value}
+
+        Output: A dictionary representing the most probable assignment to the map variables {variable: value}.
+                Its probability P(assignment, evidence) is stored in self.probability.
+
+        """
+        self.prepare(map_vars, observed)
+
+        self.nodes_expanded = 0
+        self.best_value = 0.0
+        self.best_codes = None
+        if self.constant > 0:
+            self.search(0, self.constant, {})
+
+        if self.best_codes is None:
+            # The evidence is impossible, every assignment has probability zero
+            self.best_codes = {var: 0 for var in map_vars}
+
+        self.probability = self.best_value
+        return {var: self.network.values[var][self.best_codes[var]] for var in map_vars}
+
+    def prepare(self, map_vars: list, observed: dict):
+        """
+        Applies the evidence and runs mini-bucket elimination for a query, without searching
+        """
+        self.factors = reduced_factors(self.network, observed)
+        order, _ = greedy_order(self.network, map_vars, observed, self.elim_heuristic)
+        self.sum_order = [var for var in order if var not in map_vars]
+
+        self.buckets, self.sent, self.constant, self.exact = mini_bucket_elimination(self.factors, order, map_vars,
+                                                                                     self.i_bound)
+
+        # Assign the map variables in reverse elimination order, so every function in the bucket of the next
+        # variable only depends on that variable and variables that are already assigned
+        self.search_order = [var for var in reversed(order) if var in map_vars]
+
+    def upper_bound(self):
+        """
+        Returns the mini-bucket upper bound on the probability of the MAP assignment of the prepared query
+        """
+        if not self.search_order or self.constant == 0:
+            return self.constant
+        return float(self.constant * self.bucket_vector(self.search_order[0], {}).max())
+
+    def greedy_codes(self):
+        """
+        Assigns the map variables of the prepared query one by one, each time picking the state with the highest
+        bound. Returns a dictionary {map variable: state index}.
+        """
+        codes = {}
+        bound = self.constant
+        for var in self.search_order:
+            bounds = bound * self.bucket_vector(var, codes) if bound > 0 else np.zeros(len(self.network.values[var]))
+            codes[var] = int(np.argmax(bounds))
+            bound = bounds[codes[var]]
+        return codes
+
+    def bucket_vector(self, var, codes):
+        """
+        Computes by how much the bound changes when a variable is assigned, for each of its states. The bound of a
+        partial assignment is the product of the functions in the buckets of the assigned variables, except for
+        the messages those buckets sent themselves. Assigning a variable therefore multiplies in its bucket and
+        divides out the messages it sent, which only depend on variables that are already assigned.
+        """
+        vector = np.ones(len(self.network.values[var]))
+        for factor in self.buckets[var]:
+            index = tuple(slice(None) if v == var else codes[v] for v in factor.variables)
+            vector = vector * factor.table[index]
+
+        # A sent message is only zero if the current bound is zero, and such nodes are pruned before getting here
+        for message in self.sent[var]:
+            vector = vector / message.table[tuple(codes[v] for v in message.variables)]
+        return vector
+
+    def search(self, depth, bound, codes):
+        """
+        Depth-first search below a partial assignment
+        Args:
+            depth: number of assigned map variables
+            bound: upper bound on the probability of any completion of the partial assignment
+            codes: dictionary {map variable: state index} of the partial assignment
+        """
+        self.nodes_expanded += 1
+
+        if depth == len(self.search_order):
+            value = bound if self.exact else self.exact_value(codes)
+            if value > self.best_value:
+                self.best_value = value
+                self.best_codes = dict(codes)
+            return
+
+        var = self.search_order[depth]
+        bounds = bound * self.bucket_vector(var, codes)
+
+        # Try the most promising states first; once a bound cannot beat the best assignment, neither can the rest
+        for code in np.argsort(-bounds, kind="stable"):
+            if bounds[code] <= self.best_value:
+                break
+            codes[var] = int(code)
+            self.search(depth + 1, bounds[code], codes)
+            del codes[var]
+
+    def exact_value(self, codes):
+        """
+        Computes P(assignment, evidence) for a full assignment to the map variables by summing out all other
+        variables
+        """
+        factors = []
+        for factor in self.factors:
+            factor = factor.copy()
+            for var in [var for var in factor.variables if var in codes]:
+                factor.reduce(var, codes[var])
+            factors.append(factor)
+
+        for var in self.sum_order:
+            to_multiply = [factor for factor in factors if var in factor.variables]
+            if not to_multiply:
+                continue
+            result = NumpyFactor.sum_product(to_multiply, var)
+            factors = [factor for factor in factors if var not in factor.variables] + [result]
+
+        value = 1.0
+        for factor in factors:
+            value *= float(factor.table)
+        return value
@@ -0,0 +1,195 @@
+"""
+Compiled binary format for Bayesian networks, so a network only has to be parsed from its .bif file once.
+
+A compiled file consists of
+    - the magic bytes b"BNET" and a little endian uint32 format version
+    - a little endian uint64 with the length of the metadata
+    - the metadata as UTF-8 JSON: the network name, the sha256 of the source .bif file and per variable its name,
+      states, parents and the offset and shape of its probabilities
+    - zero padding up to a multiple of 8 bytes
+    - the probabilities of all variables as one contiguous block of little endian float64 values
+
+Loading memory-maps the probability block, so the arrays of a compiled network are read-only views into the file.
+
+"""
+import hashlib
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from read_bayesnet import BayesNet
+
+MAGIC = b"BNET"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ")
+DTYPE = np.dtype("<f8")
+
+# Default directory, relative to the .bif file, in which compiled networks are cached
+CACHE_DIR = "__netcache__"
+
+
+def source_hash(filename):
+    """
+    Returns the sha256 hex digest of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_network(filename, output=None):
+    """
+    Parse a .bif file and write it in the compiled format
+    Args:
+        filename: path to the .bif file
+        output:   path of the compiled file, defaults to the .bif path with a .bnc suffix
+
+    Returns: path of the compiled file
+    """
+    filename = Path(filename)
+    output = Path(output) if output is not None else filename.with_suffix(".bnc")
+    write_compiled(BayesNet(filename), output, source_hash(filename))
+    return output
+
+
+def table_layout(network: BayesNet):
+    """
+    Lays out the probabilities of all variables of a network after each other in one flat block
+    Args:
+        network: the network
+
+    Returns: a list with per variable a dictionary with its name, states, parents and the offset and shape of its
+             probabilities in the block, and the total number of values in the block
+    """
+    variables = []
+    offset = 0
+    for variable in network.nodes:
+        shape = network.tables[variable].shape
+        variables.append({
+            "name": variable,
+            "states": network.values[variable],
+            "parents": network.parents[variable],
+            "offset": offset,
+            "shape": list(shape),
+        })
+        offset += int(np.prod(shape))
+    return variables, offset
+
+
+def tables_from_block(variables, data):
+    """
+    Splits a flat block of probabilities laid out by table_layout into the arrays of the variables, without copying
+    Args:
+        variables: the layout of the block
+        data:      one dimensional array with the block
+
+    Returns: the values, parents and tables dictionaries of the network
+    """
+    values = {}
+    parents = {}
+    tables = {}
+    for variable in variables:
+        name = variable["name"]
+        values[name] = variable["states"]
+        parents[name] = variable["parents"]
+        end = variable["offset"] + int(np.prod(variable["shape"]))
+        tables[name] = data[variable["offset"]:end].reshape(variable["shape"])
+    return values, parents, tables
+
+
+def write_compiled(network: BayesNet, output, digest=""):
+    """
+    Write a loaded network in the compiled format. The file is written next to its destination first and moved in
+    place afterwards, so readers never see a partially written file.
+    Args:
+        network: network to write
+        output:  path of the compiled file
+        digest:  hash of the source the network was loaded from, stored to detect stale files
+    """
+    variables, _ = table_layout(network)
+    metadata = json.dumps({"name": network.name, "source_hash": digest, "variables": variables}).encode("utf-8")
+    padding = -(HEADER.size + len(metadata)) % DTYPE.itemsize
+
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    temporary = output.with_name(f"{output.name}.{os.getpid()}.tmp")
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+        file.write(metadata)
+        file.write(b"\0" * padding)
+        for variable in network.nodes:
+            file.write(np.ascontiguousarray(network.tables[variable], dtype=DTYPE).tobytes())
+    os.replace(temporary, output)
+
+
+def read_metadata(filename):
+    """
+    Read the metadata of a compiled file
+    Returns: the metadata dictionary and the byte offset at which the probabilities start
+    """
+    with open(filename, "rb") as file:
+        magic, version, length = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{filename} is not a compiled network of version {VERSION}")
+        metadata = json.loads(file.read(length).decode("utf-8"))
+
+    start = HEADER.size + length
+    return metadata, start + (-start % DTYPE.itemsize)
+
+
+def load_compiled(filename) -> BayesNet:
+    """
+    Load a compiled network. The probability arrays are memory-mapped, nothing is copied into memory until it is used.
+    """
+    metadata, start = read_metadata(filename)
+    size = sum(int(np.prod(variable["shape"])) for variable in metadata["variables"])
+    data = np.memmap(filename, dtype=DTYPE, mode="r", offset=start, shape=(size,)) if size else np.empty(0, DTYPE)
+
+    values, parents, tables = tables_from_block(metadata["variables"], data)
+    return BayesNet.from_tables(metadata["name"], values, parents, tables)
+
+
+def load_network(filename, cache_dir=None) -> BayesNet:
+    """
+    Load a network from a .bif file through the compiled cache. The .bif file is only parsed if there is no compiled
+    file for it yet or if the compiled file was made from different contents.
+    Args:
+        filename:  path to the .bif file
+        cache_dir: directory for compiled files, defaults to __netcache__ next to the .bif file
+    """
+    filename = Path(filename)
+    cache_dir = Path(cache_dir) if cache_dir is not None else filename.parent / CACHE_DIR
+    compiled = cache_dir / filename.with_suffix(".bnc").name
+    digest = source_hash(filename)
+
+    try:
+        metadata, _ = read_metadata(compiled)
+        up_to_date = metadata["source_hash"] == digest
+    except (OSError, ValueError, struct.error):
+        up_to_date = False
+
+    if not up_to_date:
+        write_compiled(BayesNet(filename), compiled, digest)
+
+    return load_compiled(compiled)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile .bif networks to the binary network format")
+    parser.add_argument("networks", nargs="+", help="Paths to .bif files")
+    parser.add_argument("--output-dir", help="Directory for the compiled files, defaults to next to each .bif file")
+
+    args = parser.parse_args()
+
+    for network in args.networks:
+        output = None
+        if args.output_dir is not None:
+            output = Path(args.output_dir) / Path(network).with_suffix(".bnc").name
+        print(f"Compiled {network} to {compile_network(network, output)}")
@@ -0,0 +1,119 @@
+"""
+Bounded LRU cache for elimination orders.
+
+An elimination order only depends on the network, the heuristic, which variables are map variables or observed and
+which CPTs are left after pruning, not on the observed values. Queries with the same shape can therefore reuse the
+order of an earlier query.
+
+"""
+import threading
+import weakref
+from collections import OrderedDict
+
+
+class ElimOrderCache:
+    """
+    Least-recently-used cache of (elimination order, predicted max clique size) pairs.
+
+    Entries are stored per network object. When a network is garbage collected its entries are dropped, so an
+    entry can never be served for a different network that happens to be allocated at the same address.
+    Keys also contain the structure version of the network, so after BayesNet.invalidate_structure a network that
+    was modified in place gets new entries instead of stale orders. Call invalidate to also free the old entries
+    right away.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(network, heuristic, map_vars, observed, nodes=None):
+        """
+        Returns the key under which the order for a query shape is stored
+        Args:
+            network:   network the query is run on
+            heuristic: name of the elimination order heuristic
+            map_vars:  the map variables of the query
+            observed:  the observed variables of the query, only the variable names are used
+            nodes:     the nodes whose CPTs are used after pruning, None if all of them are
+        """
+        return (id(network), network.structure_version, heuristic, frozenset(map_vars), frozenset(observed),
+                None if nodes is None else frozenset(nodes))
+
+    def get(self, network, heuristic, map_vars, observed, nodes=None):
+        """
+        Look up a cached order
+        Returns: the (elimination order, max clique size) pair, or None if the query shape was not cached
+        """
+        entry = self.lookup(self.make_key(network, heuristic, map_vars, observed, nodes))
+        if entry is None:
+            return None
+        order, max_clique_size = entry
+        return list(order), max_clique_size
+
+    def put(self, network, heuristic, map_vars, observed, order, max_clique_size, nodes=None):
+        """
+        Store the order for a query shape, evicting the least recently used entry if the cache is full
+        """
+        self.store(network, self.make_key(network, heuristic, map_vars, observed, nodes),
+                   (tuple(order), max_clique_size))
+
+    def lookup(self, key):
+        """
+        Returns the entry stored under a key, or None, and counts the hit or miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def store(self, network, key, entry):
+        """
+        Stores an entry for a network under a key whose first element is id(network)
+        """
+        with self._lock:
+            if id(network) not in self._watched:
+                self._watched.add(id(network))
+                weakref.finalize(network, self.invalidate_id, id(network))
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, network):
+        """
+        Drop all orders that were computed for a network
+        """
+        self.invalidate_id(id(network))
+
+    def invalidate_id(self, network_id):
+        with self._lock:
+            self._watched.discard(network_id)
+            for key in [key for key in self._entries if key[0] == network_id]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Drop all entries and reset the hit and miss counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Returns a dictionary with the number of hits, misses and cached entries"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
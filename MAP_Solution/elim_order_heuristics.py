@@ -32,20 +32,9 @@ def min_factors(net: BayesNet) -> list:
     Returns: a list of nodes in ascending order of number of factors the node appears in
 
     """
-    # Dictionary of variable: factor counts
-    factor_count = {}
-
-    nodes = net.nodes
-    probabilities = net.probabilities
-
-    # Collect the counts for each variable
-    for node in nodes:
-        count = 0
-        for key, value in probabilities.items():
-
-            if node in value.columns:
-                count += 1
-        factor_count[node] = count
+    # Dictionary of variable: factor counts, from the variable-to-factor incidence index
+    index = net.index
+    factor_count = {node: index.num_factors(i) for i, node in enumerate(index.names)}
 
     # Sort the dictionary by count
     sorted_items = sorted(factor_count.items(), key=operator.itemgetter(1))
@@ -54,3 +43,149 @@ def min_factors(net: BayesNet) -> list:
     sorted_vars = [item[0] for item in sorted_items]
 
     return sorted_vars
+
+
+def interaction_graph(net: BayesNet, observed=(), nodes=None) -> dict:
+    """
+    Builds the moral graph of a bayesian network: every node is connected to its parents, its children and the
+    other parents of its children. Observed nodes are left out, since their factors are reduced before elimination.
+    Args:
+        net: Bayesian network to build the graph for.
+        observed: variables with evidence.
+        nodes: nodes whose CPTs are used, e.g. those left after pruning, all nodes if None. Only the variables in
+               these CPTs are in the graph.
+
+    Returns: a dictionary {variable: set of neighbouring variables}
+
+    """
+    nodes = net.nodes if nodes is None else nodes
+    present = {var for node in nodes for var in [node] + net.parents[node]}
+    graph = {node: set() for node in net.nodes if node in present and node not in observed}
+
+    for node in nodes:
+        parents = net.parents[node]
+        # Every CPT becomes a clique over the node and its parents
+        family = [var for var in [node] + parents if var in graph]
+        for var in family:
+            graph[var].update(other for other in family if other != var)
+
+    return graph
+
+
+def degree_cost(graph, var, cardinality):
+    """Number of neighbours of a variable (min-degree)"""
+    return len(graph[var])
+
+
+def fill_cost(graph, var, cardinality):
+    """Number of edges that eliminating a variable adds between its neighbours (min-fill)"""
+    neighbours = list(graph[var])
+    return sum(1 for i, u in enumerate(neighbours) for w in neighbours[i + 1:] if w not in graph[u])
+
+
+def weight_cost(graph, var, cardinality):
+    """Size of the factor created by eliminating a variable, the product of the cardinalities in its clique
+    (min-weight)"""
+    weight = cardinality[var]
+    for neighbour in graph[var]:
+        weight *= cardinality[neighbour]
+    return weight
+
+
+def weighted_fill_cost(graph, var, cardinality):
+    """Sum over the added edges of the product of the cardinalities of their end points (weighted-min-fill)"""
+    neighbours = list(graph[var])
+    return sum(cardinality[u] * cardinality[w]
+               for i, u in enumerate(neighbours) for w in neighbours[i + 1:] if w not in graph[u])
+
+
+# Greedy heuristics, looked up by name in MAP.get_map_elim_order
+GREEDY_HEURISTICS = {
+    "min_degree": degree_cost,
+    "min_fill": fill_cost,
+    "min_weight": weight_cost,
+    "weighted_min_fill": weighted_fill_cost,
+}
+
+
+def eliminate_from_graph(graph, var):
+    """
+    Removes a variable from an interaction graph, connecting all of its neighbours to each other
+    Args:
+        graph: dictionary {variable: set of neighbouring variables}, modified in place
+        var: variable to eliminate
+
+    Returns: the clique formed by the variable and its neighbours
+
+    """
+    neighbours = graph.pop(var)
+    for neighbour in neighbours:
+        graph[neighbour].discard(var)
+        graph[neighbour].update(other for other in neighbours if other != neighbour)
+    return neighbours | {var}
+
+
+def greedy_order(net: BayesNet, map_vars, observed, heuristic, nodes=None) -> tuple:
+    """
+    Greedily builds an elimination order on the interaction graph, every time eliminating the variable with the
+    lowest cost. All non-map variables are eliminated before the map variables, as required for MAP.
+    Args:
+        net: Bayesian network to find the elimination order for.
+        map_vars: map variables, these are eliminated last.
+        observed: variables with evidence, these are not eliminated.
+        heuristic: name of the cost function, one of the keys of GREEDY_HEURISTICS.
+        nodes: nodes whose CPTs take part in the elimination, all nodes if None. Only their variables are ordered.
+
+    Returns: the elimination order and the predicted size (number of variables) of the largest clique
+
+    """
+    cost_function = GREEDY_HEURISTICS[heuristic]
+    cardinality = {node: len(values) for node, values in net.values.items()}
+    graph = interaction_graph(net, observed, nodes)
+
+    # Break ties by the order in which the nodes were declared, so orders are reproducible
+    position = {node: i for i, node in enumerate(net.nodes)}
+
+    order = []
+    max_clique_size = 0
+    for group in ([var for var in graph if var not in map_vars], [var for var in graph if var in map_vars]):
+        remaining = set(group)
+        costs = {var: cost_function(graph, var, cardinality) for var in remaining}
+
+        while remaining:
+            var = min(remaining, key=lambda v: (costs[v], position[v]))
+            remaining.remove(var)
+            del costs[var]
+
+            neighbours = graph[var]
+            clique = eliminate_from_graph(graph, var)
+            order.append(var)
+            max_clique_size = max(max_clique_size, len(clique))
+
+            # Only the costs of the neighbours and their neighbours can have changed
+            affected = set(neighbours)
+            for neighbour in neighbours:
+                affected.update(graph[neighbour])
+            for other in affected & remaining:
+                costs[other] = cost_function(graph, other, cardinality)
+
+    return order, max_clique_size
+
+
+def induced_clique_size(net: BayesNet, order, observed=(), nodes=None) -> int:
+    """
+    Simulates an elimination order on the interaction graph to predict the size of the largest factor it creates.
+    Args:
+        net: Bayesian network the order belongs to.
+        order: elimination order.
+        observed: variables with evidence.
+        nodes: nodes whose CPTs take part in the elimination, all nodes if None.
+
+    Returns: the number of variables in the largest clique formed during elimination
+
+    """
+    graph = interaction_graph(net, observed, nodes)
+    max_clique_size = 0
+    for var in order:
+        max_clique_size = max(max_clique_size, len(eliminate_from_graph(graph, var)))
+    return max_clique_size
@@ -9,12 +9,23 @@ class Factor:
         self.dataframe = cpt
         assert isinstance(self.dataframe, pd.DataFrame)
 
+    @classmethod
+    def from_network(cls, network, variable):
+        """
+        Builds a factor from the conditional probability table of a variable in a network. States are stored as
+        their index in network.values, so merges, groupbys and comparisons work on small integers.
+        Args:
+            network:  read_bayesnet.BayesNet the variable belongs to
+            variable: variable whose conditional probability table to use
+        """
+        return cls(network.coded_probabilities[variable])
+
     def reduce(self, variable, value):
         """
         Reduces this factor by applying evidence to it. Evidence variable is removed from dataframe
         Args:
             variable: variable to apply evidence to
-            value: evidence to apply
+            value: index of the observed state
         """
         # Reduce table
         self.dataframe = self.dataframe[self.dataframe[variable] == value]
@@ -48,10 +59,14 @@ class Factor:
         # Extract all variable columns (don't select last column which is probability column)
         all_columns = self.dataframe.columns[:-1]
 
-        # TODO: This causes problems when the factor only contains the variable to be marginalized out
         # Get all columns except for the column to be marginalized out
         columns_to_keep = [col for col in all_columns if col != variable]
 
+        # If only the variable itself is left, the result is a constant with a single "prob" row
+        if not columns_to_keep:
+            self.dataframe = pd.DataFrame({"prob": [self.dataframe["prob"].sum()]})
+            return
+
         # Sum out variable by first grouping by the columns to keep and summing up each group
         # Calling reset_index() is necessary to prevent index out of range exception
         new_factor = self.dataframe.groupby(columns_to_keep).sum().reset_index()
@@ -63,10 +78,10 @@ class Factor:
 
     def multiply(self, factor2: "Factor", variable):
         """
-        Multiplies this factor with another provided factor, merging the two factors on a common variable
+        Multiplies this factor with another provided factor, merging the two factors on their common variables
         Args:
             factor2: factor to multiply this with
-            variable: variable to merge the two factors on
+            variable: variable to eliminate next, which is always one of the common variables
         """
         # Get both dataframes from the associated factors
         f1_df = self.get_data_frame()
@@ -79,9 +94,10 @@ class Factor:
         # Add a single "prob" column
         all_columns = all_columns + ["prob"]
 
-        # Merge both dataframes on the common variable. Where duplicates exists add _1 and _2 suffixes
-        # Only prob should have duplicates
-        new_df = pd.merge(f1_df, f2_df, on=variable, suffixes=("_1", "_2"))
+        # Merge both dataframes on all common variables, merging on variable alone would pair up rows that
+        # disagree on the other common variables. Only prob is in both, it gets _1 and _2 suffixes.
+        common = [col for col in f1_df.columns[:-1] if col in f2_df.columns[:-1]]
+        new_df = pd.merge(f1_df, f2_df, on=common, suffixes=("_1", "_2"))
 
         # Make a new column in the table with the probabilities of individual dataframes multiplied together
         new_df["prob"] = new_df["prob_1"] * new_df["prob_2"]
@@ -91,15 +107,54 @@ class Factor:
 
         self.dataframe = new_df
 
+    @staticmethod
+    def sum_product(factors, variable):
+        """
+        Multiplies factors together and sums a variable out of the product. The first factor is modified and
+        returned as the result.
+        Args:
+            factors: factors that all contain variable
+            variable: variable to sum out
+        """
+        result = factors[0]
+        for factor in factors[1:]:
+            result.multiply(factor, variable)
+        result.marginalize(variable)
+        return result
+
     def normalize(self):
         """
         Normalizes this factor such that the probability distribution adds to 1
         """
         self.dataframe["prob"] = self.dataframe["prob"] / (self.dataframe["prob"].sum())
 
+    def argmax(self, variable, assignment: dict):
+        """
+        Finds the state of a variable with the highest probability, given the states of the other variables
+        Args:
+            variable:   variable to find the maximising state for
+            assignment: dictionary {variable: state index} that contains at least all other variables in the factor
+
+        Returns: the index of the maximising state of variable
+        """
+        df = self.dataframe
+
+        # Keep only rows that are consistent with the values that were already decided
+        for var, value in assignment.items():
+            if var in df.columns:
+                df = df[df[var] == value]
+
+        # Find row with maximum probability
+        max_row = df.loc[df["prob"].idxmax()]
+        return int(max_row[variable])
+
     def get_data_frame(self):
         return self.dataframe
 
+    def num_entries(self):
+        """Returns the number of rows in the table of the factor"""
+        return len(self.dataframe)
+
     def get_vars(self):
         return self.dataframe.columns[:].tolist()
 
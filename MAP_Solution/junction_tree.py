@@ -0,0 +1,268 @@
+"""
+Junction tree (clique tree) compilation of a Bayesian network.
+
+The network is triangulated once with one of the greedy elimination heuristics, after which queries only pass
+messages between cliques. Evidence is entered as indicator factors in a single clique per variable, so messages
+that are not downstream of a changed evidence variable stay valid and are reused by the next query.
+
+"""
+from collections import deque
+
+import numpy as np
+
+from elim_order_heuristics import interaction_graph, eliminate_from_graph, greedy_order
+from numpy_factor import NumpyFactor
+from read_bayesnet import BayesNet
+
+# Calibration modes: sum-product for marginals and P(e), max-product for the most probable explanation
+SUM = "sum"
+MAX = "max"
+
+
+class JunctionTree:
+    """
+    Junction tree over numpy factors that supports sum-product and max-product calibration.
+    """
+
+    def __init__(self, network: BayesNet, elim_heuristic="min_fill"):
+        """
+        Compiles a network into a junction tree
+        Args:
+            network:        the network to compile
+            elim_heuristic: greedy heuristic used to triangulate the network, one of the keys of GREEDY_HEURISTICS
+        """
+        self.network = network
+        self.cliques = self.find_cliques(network, elim_heuristic)
+        self.neighbours = self.connect_cliques(self.cliques)
+
+        # Every CPT is multiplied into the first clique that contains its family
+        self.potentials = [NumpyFactor(clique, network.values, np.ones([len(network.values[var]) for var in clique]))
+                           for clique in self.cliques]
+        for variable in network.nodes:
+            family = set([variable] + network.parents[variable])
+            index = next(i for i, clique in enumerate(self.cliques) if family <= set(clique))
+            self.potentials[index].multiply(NumpyFactor.from_network(network, variable))
+
+        # Evidence on a variable is entered in the smallest clique that contains it
+        self.home = {}
+        for variable in network.nodes:
+            candidates = [i for i, clique in enumerate(self.cliques) if variable in clique]
+            self.home[variable] = min(candidates, key=lambda i: self.potentials[i].table.size)
+
+        # For every directed edge (i, j), the cliques on the side of i. A message from i to j only depends on these.
+        self.upstream = {}
+        for i in range(len(self.cliques)):
+            for j in self.neighbours[i]:
+                self.upstream[(i, j)] = self.reachable(i, j)
+
+        self.evidence = {}
+        self.messages = {}
+        self.evidence_potentials = {}
+
+        # Number of messages computed so far, useful to see how much work was reused
+        self.messages_computed = 0
+
+    @staticmethod
+    def find_cliques(network, elim_heuristic):
+        """
+        Triangulates the interaction graph and returns its maximal cliques, each as a list of variables
+        """
+        order, _ = greedy_order(network, [], {}, elim_heuristic)
+        graph = interaction_graph(network)
+        cliques = [eliminate_from_graph(graph, var) for var in order]
+
+        # Only keep cliques that are not contained in a larger one
+        maximal = []
+        for clique in sorted(cliques, key=len, reverse=True):
+            if not any(clique <= other for other in maximal):
+                maximal.append(clique)
+
+        position = {node: i for i, node in enumerate(network.nodes)}
+        return [sorted(clique, key=position.get) for clique in maximal]
+
+    @staticmethod
+    def connect_cliques(cliques):
+        """
+        Connects the cliques into a tree by a maximum spanning tree on the separator sizes, which gives the running
+        intersection property. Returns a list of neighbouring clique indices per clique.
+        """
+        edges = sorted(((len(set(a) & set(b)), i, j) for i, a in enumerate(cliques)
+                        for j, b in enumerate(cliques) if i < j), reverse=True)
+
+        # Kruskal with a union-find over the clique indices
+        root = list(range(len(cliques)))
+
+        def find(i):
+            while root[i] != i:
+                root[i] = root[root[i]]
+                i = root[i]
+            return i
+
+        neighbours = [[] for _ in cliques]
+        for _, i, j in edges:
+            if find(i) != find(j):
+                root[find(i)] = find(j)
+                neighbours[i].append(j)
+                neighbours[j].append(i)
+        return neighbours
+
+    def reachable(self, start, blocked):
+        """
+        Returns the cliques that can be reached from start without passing through the clique blocked
+        """
+        seen = {start}
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            for k in self.neighbours[i]:
+                if k != blocked and k not in seen:
+                    seen.add(k)
+                    queue.append(k)
+        return seen
+
+    def separator(self, i, j):
+        return [var for var in self.cliques[i] if var in self.cliques[j]]
+
+    def set_evidence(self, evidence: dict):
+        """
+        Replaces the evidence. Only messages that depend on a clique whose evidence changed are discarded.
+        Args:
+            evidence: dictionary of the observed variables {variable: value}
+        """
+        changed = {var for var in set(evidence) | set(self.evidence) if evidence.get(var) != self.evidence.get(var)}
+        changed_cliques = {self.home[var] for var in changed}
+
+        for i in changed_cliques:
+            self.evidence_potentials.pop(i, None)
+        for key in [key for key in self.messages if self.upstream[key[1:]] & changed_cliques]:
+            del self.messages[key]
+
+        self.evidence = dict(evidence)
+
+    def potential(self, i):
+        """
+        Returns the potential of a clique with the indicators of the evidence homed in it applied
+        """
+        if i not in self.evidence_potentials:
+            potential = self.potentials[i].copy()
+            for variable, value in self.evidence.items():
+                if self.home[variable] == i:
+                    axis = potential.variables.index(variable)
+                    mask = np.zeros(potential.table.shape[axis])
+                    mask[self.network.values[variable].index(value)] = 1
+                    shape = [1] * potential.table.ndim
+                    shape[axis] = -1
+                    potential.table = potential.table * mask.reshape(shape)
+            self.evidence_potentials[i] = potential
+        return self.evidence_potentials[i]
+
+    def message(self, mode, i, j):
+        """
+        Computes the message from clique i to clique j, assuming the messages into i from its other neighbours exist
+        """
+        factors = [self.potential(i)] + [self.messages[(mode, k, i)] for k in self.neighbours[i] if k != j]
+
+        # Eliminate the variables that are not passed on one at a time, without building the product over the clique
+        eliminate = NumpyFactor.sum_product if mode == SUM else NumpyFactor.max_product
+        separator = self.separator(i, j)
+        for var in [var for var in self.cliques[i] if var not in separator]:
+            to_combine = [factor for factor in factors if var in factor.variables]
+            factors = [factor for factor in factors if var not in factor.variables] + [eliminate(to_combine, var)]
+
+        message = factors[0].copy()
+        for factor in factors[1:]:
+            message.multiply(factor)
+
+        self.messages_computed += 1
+        return message
+
+    def calibrate(self, mode=SUM):
+        """
+        Makes sure all messages of the given mode exist, computing only the ones that are missing
+        Args:
+            mode: "sum" for sum-product or "max" for max-product calibration
+        """
+        # Order the cliques breadth first from the root, so children come after their parent
+        order = [0]
+        parent = {0: None}
+        for i in order:
+            for k in self.neighbours[i]:
+                if k not in parent:
+                    parent[k] = i
+                    order.append(k)
+
+        # Collect evidence towards the root, then distribute it back to the leaves
+        for i in reversed(order[1:]):
+            if (mode, i, parent[i]) not in self.messages:
+                self.messages[(mode, i, parent[i])] = self.message(mode, i, parent[i])
+        for i in order[1:]:
+            if (mode, parent[i], i) not in self.messages:
+                self.messages[(mode, parent[i], i)] = self.message(mode, parent[i], i)
+
+        return order, parent
+
+    def belief(self, mode, i):
+        """
+        Returns the calibrated belief of a clique, the product of its potential and all incoming messages
+        """
+        factor = self.potential(i).copy()
+        for k in self.neighbours[i]:
+            factor.multiply(self.messages[(mode, k, i)])
+        return factor
+
+    def evidence_probability(self):
+        """
+        Returns the probability of the evidence P(e)
+        """
+        self.calibrate(SUM)
+        return float(self.belief(SUM, 0).table.sum())
+
+    def marginals(self, variables=None):
+        """
+        Computes the posterior distribution of single variables given the evidence
+        Args:
+            variables: variables to compute the posterior for, defaults to all variables
+
+        Returns: dictionary {variable: {value: probability}}
+        """
+        self.calibrate(SUM)
+        variables = self.network.nodes if variables is None else variables
+
+        beliefs = {}
+        marginals = {}
+        for variable in variables:
+            i = self.home[variable]
+            if i not in beliefs:
+                beliefs[i] = self.belief(SUM, i)
+            factor = beliefs[i].copy()
+            for var in [var for var in factor.variables if var != variable]:
+                factor.marginalize(var)
+            factor.normalize()
+            marginals[variable] = dict(zip(self.network.values[variable], factor.table.tolist()))
+        return marginals
+
+    def mpe(self):
+        """
+        Finds the most probable explanation: the most probable assignment to all variables consistent with the
+        evidence.
+
+        Returns: the assignment {variable: value} and its joint probability P(assignment)
+        """
+        order, parent = self.calibrate(MAX)
+
+        codes = {}
+        probability = None
+        for i in order:
+            belief = self.belief(MAX, i)
+            index = tuple(codes[var] if var in codes else slice(None) for var in belief.variables)
+            table = belief.table[index]
+            if probability is None:
+                probability = float(table.max())
+
+            # Assign the variables of this clique that were not fixed by the cliques before it
+            free = [var for var in belief.variables if var not in codes]
+            for var, code in zip(free, np.unravel_index(int(np.argmax(table)), table.shape)):
+                codes[var] = int(code)
+
+        assignment = {var: self.network.values[var][code] for var, code in codes.items()}
+        return assignment, probability
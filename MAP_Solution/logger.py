@@ -1,19 +1,86 @@
+import atexit
 import logging
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
 
-# Setup logger
+# Setup logger. Importing this module only attaches the console handler, the verbose log file is opened by
+# enable_file_logging.
 log_formatter = logging.Formatter('\n%(message)s')
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-# Log to file
-file_handler = logging.FileHandler('MAP.log')
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(log_formatter)
-logger.addHandler(file_handler)
+logger.setLevel(logging.INFO)
 
 # Log to console
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(log_formatter)
 logger.addHandler(console_handler)
+
+# Handler and listener of the log file, and the logger level to restore, while file logging is enabled
+_queue_handler = None
+_listener = None
+_previous_level = None
+
+
+def enable_file_logging(filename='MAP.log', level=logging.DEBUG):
+    """
+    Starts writing log messages to a file. The file is written by a background thread, the logging call only puts
+    the record on a queue.
+    Args:
+        filename: file to log to
+        level:    lowest level that is written to the file
+
+    Returns: the path of the log file
+    """
+    global _queue_handler, _listener, _previous_level
+    disable_file_logging()
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setLevel(level)
+    file_handler.setFormatter(log_formatter)
+
+    # QueueHandler formats the message before queueing it, so factors are rendered as they are at the time of the
+    # logging call, even though they are modified afterwards
+    _queue_handler = QueueHandler(queue.SimpleQueue())
+    _listener = QueueListener(_queue_handler.queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(_queue_handler)
+    _previous_level = logger.level
+    logger.setLevel(min(level, logger.level))
+    return file_handler.baseFilename
+
+
+def disable_file_logging():
+    """
+    Stops file logging, after writing out the messages that are still queued, and restores the level the logger
+    had before it was enabled
+    """
+    global _queue_handler, _listener, _previous_level
+    if _listener is None:
+        return
+    logger.removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _queue_handler = None
+    _listener = None
+    logger.setLevel(_previous_level)
+    _previous_level = None
+
+
+atexit.register(disable_file_logging)
+
+
+class LazyTable:
+    """
+    Renders a factor as a table only when a log message containing it is formatted, which does not happen when
+    the level of the message is disabled. Use it as a %-style argument: logger.debug("%s", LazyTable(factor)).
+    """
+
+    __slots__ = ("factor",)
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __str__(self):
+        return '\t' + self.factor.get_data_frame().to_string().replace('\n', '\n\t')
@@ -5,22 +5,68 @@ Class for the implementation of the variable elimination algorithm.
 
 """
 from factor import Factor
+from numpy_factor import NumpyFactor, LogNumpyFactor, BATCH
+from sparse_factor import SparseFactor, AdaptiveFactor
+import numpy as np
 from read_bayesnet import BayesNet
-from logger import logger
+from logger import logger, LazyTable
+import logging
 from elim_order_heuristics import *
+from elim_order_cache import ElimOrderCache
+from network_pruning import PruneCache
+from network_index import FactorPool
+from junction_tree import JunctionTree
+from memory_budget import MemoryBudget
+from collections import namedtuple
+import heapq
+
+# Factor representations that can be selected in MAP.run
+FACTOR_BACKENDS = {
+    "pandas": Factor,
+    "numpy": NumpyFactor,
+    "numpy_log": LogNumpyFactor,
+    "sparse": SparseFactor,
+    "auto": AdaptiveFactor,
+}
+
+# Result of MAP.infer. probability is P(assignment, evidence), evidence_probability is P(evidence) and posteriors is
+# a dictionary {variable: {value: P(variable = value | evidence)}}, or None if no posteriors were asked for.
+InferenceResult = namedtuple("InferenceResult", ["assignment", "probability", "evidence_probability", "posteriors"])
 
 
 class MAP():
 
-    def __init__(self, network):
+    # Elimination orders shared by all MAP instances, see elim_order_cache.py
+    order_cache = ElimOrderCache()
+
+    # Pruned networks shared by all MAP instances, see network_pruning.py
+    prune_cache = PruneCache()
+
+    def __init__(self, network, order_cache=None):
         """
         Initialize the variable elimination algorithm with the specified network.
         Add more initializations if necessary.
 
+        Input:
+            network:     The network to run queries on
+            order_cache: Cache for elimination orders, defaults to the cache shared by all MAP instances
+
         """
         self.network = network
+        if order_cache is not None:
+            self.order_cache = order_cache
 
-    def run(self, map_vars:list, observed: dict, elim_heuristic=None):
+        # Size of the largest clique predicted for the most recently computed elimination order
+        self.max_clique_size = None
+
+        # PruneResult of the most recent query, None if it was run without pruning
+        self.pruning = None
+
+        # Junction tree for posteriors of non-map variables in infer, built on first use
+        self.junction_tree = None
+
+    def run(self, map_vars:list, observed: dict, elim_heuristic=None, factor_backend="pandas", prune=True,
+            profile=None, memory_budget=None):
         """
         Use the variable elimination algorithm to find out the probability
         distribution of the query variable given the observed variables
@@ -31,95 +77,457 @@ class MAP():
             elim_heuristic: String to specify which elimination order heuristic to use.
                             That that the tests in test_map.py pass none so you should implement a default elim order
                             heuristic if none is provided.
+            factor_backend: Name of the factor representation to use, one of the keys of FACTOR_BACKENDS.
+            prune:          Remove barren and d-separated nodes before elimination, see network_pruning.py
+            profile:        A profiling.Profiler that records the time and factor sizes of every step, or None
+            memory_budget:  A memory_budget.MemoryBudget, or the size in bytes of the largest table to keep in
+                            memory. Larger intermediate factors are spilled to scratch files, which are deleted when
+                            the query is finished. Only the "numpy" and "numpy_log" backends support a budget.
 
         Output: A dictionary representing the most probable assignment to the map variables {variable: value}
 
         """
+        if memory_budget is not None:
+            if factor_backend not in ("numpy", "numpy_log"):
+                raise ValueError(f"Factor backend {factor_backend} does not support a memory budget")
+            if not isinstance(memory_budget, MemoryBudget):
+                memory_budget = MemoryBudget(memory_budget)
+        if profile is not None:
+            profile.begin_run(map_vars, observed, factor_backend)
+
+        try:
+            # Order only the variables that are left after pruning
+            nodes = self.prune(map_vars, observed, prune)
+            elim_order = self.get_map_elim_order(map_vars, observed, elim_heuristic, nodes)
+
+            logger.info("Elimination Order: " + str(elim_order))
+            logger.info("Predicted Max Clique Size: " + str(self.max_clique_size))
+            logger.info("MAP Variables: "+ str(map_vars))
+            logger.info("Observed Variables: " + str(observed))
+
+            assert isinstance(self.network, BayesNet)
+
+            # Convert cpts to factors
+            factor_class = FACTOR_BACKENDS[factor_backend]
+            nodes = self.network.nodes if nodes is None else nodes
+            factors = self.get_factors_from_cpts(factor_backend, nodes)
+
+            logger.debug("Original Factors: ")
+            self.log_factors(factors)
 
-        elim_order = self.get_map_elim_order(map_vars, observed, elim_heuristic)
+            # Clamp evidence in the factors. Factors work on state indices, only the result is converted back to
+            # values.
+            factor_of = dict(zip(nodes, factors))
+            for variable, value in self.network.encode(observed).items():
+                affected = self.factors_containing(variable, factor_of)
+                if profile is not None:
+                    step = profile.begin_step(variable, "reduce", affected)
+                for factor in affected:
+                    if memory_budget is not None:
+                        memory_budget.reduce(factor, variable, value)
+                    else:
+                        factor.reduce(variable, value)
+                if profile is not None:
+                    profile.lap(step, "reduce")
+                    profile.end_step(step, affected)
+
+            # If factor is trivial after reduction, leave it out. The pool finds the factors of a variable without
+            # scanning all of them.
+            factors = FactorPool(factor for factor in factors if factor.get_vars() != ["prob"])
+
+            logger.debug("Factors with evidence applied: ")
+            self.log_factors(factors)
 
-        logger.info("Elimination Order: " + str(elim_order))
-        logger.info("MAP Variables: "+ str(map_vars))
-        logger.info("Observed Variables: " + str(observed))
+            backtrack_factors = []
 
-        assert isinstance(self.network, BayesNet)
+            # Use provided elimination order
+            for var_to_eliminate in elim_order:
 
-        # Convert cpts to factors
-        factors = self.get_factors_from_cpts()
+                logger.debug("Eliminate variable: " + var_to_eliminate)
 
-        logger.debug("Original Factors: ")
-        self.log_factors(factors)
+                # Collect all factors to be multiplied, this takes them out of the pool
+                to_multiply = factors.pop(var_to_eliminate)
+                logger.debug("Factors to multiply containing variable: " + var_to_eliminate)
+                self.log_factors(to_multiply)
 
-        # Clamp evidence in the factors
-        to_delete = []
-        for variable, value in observed.items():
-            for factor in factors:
-                if variable in factor.get_vars():
-                    factor.reduce(variable, value)
-                    # Check if factor is trivial
-                    if factor.get_data_frame().columns[:].tolist() == ["prob"]:
-                        to_delete.append(factor)
+                if profile is not None:
+                    step = profile.begin_step(var_to_eliminate, "max" if var_to_eliminate in map_vars else "sum",
+                                              to_multiply)
 
-        # If factor is trivial after reduction, delete it from list
-        for factor in to_delete:
-            factors.remove(factor)
+                # If non-map variable then marginalize out. Multiplying and summing is one step, so backends that
+                # can sum out a variable without materialising the product do so.
+                if var_to_eliminate not in map_vars:
+                    if memory_budget is not None:
+                        result = memory_budget.sum_product(to_multiply, var_to_eliminate)
+                    else:
+                        result = factor_class.sum_product(to_multiply, var_to_eliminate)
+                    if profile is not None:
+                        profile.lap(step, "sum")
+                    logger.debug("Sum out " + var_to_eliminate + " of the product")
+                    self.log_factor(result)
 
-        logger.debug("Factors with evidence applied: ")
-        self.log_factors(factors)
+                # Otherwise this is a map variable to be maximised out
+                else:
+                    # Multiply together
+                    if memory_budget is not None:
+                        result = memory_budget.product(to_multiply)
+                    else:
+                        result = to_multiply[0]
+                        for factor in to_multiply[1:]:
+                            result.multiply(factor, var_to_eliminate)
+                    if profile is not None:
+                        profile.lap(step, "multiply")
+                    logger.debug("Result of multiplication: ")
+                    self.log_factor(result)
 
-        backtrack_factors = []
+                    # Store this factor in a stack for use in backtracking to find map instantiation later
+                    logger.debug(f"Storing factor for backtracking to find value of {var_to_eliminate}")
+                    self.log_factor(result)
+                    if memory_budget is not None and len(result.get_vars()) - 1 >= 2:
+                        # The budget maximises into a new factor, so a spilled product is kept without copying it
+                        backtrack_factors.append(result)
+                        result = memory_budget.maximize(result, var_to_eliminate)
+                        if profile is not None:
+                            profile.lap(step, "max")
+                    else:
+                        backtrack_factors.append(result.copy())
+                        if profile is not None:
+                            profile.lap(step, "copy")
+
+                    # Only maximise if there are at least two variables in the factor because otherwise
+                    # the factor is empty
+                    if memory_budget is None and (len(result.get_vars()) -1 >= 2):
+                        result.maximize(var_to_eliminate)
+                        if profile is not None:
+                            profile.lap(step, "max")
+                        logger.debug("Maximise out " + var_to_eliminate)
+                        self.log_factor(result)
+
+                if profile is not None:
+                    profile.end_step(step, result)
+
+                # Replace the used factors with the new one
+                factors.add(result)
+                logger.debug("New List of Factors: ")
+                self.log_factors(factors)
+
+            logger.debug("Finished marginalizing/maximising variables. "
+                         "Start backtracking to find variable instantiations.")
+            map_assignment = self.network.decode(self.get_map_instantiation(backtrack_factors))
+        finally:
+            # Also delete the scratch files and stop tracemalloc when the query fails
+            if memory_budget is not None:
+                memory_budget.close()
+            if profile is not None:
+                profile.end_run()
+        return map_assignment
+
+    def run_batch(self, map_vars: list, evidence_list: list, elim_heuristic=None, prune=True):
+        """
+        Answers many MAP queries that share the same map variables and observed variables, but differ in the
+        observed values. All queries are evaluated together on numpy factors that carry a leading batch axis.
+
+        Input:
+            map_vars:       The map variables to be queried
+            evidence_list:  A list of dictionaries {variable: value}, one per query, all with the same variables
+            elim_heuristic: String to specify which elimination order heuristic to use.
+            prune:          Remove barren and d-separated nodes before elimination, see network_pruning.py
+
+        Output: A list with for every query a dictionary representing the most probable assignment to the map
+                variables {variable: value}
+
+        """
+        if len(evidence_list) == 0:
+            return []
+
+        observed_vars = list(evidence_list[0].keys())
+        if any(evidence.keys() != evidence_list[0].keys() for evidence in evidence_list):
+            raise ValueError("All queries in a batch must observe the same variables")
+
+        batch_size = len(evidence_list)
+        nodes = self.prune(map_vars, observed_vars, prune)
+        elim_order = self.get_map_elim_order(map_vars, evidence_list[0], elim_heuristic, nodes)
+
+        logger.info("Batch Size: " + str(batch_size))
+        logger.info("Elimination Order: " + str(elim_order))
+        logger.info("Predicted Max Clique Size: " + str(self.max_clique_size))
+        logger.info("MAP Variables: " + str(map_vars))
+        logger.info("Observed Variables: " + str(observed_vars))
+
+        nodes = self.network.nodes if nodes is None else nodes
+        factors = self.get_factors_from_cpts("numpy", nodes)
+
+        # Clamp the evidence of every query, this replaces each evidence variable by the batch axis
+        factor_of = dict(zip(nodes, factors))
+        for variable in observed_vars:
+            index = {value: i for i, value in enumerate(self.network.values[variable])}
+            codes = np.asarray([index[evidence[variable]] for evidence in evidence_list], dtype=np.intp)
+            for factor in self.factors_containing(variable, factor_of):
+                factor.reduce_batch(variable, codes)
 
-        # Use provided elimination order
+        # Factors that only depend on the batch scale all assignments of a query equally, so they can be dropped
+        factors = FactorPool(factor for factor in factors if any(var != BATCH for var in factor.variables))
+
+        backtrack_factors = []
         for var_to_eliminate in elim_order:
+            to_multiply = factors.pop(var_to_eliminate)
+
+            if var_to_eliminate not in map_vars:
+                result = NumpyFactor.sum_product(to_multiply, var_to_eliminate)
+            else:
+                result = to_multiply[0]
+                for factor in to_multiply[1:]:
+                    result.multiply(factor)
+                backtrack_factors.append(result.copy())
+                result.maximize(var_to_eliminate)
+
+            factors.add(result)
+
+        # Backtrack through the stored factors for all queries at once
+        assignment = {}
+        while len(backtrack_factors) > 0:
+            factor = backtrack_factors.pop()
+            var_to_assign = [v for v in factor.variables if v != BATCH and v not in assignment][0]
+            assignment[var_to_assign] = factor.argmax_batch(var_to_assign, assignment, batch_size)
+
+        return [self.network.decode({var: codes[i] for var, codes in assignment.items()}) for i in range(batch_size)]
+
+    def infer(self, map_vars: list, observed: dict, elim_heuristic=None, posteriors=None):
+        """
+        Answers a MAP query together with P(evidence) and posterior marginals, on numpy factors.
+
+        The non-map variables are summed out once. The factors that are left only contain map variables and are
+        shared: maximising over them gives the MAP assignment and its probability, summing over them gives P(e)
+        and the posteriors of the map variables. Only barren nodes are pruned, since the factors of d-separated
+        nodes contribute to P(e).
+
+        Input:
+            map_vars:       The map variables to be queried
+            observed:       A dictionary of the observed variables {variable: value}
+            elim_heuristic: String to specify which elimination order heuristic to use.
+            posteriors:     None for no posteriors, True for the posteriors of the map variables, "all" for all
+                            unobserved variables or a list of variables. Posteriors of non-map variables come from a
+                            junction tree over the same network, which is kept for later queries. Posteriors are
+                            undefined if the evidence is impossible, asking for them then raises a ValueError.
+
+        Output: An InferenceResult
+
+        """
+        shared, map_order, constant = self.sum_out_non_map(map_vars, observed, elim_heuristic)
+        codes, probability = self.maximize_map_factors(shared, map_order)
+        assignment = self.network.decode(codes)
+        probability *= constant
+
+        # Sum phase on the same shared factors
+        evidence_probability = constant * self.sum_out(shared, map_order)
+
+        result_posteriors = None
+        if posteriors:
+            if evidence_probability == 0:
+                raise ValueError(f"Evidence {observed} has probability zero, posteriors are undefined")
+            if posteriors is True:
+                variables = list(map_vars)
+            elif posteriors == "all":
+                variables = [var for var in self.network.nodes if var not in observed]
+            else:
+                variables = list(posteriors)
+
+            result_posteriors = {}
+            for var in variables:
+                if var in map_vars:
+                    marginal = self.sum_out(shared, [other for other in map_order if other != var], keep=var)
+                    result_posteriors[var] = dict(zip(self.network.values[var], (marginal / marginal.sum()).tolist()))
+
+            others = [var for var in variables if var not in map_vars]
+            if others:
+                if self.junction_tree is None:
+                    self.junction_tree = JunctionTree(self.network)
+                self.junction_tree.set_evidence(observed)
+                result_posteriors.update(self.junction_tree.marginals(others))
+            result_posteriors = {var: result_posteriors[var] for var in variables}
+
+        return InferenceResult(assignment, probability, evidence_probability, result_posteriors)
+
+    def run_top_k(self, map_vars: list, observed: dict, k: int, elim_heuristic=None):
+        """
+        Finds the k most probable assignments to the map variables, by Lawler-Nilsson partitioning.
+
+        The non-map variables are summed out once, as in infer. The best assignment of the factors that are left
+        is found by max-product elimination. After an assignment is reported, the part of the search space it came
+        from is split into disjoint parts that each exclude it: part i keeps the values of the first i map
+        variables and forbids the value of the next one. The best assignment of every part is found by another
+        max-product elimination over the small factors of the map variables, with indicator factors for the
+        constraints, and the parts are kept in a priority queue. Every reported assignment therefore costs at most
+        one elimination per map variable, instead of a complete MAP.run.
+
+        Input:
+            map_vars:       The map variables to be queried
+            observed:       A dictionary of the observed variables {variable: value}
+            k:              Number of assignments to return
+            elim_heuristic: String to specify which elimination order heuristic to use.
+
+        Output: A list of at most k (assignment, P(assignment, evidence)) pairs, most probable first. Assignments
+                with probability zero are left out.
+
+        """
+        shared, map_order, constant = self.sum_out_non_map(map_vars, observed, elim_heuristic)
+        if constant == 0:
+            return []
+
+        # Priority queue of parts of the search space, as (-probability, tie breaker, assignment, allowed states)
+        allowed = {var: np.ones(len(self.network.values[var]), dtype=bool) for var in map_order}
+        codes, probability = self.maximize_map_factors(shared, map_order)
+        queue = [(-probability, 0, codes, allowed)]
+        counter = 1
+
+        results = []
+        while queue and len(results) < k:
+            negative_probability, _, codes, allowed = heapq.heappop(queue)
+            if negative_probability == 0:
+                break
+            results.append((self.network.decode(codes), -negative_probability * constant))
+
+            for i, var in enumerate(map_order):
+                part = dict(allowed)
+                for fixed in map_order[:i]:
+                    part[fixed] = np.zeros_like(allowed[fixed])
+                    part[fixed][codes[fixed]] = True
+                part[var] = allowed[var].copy()
+                part[var][codes[var]] = False
+                if not part[var].any():
+                    continue
+
+                part_codes, part_probability = self.maximize_map_factors(shared, map_order, part)
+                if part_probability > 0:
+                    heapq.heappush(queue, (-part_probability, counter, part_codes, part))
+                    counter += 1
+
+        return results
+
+    def sum_out_non_map(self, map_vars, observed, elim_heuristic=None):
+        """
+        Applies the evidence and sums out all non-map variables on numpy factors. Only barren nodes are pruned,
+        since they sum to one; the factors of d-separated nodes are kept so that the constant is exact.
+
+        Input:
+            map_vars:       The map variables to be queried
+            observed:       A dictionary of the observed variables {variable: value}
+            elim_heuristic: String to specify which elimination order heuristic to use.
 
-            logger.debug("Eliminate variable: " + var_to_eliminate)
+        Output: the remaining factors, which only contain map variables, the order in which to eliminate the map
+                variables and the product of all factors without variables
 
-            # Collect all factors to be multiplied
-            to_multiply = [factor for factor in factors if any(var == var_to_eliminate for var in factor.get_vars())]
-            logger.debug("Factors to multiply containing variable: " + var_to_eliminate)
-            self.log_factors(to_multiply)
+        """
+        index = self.network.index
+        ancestral = index.ancestors([index.ids[var] for var in list(map_vars) + list(observed)])
+        nodes = [index.names[i] for i in np.flatnonzero(ancestral)]
+        elim_order = self.get_map_elim_order(map_vars, observed, elim_heuristic, nodes)
+
+        factors = self.get_factors_from_cpts("numpy", nodes)
+        factor_of = dict(zip(nodes, factors))
+        for variable, value in self.network.encode(observed).items():
+            for factor in self.factors_containing(variable, factor_of):
+                factor.reduce(variable, value)
+
+        # Collect everything that no longer depends on a variable in constant
+        constant = 1.0
+        pool = FactorPool()
+        for factor in factors:
+            if factor.variables:
+                pool.add(factor)
+            else:
+                constant *= float(factor.table)
+        for var in elim_order:
+            if var not in map_vars:
+                result = NumpyFactor.sum_product(pool.pop(var), var)
+                if result.variables:
+                    pool.add(result)
+                else:
+                    constant *= float(result.table)
+
+        return list(pool), [var for var in elim_order if var in map_vars], constant
+
+    def maximize_map_factors(self, factors, map_order, allowed=None):
+        """
+        Finds the most probable assignment of numpy factors that only contain map variables, which are not
+        modified
 
-            # Multiply together
+        Input:
+            factors:   The factors
+            map_order: The map variables in the order in which to maximise them out
+            allowed:   A dictionary {variable: boolean array over its states}, states that are False are excluded
+
+        Output: a dictionary {variable: state index} and the product of the factors for that assignment
+
+        """
+        pool = FactorPool(factor.copy() for factor in factors)
+        if allowed is not None:
+            for var, mask in allowed.items():
+                pool.add(NumpyFactor([var], self.network.values, mask.astype(np.float64)))
+
+        # Keep the product of every step for backtracking
+        backtrack_factors = []
+        probability = 1.0
+        for var in map_order:
+            to_multiply = pool.pop(var)
             result = to_multiply[0]
             for factor in to_multiply[1:]:
-                result.multiply(factor, var_to_eliminate)
-            logger.debug("Result of multiplication: ")
-            self.log_factor(result)
+                result.multiply(factor)
+            backtrack_factors.append(result.copy())
+            result.maximize(var)
+            if result.variables:
+                pool.add(result)
+            else:
+                probability *= float(result.table)
+        return self.get_map_instantiation(backtrack_factors), probability
 
-            # If non-map variable then marginalize out
-            if var_to_eliminate not in map_vars:
-                # Marginalize out the variable to be eliminated
-                result.marginalize(var_to_eliminate)
-                logger.debug("Sum out " + var_to_eliminate)
-                self.log_factor(result)
+    @staticmethod
+    def sum_out(factors, order, keep=None):
+        """
+        Sums variables out of the product of numpy factors, which are not modified
 
-            # Otherwise this is a map variable to be maximised out
-            else:
-                # Store this factor in a stack for use in backtracking to find map instantiation later
-                logger.debug(f"Storing factor for backtracking to find value of {var_to_eliminate}")
-                self.log_factor(result)
-                backtrack_factors.append(result.copy())
+        Input:
+            factors: The factors
+            order:   The variables to sum out, in this order
+            keep:    A variable that is not summed out, or None
 
-                # Only maximise if there are at least two variables in the factor because otherwise
-                # the factor is empty
-                if (len(result.dataframe.columns) -1 >= 2):
-                    result.maximize(var_to_eliminate)
-                    logger.debug("Maximise out " + var_to_eliminate)
-                    self.log_factor(result)
+        Output: The sum as a float, or if keep is given an array over the states of keep
 
-            # Remove used factors and replace with new one in list of factors
-            for factor in to_multiply:
-                factors.remove(factor)
-            factors.append(result)
-            logger.debug("New List of Factors: ")
-            self.log_factors(factors)
+        """
+        pool = FactorPool(factors)
+        for var in order:
+            pool.add(NumpyFactor.sum_product(pool.pop(var), var))
 
-        logger.debug("Finished marginalizing/maximising variables. Start backtracking to find variable instantiations.")
-        map_assignment = self.get_map_instantiation(backtrack_factors)
+        value = 1.0
+        for factor in pool:
+            value = value * (factor.aligned([keep]).reshape(-1) if keep is not None else float(factor.table))
+        return value
 
-        return map_assignment
+    def prune(self, map_vars, observed, prune=True):
+        """
+        Looks up which CPTs are needed for a query and stores the PruneResult in self.pruning
+
+        Input:
+            map_vars: The map variables to be queried
+            observed: The observed variables, only the names are used
+            prune:    If False, nothing is pruned
+
+        Output: list of the nodes whose CPTs are needed, or None if all of them are
+
+        """
+        if not prune:
+            self.pruning = None
+            return None
+
+        self.pruning = self.prune_cache.prune(self.network, map_vars, observed)
+        logger.info(f"Pruned Factors: {self.pruning.factors_pruned} of {len(self.network.nodes)}, "
+                    f"Pruned Entries: {self.pruning.entries_pruned}")
+        return self.pruning.nodes
 
     def get_map_instantiation(self, backtrack_factors):
+        """
+        Backtracks through the factors stored while maximising, returning a dictionary {variable: state index}
+        """
         map_assignment = {}
         while len(backtrack_factors) > 0:
             # Pop the latest factor and find its maximising instantiation
@@ -127,23 +535,14 @@ class MAP():
             logger.debug("Popped this factor from the backtracking stack:")
             self.log_factor(factor)
 
-            df = factor.dataframe
-            vars_in_factor = df.columns[:-1].tolist()
+            vars_in_factor = factor.get_vars()[:-1]
 
             var_to_assign = [v for v in vars_in_factor if v not in map_assignment][0]
             logger.debug(f"Finding MAP instantiation for {var_to_assign}")
 
-            # Check consistency of row with previously assigned values
-            for var, value in map_assignment.items():
-                if var in df.columns:
-                    # keep only rows where this variable has the value we already decided
-                    df = df[df[var]==value]
-
-            # Find row with maixmum probability
-            max_row = df.loc[df["prob"].idxmax()]
-
-            map_assignment[var_to_assign] = max_row[var_to_assign]
-            logger.debug(f"MAP assignment for variable {var_to_assign} is {max_row[var_to_assign]}")
+            # Find maximising value that is consistent with previously assigned values
+            map_assignment[var_to_assign] = factor.argmax(var_to_assign, map_assignment)
+            logger.debug(f"MAP assignment for variable {var_to_assign} is {map_assignment[var_to_assign]}")
 
         logger.debug("Final Map Instantiation:")
 
@@ -151,8 +550,40 @@ class MAP():
             logger.debug(f"{key}->{value}")
         return map_assignment
 
-    def get_map_elim_order(self, map_vars, observed, elim_order):
+    def get_map_elim_order(self, map_vars, observed, elim_order, nodes=None):
+        """
+        Computes an elimination order in which all non-map variables come before the map variables and
+        stores the predicted size of the largest clique in self.max_clique_size
+
+        Input:
+            map_vars:   The map variables to be queried
+            observed:   A dictionary of the observed variables {variable: value}
+            elim_order: Name of the heuristic, "min_parents", "min_factors" or one of the keys of
+                        GREEDY_HEURISTICS. Defaults to min_factors.
+            nodes:      The nodes whose CPTs are used, e.g. after pruning, or None for all nodes. Only the
+                        variables in their CPTs are ordered, and the clique size is predicted for that subnetwork.
 
+        Output: list of variables in the order in which they should be eliminated
+
+        """
+        # The order only depends on which variables are observed, so it can be reused for other evidence values
+        cached = self.order_cache.get(self.network, elim_order, map_vars, observed, nodes)
+        if cached is not None:
+            order, self.max_clique_size = cached
+            return order
+
+        order = self.compute_map_elim_order(map_vars, observed, elim_order, nodes)
+        self.order_cache.put(self.network, elim_order, map_vars, observed, order, self.max_clique_size, nodes)
+        return order
+
+    def compute_map_elim_order(self, map_vars, observed, elim_order, nodes=None):
+        """
+        Computes the elimination order of get_map_elim_order without looking at the cache
+        """
+        # Greedy heuristics already respect the MAP constraint on the interaction graph
+        if elim_order in GREEDY_HEURISTICS:
+            elim_order, self.max_clique_size = greedy_order(self.network, map_vars, observed, elim_order, nodes)
+            return elim_order
 
         if elim_order == "min_parents":
             order = min_parents(self.network)
@@ -167,26 +598,46 @@ class MAP():
         # remove evidence vars
         for var in observed.keys():
             non_map_vars.remove(var)
+        # only order the variables of the CPTs that are used
+        if nodes is not None:
+            used = interaction_graph(self.network, observed, nodes)
+            non_map_vars = [var for var in non_map_vars if var in used]
 
         non_map_var_order = [var for var in order if var in non_map_vars]
         map_var_order = [var for var in order if var in map_vars]
         elim_order = non_map_var_order + map_var_order
+        self.max_clique_size = induced_clique_size(self.network, elim_order, observed, nodes)
         return elim_order
 
-    # Logging functions
+    # Logging functions. Tables are only rendered if the message is actually logged.
     def log_factors(self, factors):
-        for factor in factors:
-            logger.debug('\t' + factor.get_data_frame().to_string().replace('\n', '\n\t'))
+        if logger.isEnabledFor(logging.DEBUG):
+            for factor in factors:
+                logger.debug('%s', LazyTable(factor))
 
     def log_factor(self, factor, info=False):
-        if info:
-            logger.info('\t' + factor.get_data_frame().to_string().replace('\n', '\n\t'))
-        else:
-            logger.debug('\t' + factor.get_data_frame().to_string().replace('\n', '\n\t'))
+        logger.log(logging.INFO if info else logging.DEBUG, '%s', LazyTable(factor))
+
+    def factors_containing(self, variable, factor_of):
+        """
+        Looks up the factors that contain a variable in the variable-to-factor index of the network, instead of
+        scanning all factors
+
+        Input:
+            variable:  The variable to look up
+            factor_of: A dictionary {node: factor built from its CPT}, before any variable was eliminated
+
+        Output: list of the factors that contain the variable
+
+        """
+        index = self.network.index
+        return [factor_of[index.names[i]] for i in index.factors(index.ids[variable]).tolist()
+                if index.names[i] in factor_of]
 
-    def get_factors_from_cpts(self):
+    def get_factors_from_cpts(self, factor_backend="pandas", nodes=None):
+        factor_class = FACTOR_BACKENDS[factor_backend]
         factors = []
-        for name, cpt in self.network.probabilities.items():
-            factors.append(Factor(cpt))
+        for name in (self.network.probabilities if nodes is None else nodes):
+            factors.append(factor_class.from_network(self.network, name))
 
         return factors
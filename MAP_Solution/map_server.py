@@ -0,0 +1,417 @@
+"""
+Asyncio HTTP server that answers MAP queries, coalescing concurrent queries into batches.
+
+Queries with the same shape, i.e. the same network, map variables and observed variables, only differ in the
+observed values, which is exactly what MAP.run_batch evaluates in one vectorized pass. The server keeps a pending
+batch per shape: the first query of a shape opens it, queries of the same shape that arrive within batch_window
+seconds join it, and the batch is sent to a worker pool when the window ends or when it holds max_batch_size
+queries. The event loop itself never runs inference, so it keeps accepting requests while the workers compute.
+
+Workers are processes by default. The networks are published once in shared memory and the workers attach to them,
+see shared_network.py.
+
+Endpoints, all answering JSON:
+    POST /map    body {"network": "alarm", "map_vars": [...], "evidence": {...}}, answers {"result": {...}}
+    GET  /stats  query and batch counts and latency percentiles in seconds
+    GET  /health answers {"status": "ok"}
+
+Usage:
+    python map_server.py serve data/queries.json --port 8080
+    python map_server.py client data/queries.json --port 8080 --repeat 100
+
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from compiled_network import load_network
+from logger import logger
+from map import MAP
+from read_bayesnet import BayesNet
+from shared_network import SharedNetworkStore, attach
+
+# Per-process state of a worker, set up by init_worker
+_networks = {}
+
+# Reason phrases of the status codes the server sends
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def init_worker(handles):
+    """
+    Initializes a worker process
+    Args:
+        handles: dictionary {network name: shared_network.SharedNetwork} of the networks to attach to
+    """
+    for name, handle in handles.items():
+        _networks[name] = attach(handle)
+
+    # Every batch would otherwise log its elimination order to the console
+    logger.setLevel(logging.WARNING)
+
+
+def answer_batch(name, map_vars, evidence_list):
+    """
+    Answers a batch of queries of one shape in a worker. If the batch fails, e.g. because one query observes a
+    value that does not exist, the queries are answered one by one so only the faulty ones fail.
+    Args:
+        name:          name of the network
+        map_vars:      the map variables of all queries
+        evidence_list: list of dictionaries {variable: value}, all with the same variables
+
+    Returns: a list with per query a ("result", assignment) or ("error", message) pair
+    """
+    network = _networks[name]
+    try:
+        return [("result", result) for result in MAP(network).run_batch(map_vars, evidence_list)]
+    except Exception:
+        answers = []
+        for evidence in evidence_list:
+            try:
+                answers.append(("result", MAP(network).run(map_vars, evidence, factor_backend="numpy")))
+            except Exception as e:
+                answers.append(("error", f"{type(e).__name__}: {e}"))
+        return answers
+
+
+class LatencyStats:
+    """
+    Latencies of the most recent queries and sizes of the most recent batches.
+    """
+
+    def __init__(self, window=10000):
+        """
+        Args:
+            window: number of recent queries and batches to keep
+        """
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.queries = 0
+        self.errors = 0
+        self.batches = 0
+
+    def record_query(self, seconds, error=False):
+        self.latencies.append(seconds)
+        self.queries += 1
+        self.errors += error
+
+    def record_batch(self, size):
+        self.batch_sizes.append(size)
+        self.batches += 1
+
+    def summary(self):
+        """
+        Returns a dictionary with the query and batch counts, the mean batch size and the 50th, 90th, 99th
+        percentile and maximum latency of the recent queries
+        """
+        summary = {"queries": self.queries, "errors": self.errors, "batches": self.batches,
+                   "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None}
+        latencies = np.asarray(self.latencies)
+        for name, percentile in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100)):
+            summary[name] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return summary
+
+
+class MAPServer:
+    """
+    Accepts MAP queries over HTTP and answers them in batches on a worker pool.
+    """
+
+    def __init__(self, networks: dict, workers=None, use_processes=True, batch_window=0.002, max_batch_size=64):
+        """
+        Args:
+            networks:       dictionary {name: BayesNet} of the networks to serve
+            workers:        number of workers in the pool, the executor default if None
+            use_processes:  run inference in worker processes that share the networks, otherwise in threads
+            batch_window:   seconds a batch waits for more queries of its shape after the first one arrived
+            max_batch_size: number of queries at which a batch is sent without waiting for the window to end
+        """
+        self.networks = networks
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.stats = LatencyStats()
+
+        # Pending batch per query shape, as a list of (evidence, future) pairs
+        self.pending = {}
+
+        self.store = SharedNetworkStore()
+        if use_processes:
+            handles = {name: self.store.publish(name, network) for name, network in networks.items()}
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(handles,))
+        else:
+            _networks.update(networks)
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        """
+        Starts listening on a TCP port, or on a Unix socket if path is given
+        Args:
+            host: interface to listen on
+            port: port to listen on, 0 picks a free port
+            path: path of a Unix socket to listen on instead of a TCP port
+
+        Returns: the port that is listened on, or path for a Unix socket
+        """
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=path)
+            return path
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stops accepting connections and shuts down the worker pool
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown()
+        self.store.close()
+
+    async def query(self, network, map_vars, evidence):
+        """
+        Answers a MAP query, as part of a batch with the concurrent queries of the same shape
+
+        Returns: a dictionary representing the most probable assignment to the map variables {variable: value}
+        """
+        if network not in self.networks:
+            raise KeyError(f"Unknown network {network}")
+        shape = (network, tuple(map_vars), tuple(sorted(evidence)))
+        future = asyncio.get_running_loop().create_future()
+
+        batch = self.pending.get(shape)
+        if batch is None:
+            batch = self.pending[shape] = []
+            asyncio.get_running_loop().call_later(self.batch_window, self.flush, shape, batch)
+        batch.append(({var: evidence[var] for var in shape[2]}, future))
+        if len(batch) >= self.max_batch_size:
+            self.flush(shape, batch)
+
+        kind, answer = await future
+        if kind == "error":
+            raise ValueError(answer)
+        return answer
+
+    def flush(self, shape, batch):
+        """
+        Sends a pending batch to the worker pool, unless it was already sent
+        """
+        if self.pending.get(shape) is not batch:
+            return
+        del self.pending[shape]
+        self.stats.record_batch(len(batch))
+        network, map_vars, _ = shape
+        task = asyncio.get_running_loop().run_in_executor(self.executor, answer_batch, network, list(map_vars),
+                                                           [evidence for evidence, _ in batch])
+        task.add_done_callback(lambda done: self.resolve(batch, done))
+
+    @staticmethod
+    def resolve(batch, done):
+        """
+        Hands the answers of a finished batch to the waiting queries
+        """
+        if done.exception() is not None:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+        for (_, future), answer in zip(batch, done.result()):
+            # The query is cancelled if its client went away
+            if not future.done():
+                future.set_result(answer)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves the HTTP requests of one connection, which is kept open unless the client asks to close it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self.respond(method, target, body)
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, body):
+        """
+        Handles one request
+        Returns: the status code and the JSON response
+        """
+        if target == "/health":
+            return 200, {"status": "ok"}
+        if target == "/stats":
+            return 200, self.stats.summary()
+        if target != "/map":
+            return 404, {"error": f"Unknown path {target}"}
+        if method != "POST":
+            return 405, {"error": "Queries must be sent with POST"}
+
+        start = time.perf_counter()
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                status, response = 400, {"error": "A query must be a JSON object"}
+            elif request.get("network") not in self.networks:
+                status, response = 404, {"error": f"Unknown network {request.get('network')}"}
+            else:
+                result = await self.query(request["network"], request["map_vars"], request.get("evidence", {}))
+                status, response = 200, {"result": result}
+        except KeyError as e:
+            status, response = 400, {"error": f"Missing field {e}"}
+        except (ValueError, TypeError) as e:
+            status, response = 400, {"error": str(e)}
+        except Exception as e:
+            status, response = 500, {"error": f"{type(e).__name__}: {e}"}
+        self.stats.record_query(time.perf_counter() - start, error=status != 200)
+        return status, response
+
+
+class MAPClient:
+    """
+    Minimal asyncio client for MAPServer, opening a connection per request.
+    """
+
+    def __init__(self, host="127.0.0.1", port=None, path=None):
+        """
+        Args:
+            host: host the server listens on
+            port: TCP port the server listens on
+            path: path of the Unix socket the server listens on, instead of host and port
+        """
+        self.host = host
+        self.port = port
+        self.path = path
+
+    async def request(self, method, target, payload=None):
+        """
+        Sends a request
+        Returns: the status code and the decoded JSON response
+        """
+        if self.path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        writer.write(f"{method} {target} HTTP/1.1\r\nHost: {self.host}\r\nConnection: close\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            if key.strip().lower() == "content-length":
+                length = int(value)
+        response = json.loads(await reader.readexactly(length))
+        writer.close()
+        await writer.wait_closed()
+        return status, response
+
+    async def query(self, network, map_vars, evidence):
+        """
+        Sends a MAP query
+        Returns: a dictionary representing the most probable assignment to the map variables {variable: value}
+        """
+        status, response = await self.request("POST", "/map", {"network": network, "map_vars": map_vars,
+                                                               "evidence": evidence})
+        if status != 200:
+            raise RuntimeError(f"Query failed with status {status}: {response['error']}")
+        return response["result"]
+
+    async def stats(self):
+        """Returns the statistics of the server"""
+        return (await self.request("GET", "/stats"))[1]
+
+
+def load_networks(query_file, network_dir=None, compiled=False):
+    """
+    Loads the networks of a queries.json style file
+    Returns: dictionary {name: BayesNet}
+    """
+    query_file = Path(query_file)
+    network_dir = Path(network_dir) if network_dir is not None else query_file.parent.parent / "Networks"
+    with open(query_file, "r") as f:
+        query_data = json.load(f)
+    load = load_network if compiled else BayesNet
+    return {net["name"]: load(network_dir / net["file"]) for net in query_data["networks"]}
+
+
+async def drive(client, query_file, repeat=1):
+    """
+    Sends all queries of a queries.json style file repeat times, all at once
+    Returns: the statistics of the server afterwards
+    """
+    with open(query_file, "r") as f:
+        query_data = json.load(f)
+    queries = [(net["name"], query["map_vars"], query.get("evidence", {}))
+               for net in query_data["networks"] for query in net["queries"]] * repeat
+    await asyncio.gather(*(client.query(*query) for query in queries))
+    return await client.stats()
+
+
+async def serve(networks, host, port, path, **options):
+    """
+    Runs a server until it is interrupted
+    """
+    server = MAPServer(networks, **options)
+    address = await server.start(host, port, path)
+    print(f"Serving {', '.join(networks)} on {address}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve MAP queries over HTTP, or send queries to a running server")
+    parser.add_argument("mode", choices=["serve", "client"], help="Run the server or the test client")
+    parser.add_argument("queries", help="Path to a queries.json file, its networks are served or its queries sent")
+    parser.add_argument("--network-dir", help="Directory containing the .bif files")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on or connect to")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on or connect to")
+    parser.add_argument("--socket", help="Path of a Unix socket to use instead of a TCP port")
+    parser.add_argument("--workers", type=int, help="Number of workers")
+    parser.add_argument("--threads", action="store_true", help="Use worker threads instead of processes")
+    parser.add_argument("--batch-window", type=float, default=0.002, help="Seconds a batch waits for more queries")
+    parser.add_argument("--max-batch-size", type=int, default=64, help="Largest number of queries in a batch")
+    parser.add_argument("--compiled", action="store_true", help="Load networks through the compiled network cache")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times the client sends every query")
+
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        try:
+            asyncio.run(serve(load_networks(args.queries, args.network_dir, args.compiled), args.host, args.port,
+                              args.socket, workers=args.workers, use_processes=not args.threads,
+                              batch_window=args.batch_window, max_batch_size=args.max_batch_size))
+        except KeyboardInterrupt:
+            pass
+    else:
+        stats = asyncio.run(drive(MAPClient(args.host, args.port, args.socket), args.queries, args.repeat))
+        print(json.dumps(stats, indent=2))
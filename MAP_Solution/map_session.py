@@ -0,0 +1,149 @@
+"""
+Stateful MAP queries for evidence that arrives (or is retracted) one variable at a time.
+
+A session fixes the map variables and one elimination order up front, with every non-map variable eliminated
+whether it is observed or not. Evidence is entered as an indicator factor in the bucket of its variable instead of
+by reducing the CPTs, so the scopes of all buckets and messages never change. Every bucket keeps the message it
+sent; when the evidence on a variable changes, only the buckets on the path from its bucket to the last bucket are
+recomputed, like the messages of junction_tree.py.
+
+"""
+import numpy as np
+
+from elim_order_heuristics import greedy_order
+from numpy_factor import NumpyFactor
+from read_bayesnet import BayesNet
+
+
+class MAPSession:
+    """
+    Bucket elimination over numpy factors that reuses the messages of earlier queries.
+    """
+
+    def __init__(self, network: BayesNet, map_vars: list, elim_heuristic="min_fill"):
+        """
+        Args:
+            network:        the network to run queries on
+            map_vars:       the map variables, fixed for the lifetime of the session
+            elim_heuristic: greedy heuristic for the elimination order, see GREEDY_HEURISTICS
+        """
+        self.network = network
+        self.map_vars = list(map_vars)
+        self.order, self.max_clique_size = greedy_order(network, map_vars, {}, elim_heuristic)
+        position = {var: i for i, var in enumerate(self.order)}
+
+        # Every CPT goes to the bucket of the first variable of its scope that is eliminated
+        self.cpts = {var: [] for var in self.order}
+        for node in network.nodes:
+            factor = NumpyFactor.from_network(network, node)
+            self.cpts[min(factor.variables, key=position.get)].append(factor)
+
+        # Find the scope of every message and the bucket it is sent to, None for a constant. These do not depend
+        # on the evidence.
+        scopes = {var: [set(factor.variables) for factor in self.cpts[var]] for var in self.order}
+        self.destination = {}
+        for var in self.order:
+            scope = set().union(*scopes[var]) - {var}
+            self.destination[var] = min(scope, key=position.get) if scope else None
+            if scope:
+                scopes[self.destination[var]].append(scope)
+        self.sources = {var: [source for source in self.order if self.destination[source] == var]
+                        for var in self.order}
+
+        self.evidence = {}
+        self.messages = {}
+        self.products = {}
+
+        # Number of bucket messages computed so far, useful to see how much work was reused
+        self.buckets_computed = 0
+
+        # P(assignment, evidence) of the most recent query
+        self.probability = None
+
+    def observe(self, variable, value):
+        """
+        Adds or changes the evidence on a single variable
+        """
+        if variable not in self.network.values:
+            raise ValueError(f"Unknown variable {variable}")
+        if value not in self.network.values[variable]:
+            raise ValueError(f"Unknown value {value} of variable {variable}")
+        if variable in self.map_vars:
+            raise ValueError(f"Cannot observe map variable {variable}")
+        if self.evidence.get(variable) != value:
+            self.evidence[variable] = value
+            self.invalidate(variable)
+
+    def retract(self, variable):
+        """
+        Removes the evidence on a single variable, if there is any
+        """
+        if variable in self.evidence:
+            del self.evidence[variable]
+            self.invalidate(variable)
+
+    def set_evidence(self, evidence: dict):
+        """
+        Replaces all evidence, only invalidating the buckets of variables whose evidence changed
+        """
+        for variable in [variable for variable in self.evidence if variable not in evidence]:
+            self.retract(variable)
+        for variable, value in evidence.items():
+            self.observe(variable, value)
+
+    def invalidate(self, variable):
+        """
+        Discards the messages that depend on the evidence on a variable: the one sent by its own bucket and
+        everything downstream of it
+        """
+        var = variable
+        while var is not None and var in self.messages:
+            del self.messages[var]
+            self.products.pop(var, None)
+            var = self.destination[var]
+
+    def bucket_factors(self, var):
+        """
+        Returns the functions in the bucket of a variable: its CPTs, the evidence indicator and received messages
+        """
+        factors = self.cpts[var] + [self.messages[source] for source in self.sources[var]]
+        if var in self.evidence:
+            indicator = np.zeros(len(self.network.values[var]))
+            indicator[self.network.values[var].index(self.evidence[var])] = 1
+            factors.append(NumpyFactor([var], self.network.values, indicator))
+        return factors
+
+    def query(self):
+        """
+        Finds the most probable assignment to the map variables given the current evidence, recomputing only
+        invalidated buckets. P(assignment, evidence) is stored in self.probability.
+
+        Returns: A dictionary representing the most probable assignment to the map variables {variable: value}
+        """
+        constant = 1.0
+        for var in self.order:
+            if var not in self.messages:
+                factors = self.bucket_factors(var)
+                if var in self.map_vars:
+                    # Keep the product of a map bucket for backtracking
+                    product = factors[0].copy()
+                    for factor in factors[1:]:
+                        product.multiply(factor)
+                    self.products[var] = product
+                    message = product.copy()
+                    message.maximize(var)
+                else:
+                    message = NumpyFactor.sum_product(factors, var)
+                self.messages[var] = message
+                self.buckets_computed += 1
+
+            if self.destination[var] is None:
+                constant *= float(self.messages[var].table)
+        self.probability = constant
+
+        # Backtrack through the map buckets, the last eliminated variable first
+        assignment = {}
+        for var in reversed(self.order):
+            if var in self.map_vars:
+                assignment[var] = self.products[var].argmax(var, assignment)
+        return self.network.decode({var: assignment[var] for var in self.map_vars})
@@ -0,0 +1,212 @@
+"""
+Memory-bounded elimination on dense factors.
+
+A MemoryBudget limits the size of the tables that elimination keeps in memory. An intermediate factor whose table
+would exceed the budget is written to a memory-mapped scratch file instead, and computed in chunks: the leading
+variables of its scope are fixed one assignment at a time, every input factor is sliced accordingly and only the
+result for that slice is computed in memory. Slices of mapped inputs are read from disk when they are used, so
+later steps stream over spilled factors in the same way.
+
+    with MemoryBudget(2 * 1024 ** 3) as budget:
+        MAP(network).run(map_vars, evidence, factor_backend="numpy", memory_budget=budget)
+
+Queries that need spilled factors complete, but are slower than in memory, since every chunk is written to and read
+back from disk.
+
+"""
+import itertools
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from logger import logger
+
+# Bytes per table entry, factors always store float64
+ENTRY_BYTES = np.dtype(np.float64).itemsize
+
+
+class MemoryBudget:
+    """
+    Multiply, sum, max and reduce operations on NumpyFactors (or LogNumpyFactors) that keep every table they
+    compute below a size limit, spilling larger tables to scratch files.
+    """
+
+    def __init__(self, max_bytes, directory=None):
+        """
+        Args:
+            max_bytes: largest table, in bytes, that is computed in memory at once
+            directory: directory to create the scratch files in, defaults to the temporary directory of the system
+        """
+        if max_bytes < ENTRY_BYTES:
+            raise ValueError(f"A memory budget must hold at least one table entry, got {max_bytes} bytes")
+        self.max_bytes = int(max_bytes)
+        self.directory = directory
+        self.scratch_dir = None
+
+        # Number and total size of the tables written to scratch files so far
+        self.spilled_factors = 0
+        self.spilled_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Deletes all scratch files. Factors that were spilled can no longer be used afterwards.
+        """
+        if self.scratch_dir is not None:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+
+    def allocate(self, shape):
+        """
+        Returns a zero-filled float64 array of the given shape, backed by a new scratch file
+        """
+        if self.scratch_dir is None:
+            self.scratch_dir = tempfile.mkdtemp(prefix="map_spill_", dir=self.directory)
+            # Also delete the files if the budget is never closed, e.g. when a query raised an exception
+            weakref.finalize(self, shutil.rmtree, self.scratch_dir, True)
+        filename = os.path.join(self.scratch_dir, f"factor_{self.spilled_factors}.dat")
+        table = np.memmap(filename, dtype=np.float64, mode="w+", shape=tuple(shape))
+        self.spilled_factors += 1
+        self.spilled_bytes += table.nbytes
+        return table
+
+    def product(self, factors):
+        """
+        Multiplies factors. Like the multiply loop of MAP.run, the first factor is reused when the product fits in
+        memory.
+        Args:
+            factors: factors to multiply, they are not used afterwards
+
+        Returns: a factor over the variables of all factors
+        """
+        output = factors[0].union_scope(factors)
+
+        def multiply(chunk):
+            result = chunk[0].copy()
+            for factor in chunk[1:]:
+                result.multiply(factor)
+            return result
+
+        if self.fits(factors, output):
+            result = factors[0]
+            for factor in factors[1:]:
+                result.multiply(factor)
+            return result
+        return self.chunked(factors, output, multiply)
+
+    def sum_product(self, factors, variable):
+        """
+        Sums a variable out of the product of factors, see NumpyFactor.sum_product. The factors are not modified.
+        """
+        output = [var for var in factors[0].union_scope(factors) if var != variable]
+        factor_class = type(factors[0])
+        return self.chunked(factors, output, lambda chunk: factor_class.sum_product(chunk, variable), variable)
+
+    def maximize(self, factor, variable):
+        """
+        Maximises a variable out of a factor. The factor is not modified, so it can be kept for backtracking.
+
+        Returns: a new factor over the other variables of the factor
+        """
+        output = [var for var in factor.variables if var != variable]
+
+        def maximize(chunk):
+            axis = chunk[0].variables.index(variable)
+            return type(factor)([var for var in chunk[0].variables if var != variable], factor.states,
+                                np.max(chunk[0].table, axis=axis))
+
+        return self.chunked([factor], output, maximize, variable)
+
+    def reduce(self, factor, variable, value):
+        """
+        Applies evidence to a factor in place, see NumpyFactor.reduce
+        """
+        output = [var for var in factor.variables if var != variable]
+
+        def reduce(chunk):
+            axis = chunk[0].variables.index(variable)
+            return type(factor)([var for var in chunk[0].variables if var != variable], factor.states,
+                                np.take(chunk[0].table, value, axis=axis))
+
+        result = self.chunked([factor], output, reduce)
+        factor.variables, factor.table = result.variables, result.table
+
+    def fits(self, factors, output, variable=None):
+        """
+        Checks whether computing a factor over output from factors, eliminating variable if given, stays within
+        the budget
+        """
+        return self.working_entries(factors, output, variable, 0) * ENTRY_BYTES <= self.max_bytes
+
+    def working_entries(self, factors, output, variable, chunked):
+        """
+        Returns the number of entries of the product that is built when the first chunked variables of output
+        are fixed. This bounds the size of the result and of the intermediate tables of a step.
+        """
+        cardinality = self.cardinality(factors)
+        entries = int(np.prod([cardinality[var] for var in output[chunked:]], dtype=np.float64))
+        return entries * (cardinality[variable] if variable is not None else 1)
+
+    @staticmethod
+    def cardinality(factors):
+        """Returns a dictionary {variable: number of states} for the variables of all factors"""
+        cardinality = {}
+        for factor in factors:
+            cardinality.update(factor.cardinality)
+        return cardinality
+
+    def chunked(self, factors, output, operation, variable=None):
+        """
+        Computes a factor over output, in memory if it fits the budget and otherwise chunk by chunk into a scratch
+        file.
+        Args:
+            factors:   the input factors
+            output:    ordered scope of the result
+            operation: function that computes the result from a list of factors, it is called with the input
+                       factors restricted to one assignment of the chunked variables and must return a factor over
+                       the remaining output variables
+            variable:  variable that is eliminated, if any, its states count towards the size of a chunk
+
+        Returns: a factor over output
+        """
+        factor_class = type(factors[0])
+        if self.fits(factors, output, variable):
+            return operation(factors)
+
+        # Fix as few leading variables as possible, so every chunk fits
+        chunked = 0
+        while chunked < len(output) and \
+                self.working_entries(factors, output, variable, chunked) * ENTRY_BYTES > self.max_bytes:
+            chunked += 1
+
+        cardinality = self.cardinality(factors)
+        table = self.allocate([cardinality[var] for var in output])
+        logger.info(f"Spilling factor over {output} ({table.nbytes} bytes) to disk in "
+                    f"{int(np.prod(table.shape[:chunked]))} chunks")
+
+        fixed = output[:chunked]
+        for codes in itertools.product(*[range(cardinality[var]) for var in fixed]):
+            assignment = dict(zip(fixed, codes))
+            chunk = [self.slice(factor, assignment) for factor in factors]
+            result = operation(chunk)
+            table[codes] = result.aligned(output[chunked:])
+        table.flush()
+        return factor_class(output, factors[0].states, table)
+
+    @staticmethod
+    def slice(factor, assignment):
+        """
+        Restricts a factor to an assignment of some of its variables, without copying the table. Slicing a mapped
+        table only reads the selected part from disk.
+        """
+        index = tuple(assignment.get(var, slice(None)) for var in factor.variables)
+        return type(factor)([var for var in factor.variables if var not in assignment], factor.states,
+                            factor.table[index])
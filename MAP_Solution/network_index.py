@@ -0,0 +1,147 @@
+"""
+Compact, array-based index of the structure of a Bayesian network.
+
+Nodes get integer ids in declaration order. Parents, children and the factors every variable appears in are stored
+in CSR form: the neighbours of node i are ids[ptr[i]:ptr[i + 1]]. Factor j is the CPT of node j, so variable i
+appears in its own factor and in the factors of its children. The index is built once per network, see
+BayesNet.index, and replaces repeated scans over all CPTs.
+
+"""
+import heapq
+
+import numpy as np
+
+
+def csr(lists):
+    """
+    Packs a list of lists of ids into a (ptr, ids) pair of int32 arrays
+    """
+    ptr = np.zeros(len(lists) + 1, dtype=np.int32)
+    ptr[1:] = np.cumsum([len(ids) for ids in lists])
+    ids = np.fromiter((i for ids in lists for i in ids), dtype=np.int32, count=int(ptr[-1]))
+    return ptr, ids
+
+
+class NetworkIndex:
+    """
+    Integer ids, topological order and CSR adjacency of a network.
+    """
+
+    __slots__ = ("names", "ids", "cardinality", "topological_order", "parent_ptr", "parent_ids", "child_ptr",
+                 "child_ids", "factor_ptr", "factor_ids")
+
+    def __init__(self, network):
+        """
+        Args:
+            network: read_bayesnet.BayesNet to index
+        """
+        self.names = network.nodes
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.cardinality = np.asarray([len(network.values[name]) for name in self.names], dtype=np.int32)
+
+        parents = [[self.ids[parent] for parent in network.parents[name]] for name in self.names]
+        children = [[] for _ in self.names]
+        for i, node_parents in enumerate(parents):
+            for parent in node_parents:
+                children[parent].append(i)
+
+        self.parent_ptr, self.parent_ids = csr(parents)
+        self.child_ptr, self.child_ids = csr(children)
+        self.factor_ptr, self.factor_ids = csr([[i] + node_children for i, node_children in enumerate(children)])
+        self.topological_order = self.sort_topologically()
+
+    def sort_topologically(self):
+        """
+        Returns the node ids with every node after its parents, ties broken by id (Kahn's algorithm)
+        """
+        in_degree = np.diff(self.parent_ptr)
+        ready = [i for i in range(len(self.names)) if in_degree[i] == 0]
+        order = []
+        while ready:
+            i = heapq.heappop(ready)
+            order.append(i)
+            for child in self.children(i).tolist():
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    heapq.heappush(ready, child)
+        if len(order) != len(self.names):
+            raise ValueError("The network contains a directed cycle")
+        return np.asarray(order, dtype=np.int32)
+
+    def parents(self, i):
+        """Returns the ids of the parents of node i"""
+        return self.parent_ids[self.parent_ptr[i]:self.parent_ptr[i + 1]]
+
+    def children(self, i):
+        """Returns the ids of the children of node i"""
+        return self.child_ids[self.child_ptr[i]:self.child_ptr[i + 1]]
+
+    def factors(self, i):
+        """Returns the ids of the factors (CPTs) that contain variable i"""
+        return self.factor_ids[self.factor_ptr[i]:self.factor_ptr[i + 1]]
+
+    def num_factors(self, i):
+        """Returns the number of factors that contain variable i"""
+        return int(self.factor_ptr[i + 1] - self.factor_ptr[i])
+
+    def ancestors(self, ids):
+        """
+        Returns a boolean mask over all nodes of the given nodes and their ancestors
+        """
+        mask = np.zeros(len(self.names), dtype=bool)
+        stack = list(ids)
+        while stack:
+            i = stack.pop()
+            if not mask[i]:
+                mask[i] = True
+                stack.extend(self.parents(i).tolist())
+        return mask
+
+
+class FactorPool:
+    """
+    The factors of a running elimination, with an index from every variable to the factors that contain it. Taking
+    the factors of a variable out of the pool only touches those factors, instead of scanning the whole list.
+    Factors are handed out in the order in which they were added.
+    """
+
+    __slots__ = ("factors", "containing", "next_slot")
+
+    def __init__(self, factors=()):
+        self.factors = {}
+        self.containing = {}
+        self.next_slot = 0
+        for factor in factors:
+            self.add(factor)
+
+    def add(self, factor, scope=None):
+        """
+        Adds a factor
+        Args:
+            factor: the factor
+            scope:  its variables, read from get_vars if not given
+        """
+        slot = self.next_slot
+        self.next_slot += 1
+        self.factors[slot] = factor
+        for var in (scope if scope is not None else factor.get_vars()):
+            if var != "prob":
+                self.containing.setdefault(var, set()).add(slot)
+
+    def pop(self, variable):
+        """
+        Removes all factors that contain a variable from the pool and returns them
+        """
+        slots = sorted(self.containing.pop(variable, ()))
+        factors = [self.factors.pop(slot) for slot in slots]
+        for factor in factors:
+            for var in factor.get_vars():
+                if var in self.containing:
+                    self.containing[var].difference_update(slots)
+        return factors
+
+    def __iter__(self):
+        return iter(self.factors.values())
+
+    def __len__(self):
+        return len(self.factors)
@@ -0,0 +1,91 @@
+"""
+Query-specific pruning of a network before variable elimination.
+
+Two kinds of nodes cannot change the answer of a MAP query and are dropped before any factor is built:
+
+- Barren nodes: non-map, unobserved nodes without children. Their CPT sums to one when they are summed out, and
+  removing them can make their parents barren too. Repeating this leaves the ancestors of the map and observed
+  variables.
+- d-separated nodes: once the evidence is absorbed into the CPTs, the remaining factors fall apart into groups that
+  share no unobserved variable. Groups that do not contain a map variable are d-separated from the map variables
+  given the evidence, and only scale every assignment by the same constant.
+
+Which nodes survive only depends on the network and on which variables are map variables or observed, so the
+result is cached per query shape, like the elimination orders.
+
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from elim_order_cache import ElimOrderCache
+from read_bayesnet import BayesNet
+
+# Result of pruning a network for a query shape. nodes are the nodes whose CPTs are still needed, in network order,
+# variables the unobserved variables that still have to be eliminated.
+PruneResult = namedtuple("PruneResult", ["nodes", "variables", "factors_pruned", "entries_pruned"])
+
+
+def prune_network(network: BayesNet, map_vars, observed):
+    """
+    Finds the nodes whose CPTs are needed to answer a MAP query
+    Args:
+        network:  the network the query is run on
+        map_vars: the map variables of the query
+        observed: the observed variables of the query, only the variable names are used
+
+    Returns: a PruneResult
+    """
+    index = network.index
+    is_observed = np.zeros(len(index.names), dtype=bool)
+    is_observed[[index.ids[var] for var in observed]] = True
+    ancestral = index.ancestors([index.ids[var] for var in map_vars] + np.flatnonzero(is_observed).tolist())
+
+    # Walk from the map variables through the CPTs of the ancestral network. Unobserved variables that share the
+    # scope of such a CPT after the evidence is absorbed are connected, observed variables block the walk. The CPTs
+    # that are reached are needed, the others are d-separated or only depend on observed variables.
+    relevant = np.zeros(len(index.names), dtype=bool)
+    needed = np.zeros(len(index.names), dtype=bool)
+    stack = [index.ids[var] for var in map_vars]
+    relevant[stack] = True
+    while stack:
+        var = stack.pop()
+        for factor in index.factors(var).tolist():
+            if not ancestral[factor] or needed[factor]:
+                continue
+            needed[factor] = True
+            for other in [factor] + index.parents(factor).tolist():
+                if not relevant[other] and not is_observed[other]:
+                    relevant[other] = True
+                    stack.append(other)
+
+    nodes = [index.names[i] for i in np.flatnonzero(needed)]
+    pruned = [index.names[i] for i in np.flatnonzero(~needed)]
+    entries_pruned = sum(int(network.tables[node].size) for node in pruned)
+    variables = [index.names[i] for i in np.flatnonzero(relevant)]
+    return PruneResult(nodes, variables, len(pruned), entries_pruned)
+
+
+class PruneCache(ElimOrderCache):
+    """
+    Least-recently-used cache of PruneResults per network and query shape.
+    """
+
+    def get(self, network, map_vars, observed):
+        """
+        Returns the cached PruneResult for a query shape, or None
+        """
+        return self.lookup(self.make_key(network, "prune", map_vars, observed))
+
+    def put(self, network, map_vars, observed, result):
+        self.store(network, self.make_key(network, "prune", map_vars, observed), result)
+
+    def prune(self, network, map_vars, observed):
+        """
+        Returns the PruneResult for a query, computing it only if the query shape was not seen before
+        """
+        result = self.get(network, map_vars, observed)
+        if result is None:
+            result = prune_network(network, map_vars, observed)
+            self.put(network, map_vars, observed, result)
+        return result
@@ -0,0 +1,97 @@
+"""
+Registry that holds several Bayesian networks in memory at once and answers MAP queries against any of them.
+
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from map import MAP
+from read_bayesnet import BayesNet
+
+
+class NetworkRegistry:
+    """
+    Thread-safe collection of loaded networks, looked up by name.
+
+    Networks are parsed once when they are loaded and are then shared by all queries, so answering a query never
+    re-reads a .bif file.
+    """
+
+    def __init__(self):
+        self._networks = {}
+        self._lock = threading.Lock()
+
+    def load(self, name, filename):
+        """
+        Load a single network and register it under the given name, replacing any network with the same name
+        Args:
+            name:     name to register the network under
+            filename: path to the .bif file
+
+        Returns: the loaded network
+        """
+        return self.add(name, BayesNet(filename))
+
+    def load_all(self, filenames: dict, max_workers=None, use_processes=False):
+        """
+        Load several networks concurrently and register them
+        Args:
+            filenames:     dictionary {name: path to .bif file}
+            max_workers:   number of workers in the pool, the executor default if None
+            use_processes: parse in a process pool instead of a thread pool. Parsing is pure Python, so only
+                           processes load networks truly in parallel, at the cost of pickling the result back.
+
+        Returns: dictionary {name: loaded network}
+        """
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(BayesNet, filename) for name, filename in filenames.items()}
+            return {name: self.add(name, future.result()) for name, future in futures.items()}
+
+    def add(self, name, network: BayesNet):
+        """
+        Register an already loaded network under the given name
+        """
+        with self._lock:
+            self._networks[name] = network
+        return network
+
+    def remove(self, name):
+        """
+        Remove a network from the registry
+        """
+        with self._lock:
+            del self._networks[name]
+
+    def get(self, name) -> BayesNet:
+        """
+        Returns the network registered under the given name
+        """
+        with self._lock:
+            return self._networks[name]
+
+    def names(self):
+        """Returns the names of the registered networks"""
+        with self._lock:
+            return list(self._networks.keys())
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._networks
+
+    def __len__(self):
+        with self._lock:
+            return len(self._networks)
+
+    def run(self, name, map_vars: list, observed: dict, **kwargs):
+        """
+        Answer a MAP query against one of the registered networks
+        Args:
+            name:     name of the network to query
+            map_vars: the map variables to be queried
+            observed: a dictionary of the observed variables {variable: value}
+            kwargs:   passed on to MAP.run
+
+        Returns: a dictionary representing the most probable assignment to the map variables {variable: value}
+        """
+        return MAP(self.get(name)).run(map_vars, observed, **kwargs)
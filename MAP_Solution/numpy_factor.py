@@ -0,0 +1,340 @@
+import numpy as np
+import pandas as pd
+
+# Name of the leading axis that batched factors carry, one entry per query in the batch
+BATCH = "__batch__"
+
+# np.einsum labels axes with letters, so it can only contract products over at most this many variables
+EINSUM_MAX_VARIABLES = 52
+
+
+def logsumexp(table, axis=None):
+    """
+    Computes log(sum(exp(table))) along an axis without overflow or underflow in the exponent
+    """
+    peak = np.max(table, axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0)
+    with np.errstate(divide="ignore"):
+        result = np.log(np.sum(np.exp(table - peak), axis=axis, keepdims=True)) + peak
+    return result.reshape(()) if axis is None else np.squeeze(result, axis=axis)
+
+
+class NumpyFactor:
+    """
+    Factor stored as a dense N-dimensional numpy array with one axis per variable.
+
+    Offers the same operations as factor.Factor, but implements them as array indexing, broadcasting and
+    axis reductions instead of pandas merges and groupbys.
+    """
+
+    # Combines the tables of two factors in multiply
+    product_op = np.multiply
+
+    def __init__(self, variables: list, states: dict, table: np.ndarray):
+        """
+        Args:
+            variables: ordered scope of the factor, axis i of the table belongs to variables[i]
+            states:    dictionary {variable: [state, ...]} giving the state labels of every axis
+            table:     array of shape (cardinality of variables[0], cardinality of variables[1], ...)
+        """
+        self.variables = list(variables)
+        self.states = states
+        self.table = np.asarray(table, dtype=np.float64)
+        assert self.table.ndim == len(self.variables)
+
+    @classmethod
+    def from_cpt(cls, cpt: pd.DataFrame, states: dict):
+        """
+        Builds a dense factor from a conditional probability table as produced by read_bayesnet.BayesNet
+        Args:
+            cpt:    dataframe with one column per variable followed by a "prob" column
+            states: possible values per variable (BayesNet.values)
+        """
+        variables = cpt.columns[:-1].tolist()
+        shape = tuple(len(states[var]) for var in variables)
+
+        # Translate the state labels of every column to their position along the matching axis
+        codes = tuple(pd.Categorical(cpt[var], categories=states[var]).codes for var in variables)
+
+        table = np.zeros(shape)
+        table[codes] = cpt["prob"].to_numpy(dtype=np.float64)
+        return cls(variables, states, table)
+
+    @classmethod
+    def from_network(cls, network, variable):
+        """
+        Builds a dense factor from the probability array of a variable in a network, without going through its
+        DataFrame
+        Args:
+            network:  read_bayesnet.BayesNet the variable belongs to
+            variable: variable whose conditional probability table to use
+        """
+        return cls([variable] + network.parents[variable], network.values, network.tables[variable])
+
+    @property
+    def cardinality(self):
+        """Returns a dictionary {variable: number of states} for the variables in this factor"""
+        return dict(zip(self.variables, self.table.shape))
+
+    def reduce(self, variable, value):
+        """
+        Reduces this factor by applying evidence to it. Evidence variable is removed from the factor
+        Args:
+            variable: variable to apply evidence to
+            value: index of the observed state
+        """
+        axis = self.variables.index(variable)
+        self.table = np.take(self.table, value, axis=axis)
+        del self.variables[axis]
+
+    def reduce_batch(self, variable, codes):
+        """
+        Applies different evidence for every query in a batch. The evidence variable is replaced by the batch axis,
+        which becomes the first axis of the factor.
+        Args:
+            variable: variable to apply evidence to
+            codes: array with for every query in the batch the index of the observed state of variable
+        """
+        axis = self.variables.index(variable)
+        if BATCH not in self.variables:
+            self.table = np.moveaxis(np.take(self.table, codes, axis=axis), axis, 0)
+        else:
+            # Pick entry (b, codes[b]) for every query b
+            table = np.moveaxis(self.table, [self.variables.index(BATCH), axis], [0, 1])
+            self.table = table[np.arange(len(codes)), codes]
+        self.variables = [BATCH] + [var for var in self.variables if var not in (BATCH, variable)]
+
+    def maximize(self, variable):
+        """
+        Maximises out a variable from the factor. Used for MAP operation.
+        Args:
+            variable: Variable to maximise out of the factor.
+        """
+        axis = self.variables.index(variable)
+        self.table = self.table.max(axis=axis)
+        del self.variables[axis]
+
+    def marginalize(self, variable):
+        """
+        Sums-out a variable from this factor
+        Args:
+            variable: variable to sum out
+        """
+        axis = self.variables.index(variable)
+        self.table = self.table.sum(axis=axis)
+        del self.variables[axis]
+
+    @classmethod
+    def sum_product(cls, factors, variable):
+        """
+        Sums a variable out of the product of factors without materialising the product, by contracting the
+        tables with np.einsum. The factors are not modified.
+        Args:
+            factors: factors that all contain variable
+            variable: variable to sum out
+
+        Returns: a new factor over all other variables of the factors
+        """
+        variables = cls.union_scope(factors)
+        output = [var for var in variables if var != variable]
+        if len(variables) > EINSUM_MAX_VARIABLES:
+            return cls.reduce_product(factors, variable, np.add)
+
+        labels = {var: i for i, var in enumerate(variables)}
+        operands = []
+        for factor in factors:
+            operands += [factor.table, [labels[var] for var in factor.variables]]
+        table = np.einsum(*operands, [labels[var] for var in output], optimize=True)
+        return cls(output, factors[0].states, table)
+
+    @classmethod
+    def max_product(cls, factors, variable):
+        """
+        Maximises a variable out of the product of factors without materialising the product. The factors are not
+        modified.
+        Args:
+            factors: factors that all contain variable
+            variable: variable to maximise out
+
+        Returns: a new factor over all other variables of the factors
+        """
+        return cls.reduce_product(factors, variable, np.maximum)
+
+    @classmethod
+    def reduce_product(cls, factors, variable, combine):
+        """
+        Eliminates a variable from the product of factors one state at a time. Only the product for a single state
+        of the variable exists at any moment, so memory is bounded by the size of the result.
+        Args:
+            factors: factors that all contain variable
+            variable: variable to eliminate
+            combine: binary ufunc that merges the products for successive states, e.g. np.maximum
+
+        Returns: a new factor over all other variables of the factors
+        """
+        output = [var for var in cls.union_scope(factors) if var != variable]
+        cardinality = next(factor.table.shape[factor.variables.index(variable)] for factor in factors
+                           if variable in factor.variables)
+
+        table = None
+        for code in range(cardinality):
+            term = None
+            for factor in factors:
+                if variable in factor.variables:
+                    factor = cls([var for var in factor.variables if var != variable], factor.states,
+                                 np.take(factor.table, code, axis=factor.variables.index(variable)))
+                aligned = factor.aligned(output)
+                term = aligned if term is None else cls.product_op(term, aligned)
+            table = term if table is None else combine(table, term)
+        return cls(output, factors[0].states, table)
+
+    @staticmethod
+    def union_scope(factors):
+        """Returns the variables of all factors, in order of first appearance"""
+        variables = []
+        for factor in factors:
+            variables += [var for var in factor.variables if var not in variables]
+        return variables
+
+    def multiply(self, factor2: "NumpyFactor", variable=None):
+        """
+        Multiplies this factor with another provided factor. Unlike factor.Factor the tables are joined on all
+        variables the two factors have in common, so variable is only accepted for interface compatibility.
+        Args:
+            factor2: factor to multiply this with
+            variable: unused
+        """
+        if not isinstance(factor2, NumpyFactor):
+            # Sparse factors mixed in by the "auto" backend
+            factor2 = factor2.to_dense()
+        variables = self.variables + [var for var in factor2.variables if var not in self.variables]
+        self.table = self.product_op(self.aligned(variables), factor2.aligned(variables))
+        self.variables = variables
+
+    def aligned(self, variables):
+        """
+        Returns the table transposed and reshaped so that it broadcasts against a table over the given variables.
+        Variables missing from this factor get an axis of length one.
+        Args:
+            variables: ordered list of variables that is a superset of the scope of this factor
+        """
+        present = [var for var in variables if var in self.variables]
+        table = np.transpose(self.table, [self.variables.index(var) for var in present])
+        shape = [table.shape[present.index(var)] if var in self.variables else 1 for var in variables]
+        return table.reshape(shape)
+
+    def normalize(self):
+        """
+        Normalizes this factor such that the probability distribution adds to 1
+        """
+        self.table = self.table / self.table.sum()
+
+    def argmax(self, variable, assignment: dict):
+        """
+        Finds the state of a variable with the highest probability, given the states of the other variables
+        Args:
+            variable:   variable to find the maximising state for
+            assignment: dictionary {variable: state index} that contains at least all other variables in the factor
+
+        Returns: the index of the maximising state of variable
+        """
+        index = tuple(slice(None) if var == variable else assignment[var] for var in self.variables)
+        return int(np.argmax(self.table[index]))
+
+    def argmax_batch(self, variable, assignment: dict, batch_size):
+        """
+        Finds the maximising state of a variable for every query in a batch
+        Args:
+            variable:   variable to find the maximising states for
+            assignment: dictionary {variable: array of state indices per query} that contains at least all other
+                        variables in the factor except the batch axis
+            batch_size: number of queries in the batch
+
+        Returns: array with for every query the index of the maximising state of variable
+        """
+        others = [var for var in self.variables if var not in (BATCH, variable)]
+        table = self.aligned([BATCH] + others + [variable])
+
+        # Factors that do not depend on the batch have a batch axis of length one
+        rows = np.arange(batch_size) if BATCH in self.variables else np.zeros(batch_size, dtype=np.intp)
+        index = (rows,) + tuple(assignment[var] for var in others)
+        return np.argmax(table[index], axis=-1)
+
+    def get_data_frame(self):
+        """Returns the factor as a dataframe in the same layout as factor.Factor"""
+        # The batch axis has no state labels, so its entries are numbered instead
+        states = [range(size) if var == BATCH else self.states[var]
+                  for var, size in zip(self.variables, self.table.shape)]
+        index = pd.MultiIndex.from_product(states, names=self.variables)
+        df = index.to_frame(index=False) if self.variables else pd.DataFrame(index=[0])
+        df["prob"] = self.table.reshape(-1)
+        return df
+
+    def num_entries(self):
+        """Returns the number of entries in the table of the factor"""
+        return int(self.table.size)
+
+    def get_vars(self):
+        return self.variables + ["prob"]
+
+    def __str__(self) -> str:
+        return str(self.get_vars())
+
+    def copy(self):
+        return type(self)(self.variables, self.states, self.table.copy())
+
+
+class LogNumpyFactor(NumpyFactor):
+    """
+    Dense factor that stores natural logarithms of probabilities, so long products of small probabilities do not
+    underflow. Products become sums and summing out becomes log-sum-exp; maximising and argmax are unchanged since
+    the logarithm is monotonic. get_data_frame still reports probabilities.
+    """
+
+    product_op = np.add
+
+    @classmethod
+    def from_factor(cls, factor: NumpyFactor):
+        """
+        Converts a factor that holds probabilities to one that holds log-probabilities
+        """
+        with np.errstate(divide="ignore"):
+            return cls(factor.variables, factor.states, np.log(factor.table))
+
+    @classmethod
+    def from_cpt(cls, cpt, states: dict):
+        return cls.from_factor(NumpyFactor.from_cpt(cpt, states))
+
+    @classmethod
+    def from_network(cls, network, variable):
+        return cls.from_factor(NumpyFactor.from_network(network, variable))
+
+    def marginalize(self, variable):
+        """
+        Sums-out a variable from this factor
+        Args:
+            variable: variable to sum out
+        """
+        axis = self.variables.index(variable)
+        self.table = logsumexp(self.table, axis=axis)
+        del self.variables[axis]
+
+    @classmethod
+    def sum_product(cls, factors, variable):
+        """
+        Sums a variable out of the product of factors without materialising the product, accumulating the terms
+        for successive states with np.logaddexp. The factors are not modified.
+        """
+        return cls.reduce_product(factors, variable, np.logaddexp)
+
+    def normalize(self):
+        """
+        Normalizes this factor such that the probability distribution adds to 1
+        """
+        self.table = self.table - logsumexp(self.table)
+
+    def get_data_frame(self):
+        """Returns the factor as a dataframe of probabilities in the same layout as factor.Factor"""
+        df = super().get_data_frame()
+        df["prob"] = np.exp(df["prob"])
+        return df
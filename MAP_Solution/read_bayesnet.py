@@ -5,8 +5,19 @@ Representation of a Bayesian network read in from a .bif file.
 
 """
 
+import itertools
+import re
+import sys
+from collections.abc import Mapping
+
+import numpy as np
 import pandas as pd
 
+from network_index import NetworkIndex
+
+# Words of a .bif file and the punctuation separating them. Comments are matched so they can be skipped.
+TOKEN_PATTERN = re.compile(r'//[^\n]*|/\*.*?\*/|[{}()\[\];,|]|[^\s{}()\[\];,|]+', re.DOTALL)
+
 
 class BayesNet:
     """
@@ -17,106 +28,314 @@ class BayesNet:
     Uses pandas DataFrames for representing conditional probability tables
     """
 
-    # Possible values per variable
-    values = {}
+    def __init__(self, filename=None):
+        """
+        Construct a bayesian network from a .bif file, or an empty network if no file is given
+
+        The file is read once and split into tokens, which are consumed block by block. The entries of each
+        probability block are collected first and turned into a DataFrame in one go.
+        """
+        self.name = None
+
+        # Possible values per variable
+        self.values = {}
+
+        # Probability distributions per variable
+        self.probabilities = {}
+
+        # Parents per variable
+        self.parents = {}
 
-    # Probability distributions per variable
-    probabilities = {}
+        # Probability distributions per variable as arrays with axes (variable, parent 1, parent 2, ...)
+        self.tables = {}
 
-    # Parents per variable
-    parents = {}
+        # Probability distributions per variable with states encoded as their index in values, built on first use
+        self.coded_probabilities = CPTFrames(self, coded=True)
 
-    def __init__(self, filename):
+        # NetworkIndex of the structure, built on first use
+        self._index = None
+
+        # Version of the structure, incremented by invalidate_structure. Caches key their entries on it.
+        self.structure_version = 0
+
+        if filename is None:
+            return
+
+        with open(filename, 'r') as file:
+            tokens = self.tokenize(file.read())
+
+        # Probability blocks may refer to variables that are declared further down, so build them at the end
+        distributions = []
+        for token in tokens:
+            if token == 'network':
+                self.name = ' '.join(self.read_until(tokens, '{'))
+                self.skip_block(tokens)
+            elif token == 'variable':
+                self.parse_variable(tokens)
+            elif token == 'probability':
+                distributions.append(self.parse_probability(tokens))
+
+        for variable, parents, table, rows, default in distributions:
+            self.probabilities[variable], self.tables[variable] = self.build_cpt(variable, parents, table, rows,
+                                                                                 default)
+
+    @classmethod
+    def from_tables(cls, name, values: dict, parents: dict, tables: dict):
         """
-        Construct a bayesian network from a .bif file
+        Construct a bayesian network from probability arrays instead of a .bif file
 
+        The DataFrames in probabilities are only built when they are first accessed, so networks backed by
+        memory-mapped arrays can be created without touching the probabilities.
+        Args:
+            name:    name of the network
+            values:  possible values per variable
+            parents: parents per variable
+            tables:  array per variable with axes (variable, parent 1, parent 2, ...)
         """
-        with open(filename, 'r') as file:
-            line_number = 0
-            for line in file:
-                if line.startswith('network'):
-                    self.name = ' '.join(line.split()[1:-1])
-                elif line.startswith('variable'):
-                    self.parse_variable(line_number, filename)
-                elif line.startswith('probability'):
-                    self.parse_probability(line_number, filename)
-                line_number = line_number + 1
-
-    def parse_probability(self, line_number, filename):
+        network = cls()
+        network.name = name
+        network.values = values
+        network.parents = parents
+        network.tables = tables
+        network.probabilities = CPTFrames(network)
+        return network
+
+    def encode(self, assignment: dict):
         """
-        Parse the probability distribution
+        Converts an assignment {variable: value} to {variable: index of the value in values}
         """
+        return {var: self.values[var].index(value) for var, value in assignment.items()}
 
-        # get line
-        line = open(filename, 'r').readlines()[line_number]
+    def decode(self, codes: dict):
+        """
+        Converts an assignment {variable: index of the value in values} back to {variable: value}
+        """
+        return {var: self.values[var][int(code)] for var, code in codes.items()}
 
-        # Find out what variable(s) we are talking about
-        variable, parents = self.parse_parents(line)
-        next_line = open(filename, 'r').readlines()[line_number + 1].strip()
+    @staticmethod
+    def tokenize(text):
+        """
+        Split the contents of a .bif file into tokens, leaving out comments
+        """
+        for match in TOKEN_PATTERN.finditer(text):
+            token = match.group()
+            if not token.startswith(('//', '/*')):
+                yield token
 
-        # If a variable has no parents, its probabilities start with table
-        if next_line.startswith('table'):
-            comma_sep_probs = next_line.split('table')[1].split(';')[0].strip()
-            probs = [float(p) for p in comma_sep_probs.split(',')]
-            df = pd.DataFrame(columns=[variable, 'prob'])
-            for value, p in zip(self.values[variable], probs):
-                df.loc[len(df)] = [value, p]
-                self.probabilities[variable] = df
-        else:
-            # create dataFrame to store the variables
-            df = pd.DataFrame(columns=[variable] + parents + ['prob'])
+    @staticmethod
+    def read_until(tokens, end):
+        """
+        Collect tokens up to (not including) the given end token. The end token is consumed.
+        """
+        collected = []
+        for token in tokens:
+            if token == end:
+                return collected
+            collected.append(token)
+        raise ValueError(f"Unexpected end of file, expected '{end}'")
 
-            # loop over the lines until a line is the same as "}"
-            with open(filename, 'r') as file:
-                for i in range(line_number + 1):
-                    file.readline()
-                for line in file:
-                    if '}' in line:
-                        # Done reading this probability distribution
-                        break
+    @staticmethod
+    def skip_block(tokens):
+        """
+        Skip the rest of a block whose opening brace has already been consumed
+        """
+        depth = 1
+        for token in tokens:
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if depth == 0:
+                    return
+        raise ValueError("Unexpected end of file, expected '}'")
+
+    def parse_variable(self, tokens):
+        """
+        Parse the name of a variable and its possible values
+        """
+        # Variable names are used as dictionary keys and column names everywhere, so share one string object
+        variable = sys.intern(next(tokens))
+        self.read_until(tokens, '{')
+
+        for token in tokens:
+            if token == '}':
+                break
+            if token == 'type':
+                # type discrete [ n ] { value, value, ... };
+                self.read_until(tokens, '{')
+                values = self.read_until(tokens, '}')
+                self.values[variable] = [value for value in values if value != ',']
+            # Skip the rest of this statement (e.g. a property)
+            if token != ';':
+                self.read_until(tokens, ';')
 
-                    # Get the values for the parents
-                    comma_sep_values = line.split('(')[1].split(')')[0]
-                    values = [v.strip() for v in comma_sep_values.split(',')]
+    def parse_probability(self, tokens):
+        """
+        Parse the probability distribution
 
-                    # Get the probabilities for the variable
-                    comma_sep_probs = line.split(')')[1].split(';')[0].strip()
-                    probs = [float(p) for p in comma_sep_probs.split(',')]
+        Returns the variable, its parents, the probabilities of a table statement, the (parent values,
+        probabilities) pairs of the conditional rows and the probabilities of a default statement
+        """
+        variable, parents = self.parse_parents(tokens)
+        self.read_until(tokens, '{')
 
-                    # Create a row in the df for each value combination
-                    for value, p in zip(self.values[variable], probs):
-                        df.loc[len(df)] = [value] + values + [p]
+        table = None
+        rows = []
+        default = None
+        for token in tokens:
+            if token == '}':
+                break
+            elif token == 'table':
+                table = self.parse_numbers(tokens)
+            elif token == 'default':
+                default = self.parse_numbers(tokens)
+            elif token == '(':
+                values = [value for value in self.read_until(tokens, ')') if value != ',']
+                rows.append((values, self.parse_numbers(tokens)))
+            elif token != ';':
+                # Unknown statement such as a property, skip it
+                self.read_until(tokens, ';')
 
-            self.probabilities[variable] = df
+        return variable, parents, table, rows, default
 
-    def parse_variable(self, line_number, filename):
+    @staticmethod
+    def parse_numbers(tokens):
         """
-        Parse the name of a variable and its possible values
+        Parse a comma separated list of probabilities ending with a semicolon, possibly spread over several lines
         """
-        variable = open(filename, 'r').readlines()[line_number].split()[1]
-        line = open(filename, 'r').readlines()[line_number + 1]
-        start = line.find('{') + 1
-        end = line.find('}')
-        values = [value.strip() for value in line[start:end].split(',')]
-        self.values[variable] = values
+        return [float(p) for p in BayesNet.read_until(tokens, ';') if p != ',']
 
-    def parse_parents(self, line):
+    def parse_parents(self, tokens):
         """
         Find out what variables are the parents
         Returns the variable and its parents
         """
-        start = line.find('(') + 1
-        end = line.find(')')
-        variables = line[start:end].strip().split('|')
-        variable = variables[0].strip()
-        if len(variables) > 1:
-            parents = variables[1]
-            self.parents[variable] = [v.strip() for v in parents.split(',')]
+        self.read_until(tokens, '(')
+        variables = self.read_until(tokens, ')')
+        variable = variables[0]
+        if '|' in variables:
+            self.parents[variable] = [v for v in variables[variables.index('|') + 1:] if v != ',']
         else:
             self.parents[variable] = []
         return variable, self.parents[variable]
 
+    def build_cpt(self, variable, parents, table, rows, default):
+        """
+        Build the conditional probability table of a variable in bulk.
+
+        The table has a column for the variable, a column per parent and a "prob" column. Conditional rows keep
+        the order of the file, and within each parent instantiation the values of the variable follow the order
+        in which they were declared.
+
+        Returns the DataFrame and the same probabilities as an array with axes (variable, parent 1, parent 2, ...)
+        """
+        states = self.values[variable]
+
+        if table is not None:
+            # A table lists the probabilities for every combination, the variable itself varies slowest
+            parent_values = list(itertools.product(*(self.values[parent] for parent in parents)))
+            probs = np.asarray(table, dtype=np.float64).reshape(len(states), len(parent_values)).T
+        else:
+            parent_values = [tuple(values) for values, _ in rows]
+            probs = [p for _, p in rows]
+
+            # Parent instantiations that are not listed explicitly get the default probabilities
+            if default is not None:
+                listed = set(parent_values)
+                for values in itertools.product(*(self.values[parent] for parent in parents)):
+                    if values not in listed:
+                        parent_values.append(values)
+                        probs.append(default)
+
+            probs = np.asarray(probs, dtype=np.float64).reshape(len(parent_values), -1)
+
+        if probs.shape[1] != len(states):
+            raise ValueError(f"Expected {len(states)} probabilities per row for variable {variable}, "
+                             f"found {probs.shape[1]}")
+
+        columns = {variable: np.tile(np.asarray(states, dtype=object), len(parent_values))}
+        for i, parent in enumerate(parents):
+            columns[parent] = np.repeat(np.asarray([values[i] for values in parent_values], dtype=object),
+                                        len(states))
+        columns['prob'] = probs.reshape(-1)
+
+        # Scatter the rows into an array, indexed by the position of each parent value
+        array = np.zeros(tuple(len(self.values[parent]) for parent in parents) + (len(states),))
+        index = tuple(np.asarray([self.values[parent].index(values[i]) for values in parent_values], dtype=np.intp)
+                      for i, parent in enumerate(parents))
+        array[index] = probs
+        array = np.ascontiguousarray(np.moveaxis(array, -1, 0))
+
+        return pd.DataFrame(columns), array
+
+    def table_to_data_frame(self, variable, coded=False):
+        """
+        Build the conditional probability table of a variable from its array in tables. Rows are ordered by
+        parent instantiation, with the last parent varying fastest.
+
+        With coded set, the columns hold the index of each state in values, in the smallest unsigned integer
+        type that fits, instead of the state names.
+        """
+        variables = [variable] + self.parents[variable]
+        if coded:
+            # Row i of the flattened array with axes (parent 1, ..., variable) has these state indices
+            shape = [len(self.values[var]) for var in self.parents[variable]] + [len(self.values[variable])]
+            codes = np.indices(shape).reshape(len(shape), -1)
+            names = self.parents[variable] + [variable]
+            df = pd.DataFrame({var: codes[names.index(var)].astype(np.min_scalar_type(max(len(self.values[var]) - 1,
+                                                                                          0)))
+                               for var in variables})
+        else:
+            states = [self.values[var] for var in self.parents[variable]] + [self.values[variable]]
+            index = pd.MultiIndex.from_product(states, names=self.parents[variable] + [variable])
+            df = index.to_frame(index=False)[variables].astype(object)
+        df['prob'] = np.moveaxis(self.tables[variable], 0, -1).reshape(-1)
+        return df
+
     @property
     def nodes(self):
         """Returns the names of the variables in the network"""
         return list(self.values.keys())
+
+    @property
+    def index(self):
+        """
+        Returns the NetworkIndex with integer ids and adjacency arrays of the network, built on first use. Call
+        invalidate_structure after changing the structure of the network.
+        """
+        if self._index is None:
+            self._index = NetworkIndex(self)
+        return self._index
+
+    def invalidate_structure(self):
+        """
+        Marks the variables, parents or values of the network as changed in place. The index is rebuilt on next use
+        and cached elimination orders and pruning results of the old structure are no longer served.
+        """
+        self._index = None
+        self.structure_version += 1
+
+
+class CPTFrames(Mapping):
+    """
+    Read-only dictionary {variable: conditional probability table} of a network, see table_to_data_frame. Each
+    DataFrame is built from the array of the variable when it is first looked up.
+    """
+
+    def __init__(self, network: BayesNet, coded=False):
+        self.network = network
+        self.coded = coded
+        self.frames = {}
+
+    def __getitem__(self, variable):
+        if variable not in self.frames:
+            if variable not in self.network.tables:
+                raise KeyError(variable)
+            self.frames[variable] = self.network.table_to_data_frame(variable, self.coded)
+        return self.frames[variable]
+
+    def __iter__(self):
+        return iter(self.network.tables)
+
+    def __len__(self):
+        return len(self.network.tables)
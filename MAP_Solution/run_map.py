@@ -6,10 +6,9 @@ Code to read in Bayesian Networks has been provided. We assume you have installe
 
 """
 from read_bayesnet import BayesNet
-from variable_elim import VariableElimination
 from map import MAP
 from elim_order_heuristics import min_factors, min_parents
-from logger import logger
+from logger import logger, enable_file_logging
 from datetime import datetime
 import time
 
@@ -19,7 +18,7 @@ earthquake_example = "Earthquake"
 alarm_example1 = "Alarm 1"
 alarm_example2 = "Alarm 2"
 def main():
-
+    log_file = enable_file_logging('MAP.log')
 
     while True:
 
@@ -30,11 +29,6 @@ def main():
                                        f"3) {alarm_example2}\n"
                                        "4) Quit\n")))
 
-        # Reset vars for each run since they are static
-        BayesNet.values.clear()
-        BayesNet.probabilities.clear()
-        BayesNet.parents.clear()
-
         if example_selection == 1:
             net = BayesNet('Networks/earthquake.bif')
             map_vars = ['Alarm']
@@ -56,10 +50,15 @@ def main():
         # Select Heuristic
         heuristic_selection = int(input(f"Select elimination order heuristic:\n"
                                         f"1) Mininum Parents\n"
-                                        f"2) Minimum Factors\n"))
-
-        if heuristic_selection == 1:
-            elim_order = "min_parents"
+                                        f"2) Minimum Factors\n"
+                                        f"3) Minimum Degree\n"
+                                        f"4) Minimum Fill\n"
+                                        f"5) Minimum Weight\n"
+                                        f"6) Weighted Minimum Fill\n"))
+
+        heuristics = ["min_parents", "min_factors", "min_degree", "min_fill", "min_weight", "weighted_min_fill"]
+        if 1 <= heuristic_selection <= len(heuristics):
+            elim_order = heuristics[heuristic_selection - 1]
         else:
             elim_order = "min_factors"
 
@@ -71,7 +70,7 @@ def main():
         # Run VE
         map_result = map.run(map_vars, evidence, elim_order)
         print(f"Map Result: {map_result}")
-        print("\nVerbose log output saved to " + logger.handlers[0].baseFilename)
+        print("\nVerbose log output saved to " + log_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+"""
+Networks in shared memory, for worker processes that answer queries against the same networks.
+
+The parent process publishes the probabilities of every network once into a multiprocessing.shared_memory block,
+laid out as in the compiled network format. Workers receive a small handle with the name of the block and the
+layout, and attach to it: their probability arrays are read-only views into the shared block, so attaching copies
+nothing and resident memory does not grow with the number of workers.
+
+    with SharedNetworkStore() as store:
+        handle = store.publish("alarm", BayesNet("Networks/alarm.bif"))
+        ...
+        # in a worker process
+        network = attach(handle)
+
+The DataFrames in BayesNet.probabilities are still built per process when they are used, so the "numpy" backends
+profit most, their factors are built directly from the shared arrays.
+
+"""
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from compiled_network import DTYPE, table_layout, tables_from_block
+from read_bayesnet import BayesNet
+
+# Picklable reference to a published network: the name of its shared memory block, the name of the network and the
+# layout of its probabilities as returned by compiled_network.table_layout
+SharedNetwork = namedtuple("SharedNetwork", ["block", "name", "variables"])
+
+# Blocks attached by this process, keyed by block name. They stay open for the lifetime of the process, since the
+# arrays of attached networks point into them.
+_attached = {}
+
+
+class SharedNetworkStore:
+    """
+    Owner of the shared memory blocks of published networks. The blocks are freed by close, after which networks
+    attached to them can no longer be used.
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def publish(self, name, network: BayesNet):
+        """
+        Copies the probabilities of a network into a new shared memory block, replacing any network published
+        under the same name
+        Args:
+            name:    name to publish the network under
+            network: the network
+
+        Returns: the SharedNetwork handle to pass to worker processes
+        """
+        variables, size = table_layout(network)
+        block = shared_memory.SharedMemory(create=True, size=max(size * DTYPE.itemsize, 1))
+        data = np.ndarray((size,), dtype=DTYPE, buffer=block.buf)
+        for variable in variables:
+            end = variable["offset"] + int(np.prod(variable["shape"]))
+            data[variable["offset"]:end] = np.ravel(network.tables[variable["name"]])
+
+        self.remove(name)
+        self.blocks[name] = block
+        self.handles[name] = SharedNetwork(block.name, network.name, variables)
+        return self.handles[name]
+
+    def remove(self, name):
+        """
+        Frees the block of a published network, if there is one
+        """
+        block = self.blocks.pop(name, None)
+        self.handles.pop(name, None)
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        """
+        Frees the blocks of all published networks
+        """
+        for name in list(self.blocks):
+            self.remove(name)
+
+
+def attach(handle: SharedNetwork) -> BayesNet:
+    """
+    Returns a network whose probabilities are read-only views into a published shared memory block
+    """
+    block = _attached.get(handle.block)
+    if block is None:
+        block = _attached[handle.block] = shared_memory.SharedMemory(name=handle.block)
+    size = sum(int(np.prod(variable["shape"])) for variable in handle.variables)
+    data = np.ndarray((size,), dtype=DTYPE, buffer=block.buf)
+    data.flags.writeable = False
+
+    values, parents, tables = tables_from_block(handle.variables, data)
+    return BayesNet.from_tables(handle.name, values, parents, tables)
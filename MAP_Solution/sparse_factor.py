@@ -0,0 +1,268 @@
+import numpy as np
+import pandas as pd
+
+from numpy_factor import NumpyFactor
+
+# Factors with at most this fraction of non-zero entries are stored sparsely by the "auto" backend
+SPARSE_DENSITY_THRESHOLD = 0.25
+
+
+def row_ids(*arrays):
+    """
+    Numbers the distinct rows of one or more code arrays with the same number of columns, so equal rows get equal
+    ids across all arrays. Returns one id array per input array.
+    """
+    stacked = np.concatenate(arrays)
+    if stacked.shape[1] == 0 or len(stacked) == 0:
+        ids = np.zeros(len(stacked), dtype=np.intp)
+    else:
+        _, ids = np.unique(stacked, axis=0, return_inverse=True)
+        ids = ids.reshape(-1)
+    return np.split(ids, np.cumsum([len(array) for array in arrays])[:-1])
+
+
+class SparseFactor:
+    """
+    Factor that only stores its non-zero entries, as one row of state indices per entry plus the probability.
+
+    Deterministic CPTs are mostly zeros, so their products and reductions only touch the assignments that are
+    possible. Rows that become zero are dropped right away.
+    """
+
+    def __init__(self, variables: list, states: dict, codes: np.ndarray, values: np.ndarray):
+        """
+        Args:
+            variables: ordered scope of the factor, column i of codes belongs to variables[i]
+            states:    dictionary {variable: [state, ...]} giving the state labels of every variable
+            codes:     integer array of shape (number of entries, number of variables) with state indices
+            values:    probability of every entry
+        """
+        self.variables = list(variables)
+        self.states = states
+        self.codes = np.asarray(codes, dtype=np.intp).reshape(len(values), len(self.variables))
+        self.values = np.asarray(values, dtype=np.float64)
+
+        nonzero = self.values != 0
+        if not nonzero.all():
+            self.codes = self.codes[nonzero]
+            self.values = self.values[nonzero]
+
+    @classmethod
+    def from_dense(cls, factor: NumpyFactor):
+        """
+        Builds a sparse factor from the non-zero entries of a dense factor
+        """
+        nonzero = np.nonzero(factor.table)
+        codes = np.stack(nonzero, axis=1) if factor.variables else np.zeros((int(factor.table != 0), 0))
+        return cls(factor.variables, factor.states, codes, factor.table[nonzero])
+
+    @classmethod
+    def from_network(cls, network, variable):
+        """
+        Builds a sparse factor from the probability array of a variable in a network
+        Args:
+            network:  read_bayesnet.BayesNet the variable belongs to
+            variable: variable whose conditional probability table to use
+        """
+        return cls.from_dense(NumpyFactor.from_network(network, variable))
+
+    @property
+    def shape(self):
+        return tuple(len(self.states[var]) for var in self.variables)
+
+    @property
+    def density(self):
+        """Fraction of the entries of the full table that is non-zero"""
+        return len(self.values) / max(int(np.prod(self.shape)), 1)
+
+    def to_dense(self) -> NumpyFactor:
+        """Returns the factor as a dense numpy factor"""
+        table = np.zeros(self.shape)
+        table[tuple(self.codes.T)] = self.values
+        return NumpyFactor(self.variables, self.states, table)
+
+    def reduce(self, variable, value):
+        """
+        Reduces this factor by applying evidence to it. Evidence variable is removed from the factor
+        Args:
+            variable: variable to apply evidence to
+            value: index of the observed state
+        """
+        axis = self.variables.index(variable)
+        keep = self.codes[:, axis] == value
+        self.codes = np.delete(self.codes[keep], axis, axis=1)
+        self.values = self.values[keep]
+        del self.variables[axis]
+
+    def eliminate(self, variable, maximize):
+        """
+        Sums or maximises a variable out of the factor by grouping the entries on the other variables
+        """
+        axis = self.variables.index(variable)
+        codes = np.delete(self.codes, axis, axis=1)
+        del self.variables[axis]
+
+        if len(self.values) == 0:
+            self.codes = codes
+            return
+
+        (ids,) = row_ids(codes)
+        groups = int(ids.max()) + 1
+        if maximize:
+            values = np.full(groups, -np.inf)
+            np.maximum.at(values, ids, self.values)
+        else:
+            values = np.bincount(ids, weights=self.values, minlength=groups)
+
+        # Keep the codes of the first entry of every group
+        first = np.full(groups, len(ids))
+        np.minimum.at(first, ids, np.arange(len(ids)))
+        self.codes = codes[first]
+        self.values = values
+
+        nonzero = self.values != 0
+        self.codes = self.codes[nonzero]
+        self.values = self.values[nonzero]
+
+    def maximize(self, variable):
+        """
+        Maximises out a variable from the factor. Used for MAP operation.
+        Args:
+            variable: Variable to maximise out of the factor.
+        """
+        self.eliminate(variable, maximize=True)
+
+    def marginalize(self, variable):
+        """
+        Sums-out a variable from this factor
+        Args:
+            variable: variable to sum out
+        """
+        self.eliminate(variable, maximize=False)
+
+    def multiply(self, factor2, variable=None):
+        """
+        Multiplies this factor with another provided factor by joining the non-zero entries that agree on all
+        common variables. Dense factors are converted first.
+        Args:
+            factor2: factor to multiply this with
+            variable: unused, the factors are joined on all common variables
+        """
+        if isinstance(factor2, NumpyFactor):
+            factor2 = SparseFactor.from_dense(factor2)
+
+        common = [var for var in self.variables if var in factor2.variables]
+        extra = [i for i, var in enumerate(factor2.variables) if var not in self.variables]
+        ids_1, ids_2 = row_ids(self.codes[:, [self.variables.index(var) for var in common]],
+                               factor2.codes[:, [factor2.variables.index(var) for var in common]])
+
+        # For every entry of this factor, find the range of matching entries in the sorted other factor
+        order = np.argsort(ids_2, kind="stable")
+        sorted_ids = ids_2[order]
+        low = np.searchsorted(sorted_ids, ids_1, side="left")
+        counts = np.searchsorted(sorted_ids, ids_1, side="right") - low
+
+        left = np.repeat(np.arange(len(ids_1)), counts)
+        offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        right = order[np.repeat(low, counts) + offsets]
+
+        self.codes = np.hstack([self.codes[left], factor2.codes[right][:, extra]])
+        self.values = self.values[left] * factor2.values[right]
+        self.variables = self.variables + [factor2.variables[i] for i in extra]
+
+        nonzero = self.values != 0
+        self.codes = self.codes[nonzero]
+        self.values = self.values[nonzero]
+
+    @classmethod
+    def sum_product(cls, factors, variable):
+        """
+        Multiplies factors together and sums a variable out of the product. The factors are not modified.
+        """
+        result = factors[0].copy() if isinstance(factors[0], SparseFactor) else cls.from_dense(factors[0])
+        for factor in factors[1:]:
+            result.multiply(factor)
+        result.marginalize(variable)
+        return result
+
+    def normalize(self):
+        """
+        Normalizes this factor such that the probability distribution adds to 1
+        """
+        self.values = self.values / self.values.sum()
+
+    def argmax(self, variable, assignment: dict):
+        """
+        Finds the state of a variable with the highest probability, given the values of the other variables
+        Args:
+            variable:   variable to find the maximising state for
+            assignment: dictionary {variable: state index} that contains at least all other variables in the factor
+
+        Returns: the index of the maximising state of variable
+        """
+        consistent = np.ones(len(self.values), dtype=bool)
+        for i, var in enumerate(self.variables):
+            if var != variable:
+                consistent &= self.codes[:, i] == assignment[var]
+
+        codes = self.codes[consistent, self.variables.index(variable)]
+        values = self.values[consistent]
+        if len(values) == 0:
+            # Every state has probability zero, pick the first like a dense argmax would
+            return 0
+
+        # Break ties towards the lowest state index, like a dense argmax
+        return int(codes[values == values.max()].min())
+
+    def get_data_frame(self):
+        """Returns the non-zero entries of the factor as a dataframe in the same layout as factor.Factor"""
+        df = pd.DataFrame({var: [self.states[var][code] for code in self.codes[:, i]]
+                           for i, var in enumerate(self.variables)})
+        df["prob"] = self.values
+        return df
+
+    def num_entries(self):
+        """Returns the number of stored, non-zero entries"""
+        return len(self.values)
+
+    def get_vars(self):
+        return self.variables + ["prob"]
+
+    def __str__(self) -> str:
+        return str(self.get_vars())
+
+    def copy(self):
+        return SparseFactor(self.variables, self.states, self.codes.copy(), self.values.copy())
+
+
+class AdaptiveFactor:
+    """
+    Factor backend that decides per factor whether to store it densely (NumpyFactor) or sparsely (SparseFactor),
+    based on the fraction of non-zero entries. It only provides the constructors used by MAP.run; the factors it
+    returns are ordinary NumpyFactor or SparseFactor objects, which can be multiplied with each other.
+    """
+
+    @staticmethod
+    def choose(factor, threshold=None):
+        """
+        Returns the factor in the representation that suits its density
+        """
+        threshold = SPARSE_DENSITY_THRESHOLD if threshold is None else threshold
+        if isinstance(factor, SparseFactor):
+            return factor.to_dense() if factor.density > threshold else factor
+        density = np.count_nonzero(factor.table) / max(factor.table.size, 1)
+        return SparseFactor.from_dense(factor) if density <= threshold else factor
+
+    @classmethod
+    def from_network(cls, network, variable):
+        return cls.choose(NumpyFactor.from_network(network, variable))
+
+    @classmethod
+    def sum_product(cls, factors, variable):
+        """
+        Sums a variable out of the product of factors, sparsely if any of them is sparse and densely otherwise.
+        The result is stored in the representation that suits its density.
+        """
+        if all(isinstance(factor, NumpyFactor) for factor in factors):
+            return cls.choose(NumpyFactor.sum_product(factors, variable))
+        return cls.choose(SparseFactor.sum_product(factors, variable))
@@ -1,9 +1,33 @@
+import asyncio
+import io
 import json
+import logging
+import tracemalloc
 from pathlib import Path
 
+import numpy as np
 import pytest
+from anytime_map import AnytimeMAP
+from batch_runner import run_queries
+from benchmark import find_regressions, random_queries, write_random_network
+from branch_and_bound import BranchAndBoundMAP
+from compiled_network import load_network
+from elim_order_cache import ElimOrderCache
+from factor import Factor
+from junction_tree import JunctionTree
+from logger import LazyTable, disable_file_logging, enable_file_logging, logger
 from map import MAP
+from map_server import MAPClient, MAPServer
+from map_session import MAPSession
+from memory_budget import MemoryBudget
+from network_index import FactorPool
+from network_pruning import PruneCache
+from network_registry import NetworkRegistry
+from profiling import Profiler
 from read_bayesnet import BayesNet
+from shared_network import SharedNetworkStore, attach
+from numpy_factor import LogNumpyFactor, NumpyFactor
+from sparse_factor import SparseFactor, AdaptiveFactor
 
 
 DATA_DIR = Path(__file__).parent / "data"
@@ -41,24 +65,23 @@ def load_test_cases():
     return test_cases
 
 
+@pytest.mark.parametrize("elim_heuristic", [None, "min_parents", "min_degree", "min_fill", "min_weight",
+                                            "weighted_min_fill"])
+@pytest.mark.parametrize("factor_backend", ["pandas", "numpy", "numpy_log", "sparse", "auto"])
 @pytest.mark.parametrize(
     "network_file,query,expected",
     load_test_cases()
 )
-def test_map_query(network_file, query, expected):
+def test_map_query(network_file, query, expected, factor_backend, elim_heuristic):
     """
     Runs a MAP query using student code and compares
     against the pgmpy-generated oracle result.
     """
 
-    # Values must be cleared each time since they are static
-    BayesNet.values.clear()
-    BayesNet.probabilities.clear()
-    BayesNet.parents.clear()
-
     net = BayesNet(network_file)
     map = MAP(net)
-    result = map.run(query["map_vars"], query.get("evidence", {}), elim_heuristic=None)
+    result = map.run(query["map_vars"], query.get("evidence", {}), elim_heuristic=elim_heuristic,
+                     factor_backend=factor_backend)
 
     assert isinstance(result, dict), "map_query must return a dict"
 
@@ -67,3 +90,696 @@ def test_map_query(network_file, query, expected):
         f"Expected: {expected}\n"
         f"Got: {result}"
     )
+
+
+def test_registry_serves_all_networks():
+    """
+    Loads every network concurrently into one registry and answers all queries without reloading.
+    """
+    with open(DATA_DIR / "queries.json") as f:
+        queries_data = json.load(f)
+
+    with open(DATA_DIR / "answers.json") as f:
+        answers_data = json.load(f)
+
+    registry = NetworkRegistry()
+    registry.load_all({net["name"]: NETWORK_DIR / net["file"] for net in queries_data["networks"]})
+
+    for net in queries_data["networks"]:
+        for q in net["queries"]:
+            result = registry.run(net["name"], q["map_vars"], q.get("evidence", {}))
+            assert result == answers_data[net["name"]][q["name"]]
+
+
+def test_compiled_network_cache(tmp_path):
+    """
+    Compiles every network into a cache directory, reloads it from the memory-mapped file and checks that the
+    probabilities and MAP answers are unchanged.
+    """
+    with open(DATA_DIR / "queries.json") as f:
+        queries_data = json.load(f)
+
+    with open(DATA_DIR / "answers.json") as f:
+        answers_data = json.load(f)
+
+    for net in queries_data["networks"]:
+        parsed = BayesNet(NETWORK_DIR / net["file"])
+        load_network(NETWORK_DIR / net["file"], cache_dir=tmp_path)
+        compiled = load_network(NETWORK_DIR / net["file"], cache_dir=tmp_path)
+
+        assert compiled.values == parsed.values
+        assert compiled.parents == parsed.parents
+        for variable in parsed.nodes:
+            assert (compiled.tables[variable] == parsed.tables[variable]).all()
+
+        for q in net["queries"]:
+            for factor_backend in ["pandas", "numpy"]:
+                result = MAP(compiled).run(q["map_vars"], q.get("evidence", {}), factor_backend=factor_backend)
+                assert result == answers_data[net["name"]][q["name"]]
+
+
+def test_elim_order_cache():
+    """
+    Queries of the same shape with different evidence values reuse the cached order, other networks do not.
+    """
+    cache = ElimOrderCache(maxsize=2)
+    net = BayesNet(NETWORK_DIR / "earthquake.bif")
+    map = MAP(net, order_cache=cache)
+
+    map.run(["Alarm"], {"Burglary": "True"}, elim_heuristic="min_fill")
+    map.run(["Alarm"], {"Burglary": "False"}, elim_heuristic="min_fill")
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    map.network = BayesNet(NETWORK_DIR / "earthquake.bif")
+    map.run(["Alarm"], {"Burglary": "True"}, elim_heuristic="min_fill")
+    assert cache.stats()["misses"] == 2
+
+    # Least recently used entries are evicted once the cache is full
+    map.run(["Alarm"], {}, elim_heuristic="min_fill")
+    assert len(cache) == 2
+
+    # An order is not served for a network whose structure was changed in place, and the index is rebuilt
+    assert cache.get(map.network, "min_fill", ["Alarm"], {}, map.pruning.nodes) is not None
+    index = map.network.index
+    map.network.parents["Alarm"] = map.network.parents["Alarm"][:1]
+    map.network.invalidate_structure()
+    assert cache.get(map.network, "min_fill", ["Alarm"], {}, map.pruning.nodes) is None
+    assert map.network.index is not index
+
+
+@pytest.mark.parametrize(
+    "network_file,query,expected",
+    load_test_cases()
+)
+def test_map_run_batch(network_file, query, expected):
+    """
+    Runs every query as part of a batch that also contains the other instantiations of its evidence variables,
+    and checks the batched answers against MAP.run.
+    """
+    net = BayesNet(network_file)
+    map = MAP(net)
+    evidence_vars = list(query.get("evidence", {}).keys())
+
+    evidence_list = [query.get("evidence", {})]
+    for evidence_var in evidence_vars:
+        for value in net.values[evidence_var]:
+            evidence_list.append({**evidence_list[0], evidence_var: value})
+
+    results = map.run_batch(query["map_vars"], evidence_list)
+
+    assert results[0] == expected
+    assert results == [map.run(query["map_vars"], evidence, factor_backend="numpy") for evidence in evidence_list]
+
+
+@pytest.mark.parametrize(
+    "network_file,query,expected",
+    load_test_cases()
+)
+def test_junction_tree(network_file, query, expected):
+    """
+    The max-product junction tree agrees with MAP.run over all unobserved variables, and the sum-product
+    posteriors of the MAP variables sum to one.
+    """
+    net = BayesNet(network_file)
+    evidence = query.get("evidence", {})
+    jt = JunctionTree(net)
+    jt.set_evidence(evidence)
+
+    assignment, probability = jt.mpe()
+    unobserved = [var for var in net.nodes if var not in evidence]
+    assert {var: assignment[var] for var in unobserved} == MAP(net).run(unobserved, evidence, factor_backend="numpy")
+    assert 0 < probability <= jt.evidence_probability() <= 1 + 1e-9
+
+    for posterior in jt.marginals(query["map_vars"]).values():
+        assert sum(posterior.values()) == pytest.approx(1)
+
+    # Retracting the evidence only recomputes the messages that depend on it
+    computed = jt.messages_computed
+    jt.set_evidence({})
+    assert jt.evidence_probability() == pytest.approx(1)
+    assert jt.messages_computed - computed <= 2 * (len(jt.cliques) - 1)
+
+
+@pytest.mark.parametrize("i_bound", [1, 2, 10])
+@pytest.mark.parametrize(
+    "network_file,query,expected",
+    load_test_cases()
+)
+def test_branch_and_bound(network_file, query, expected, i_bound):
+    """
+    Branch and bound returns the oracle answer with loose as well as exact mini-bucket bounds.
+    """
+    solver = BranchAndBoundMAP(BayesNet(network_file), i_bound=i_bound)
+    assert solver.run(query["map_vars"], query.get("evidence", {})) == expected
+
+
+@pytest.mark.parametrize(
+    "network_file,query,expected",
+    load_test_cases()
+)
+def test_anytime_map(network_file, query, expected):
+    """
+    On the small networks annealing finds the oracle answer well within its budget, and the reported bound
+    holds.
+    """
+    solver = AnytimeMAP(BayesNet(network_file), i_bound=1, seed=0)
+    result = solver.run(query["map_vars"], query.get("evidence", {}), time_budget=0.05)
+
+    assert result.assignment == expected
+    assert result.probability <= result.upper_bound * (1 + 1e-9)
+    assert 0 <= result.gap < 1
+
+
+def test_anytime_map_budget():
+    """
+    The budget covers the preparation, and the memo of neighbourhood scores stays within its size.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    map_vars, evidence = ["Tampering", "Fire", "Leaving"], {"Report": "1"}
+
+    result = AnytimeMAP(net, i_bound=1, seed=0).run(map_vars, evidence, time_budget=0)
+    assert result.steps == 0 and result.probability is None and result.gap is None
+    assert result.assignment.keys() == set(map_vars)
+
+    solver = AnytimeMAP(net, i_bound=1, seed=0, score_cache_size=2)
+    solver.run(map_vars, evidence, time_budget=0.05)
+    assert len(solver.scores) <= 2
+
+
+def test_sparse_factor_matches_dense():
+    """
+    Products and eliminations of sparse factors with zero entries agree with the dense tables.
+    """
+    rng = np.random.default_rng(0)
+    states = {"A": ["0", "1", "2"], "B": ["0", "1"], "C": ["0", "1", "2", "3"]}
+    ab = NumpyFactor(["A", "B"], states, rng.random((3, 2)) * (rng.random((3, 2)) < 0.5))
+    bc = NumpyFactor(["B", "C"], states, rng.random((2, 4)) * (rng.random((2, 4)) < 0.5))
+
+    for dense, sparse in [(ab.copy(), SparseFactor.from_dense(ab)), (bc.copy(), SparseFactor.from_dense(bc))]:
+        dense.multiply(bc if dense.variables == ["A", "B"] else ab)
+        sparse.multiply(bc if sparse.variables == ["A", "B"] else ab)
+        np.testing.assert_allclose(sparse.to_dense().aligned(dense.variables), dense.table)
+
+        maximized, sparse_maximized = dense.copy(), sparse.copy()
+        maximized.maximize("B")
+        sparse_maximized.maximize("B")
+        np.testing.assert_allclose(sparse_maximized.to_dense().aligned(maximized.variables), maximized.table)
+
+        dense.marginalize("B")
+        sparse.marginalize("B")
+        np.testing.assert_allclose(sparse.to_dense().aligned(dense.variables), dense.table)
+
+    deterministic = NumpyFactor(["A", "C"], states, np.eye(3, 4))
+    assert isinstance(AdaptiveFactor.choose(deterministic), SparseFactor)
+    assert isinstance(AdaptiveFactor.choose(NumpyFactor(["A", "B"], states, rng.random((3, 2)) + 0.1)), NumpyFactor)
+
+
+def test_network_pruning():
+    """
+    Barren and d-separated nodes are pruned, the counts are reported and the result is cached per query shape.
+    """
+    net = BayesNet(NETWORK_DIR / "earthquake.bif")
+    map = MAP(net, order_cache=ElimOrderCache())
+    map.prune_cache = PruneCache()
+
+    # Burglary and Earthquake are independent roots, and every other node is barren for this query
+    assert map.run(["Burglary"], {}) == MAP(net).run(["Burglary"], {}, prune=False)
+    assert map.pruning.nodes == ["Burglary"]
+    assert map.pruning.factors_pruned == len(net.nodes) - 1
+    assert map.pruning.entries_pruned == sum(net.tables[node].size for node in net.nodes if node != "Burglary")
+
+    # The order and the predicted clique size are computed on the pruned network only
+    assert map.get_map_elim_order(["Burglary"], {}, "min_fill", map.pruning.nodes) == ["Burglary"]
+    assert map.max_clique_size == 1
+
+    # Observing the common child connects the roots again; other evidence values reuse the pruned network
+    map.run(["Burglary"], {"Alarm": "True"})
+    assert set(map.pruning.nodes) == {"Burglary", "Earthquake", "Alarm"}
+    map.run(["Burglary"], {"Alarm": "False"})
+    assert map.prune_cache.stats()["hits"] == 1
+
+
+@pytest.mark.parametrize("network_file", sorted(NETWORK_DIR.glob("*.bif")), ids=lambda path: path.stem)
+def test_map_session(network_file):
+    """
+    Adding and retracting evidence one variable at a time gives the answers of MAP.run, and only recomputes the
+    buckets downstream of the changed evidence.
+    """
+    net = BayesNet(network_file)
+    map_vars = net.nodes[:2]
+    session = MAPSession(net, map_vars)
+
+    evidence = {}
+    for variable in net.nodes[-3:]:
+        evidence[variable] = net.values[variable][-1]
+        session.observe(variable, evidence[variable])
+        assert session.query() == MAP(net).run(map_vars, evidence, factor_backend="numpy")
+
+    computed = session.buckets_computed
+    session.retract(net.nodes[-1])
+    del evidence[net.nodes[-1]]
+    assert session.query() == MAP(net).run(map_vars, evidence, factor_backend="numpy")
+    assert session.buckets_computed - computed < len(session.order)
+
+    # Unknown variables and values are rejected when they are observed, and leave the evidence unchanged
+    for variable, value in [("Unknown", "0"), (net.nodes[-1], "unknown")]:
+        with pytest.raises(ValueError):
+            session.observe(variable, value)
+    assert session.evidence == evidence
+
+
+def test_random_network_benchmark(tmp_path):
+    """
+    Generated networks load, all backends agree on them, and slower results are reported as regressions.
+    """
+    net = BayesNet(write_random_network(tmp_path / "random.bif", 12, max_parents=3, cardinality=(2, 3), seed=1))
+    assert len(net.nodes) == 12
+    assert all(np.allclose(net.tables[node].sum(axis=0), 1) for node in net.nodes)
+
+    for query in random_queries(net, 3, seed=1):
+        answers = [MAP(net).run(query["map_vars"], query["evidence"], factor_backend=backend)
+                   for backend in ["pandas", "numpy", "sparse"]]
+        assert answers[0] == answers[1] == answers[2]
+
+    baseline = {"benchmarks": {"map": {"seconds": 1.0}, "load": {"seconds": 1.0}}, "thresholds": {"load": 3.0}}
+    results = {"benchmarks": {"map": {"seconds": 2.0}, "load": {"seconds": 2.0}, "new": {"seconds": 5.0}}}
+    assert find_regressions(results, baseline) == {"map": 2.0}
+
+
+def test_profiler(monkeypatch):
+    """
+    A profiled run records a step per observed and eliminated variable and does not change the answer.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    steps = []
+    profiler = Profiler(callback=steps.append)
+
+    for backend in ["pandas", "numpy"]:
+        assert (MAP(net).run(["Tampering", "Report"], {"Smoke": "1"}, factor_backend=backend, profile=profiler)
+                == MAP(net).run(["Tampering", "Report"], {"Smoke": "1"}, factor_backend=backend))
+
+    assert len(profiler.runs) == 2 and steps == profiler.steps
+    operations = [step["operation"] for step in profiler.runs[1]["steps"]]
+    assert operations[0] == "reduce" and operations.count("max") == 2
+    assert all(step["peak_memory"] > 0 and step["input_entries"] for step in steps)
+    assert json.loads(profiler.to_json())[0]["steps"][0]["variable"] == "Smoke"
+    assert "Run 1: numpy" in profiler.report(top=3)
+
+    # A failing query still ends its run and stops tracemalloc
+    monkeypatch.setattr(MAP, "get_map_instantiation", lambda self, factors: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        MAP(net).run(["Tampering", "Report"], {"Smoke": "1"}, factor_backend="numpy", profile=profiler)
+    assert profiler.runs[2]["seconds"] is not None and not tracemalloc.is_tracing()
+
+
+def test_lazy_logging(tmp_path, monkeypatch):
+    """
+    Factor tables are only rendered when debug logging is enabled, and file logging goes through a queue.
+    """
+    assert not any(isinstance(handler, logging.FileHandler) for handler in logger.handlers)
+
+    rendered = []
+    monkeypatch.setattr(LazyTable, "__str__", lambda self: rendered.append(self.factor) or "table")
+    net = BayesNet(NETWORK_DIR / "earthquake.bif")
+    MAP(net).run(["Burglary"], {"Alarm": "True"})
+    assert rendered == []
+
+    log_file = enable_file_logging(tmp_path / "MAP.log")
+    try:
+        MAP(net).run(["Burglary"], {"Alarm": "True"})
+    finally:
+        disable_file_logging()
+    assert rendered and "table" in Path(log_file).read_text()
+    assert logger.level == logging.INFO
+
+    # Disabling restores the level the logger had, not the default
+    logger.setLevel(logging.WARNING)
+    try:
+        enable_file_logging(tmp_path / "MAP.log")
+        assert logger.level == logging.DEBUG
+        disable_file_logging()
+        assert logger.level == logging.WARNING
+    finally:
+        disable_file_logging()
+        logger.setLevel(logging.INFO)
+
+
+def test_integer_coded_states():
+    """
+    Factors hold state indices in small integer columns, and only the result of a query is decoded to values.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    factor = Factor.from_network(net, "Alarm")
+    assert all(factor.get_data_frame()[var].dtype == np.uint8 for var in ["Alarm", "Fire", "Tampering"])
+    assert net.decode(net.encode({"Smoke": "1", "Fire": "0"})) == {"Smoke": "1", "Fire": "0"}
+
+    # Without pruning, the pandas backend also sums out variables whose factor has nothing else left
+    assert (MAP(net).run(["Tampering"], {"Smoke": "1"}, prune=False)
+            == MAP(net).run(["Tampering"], {"Smoke": "1"}, factor_backend="numpy"))
+
+
+def test_network_index():
+    """
+    The index has the parents, children and factors of every node, and a topological order.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    index = net.index
+    position = {node: k for k, node in enumerate(index.topological_order.tolist())}
+
+    for node in net.nodes:
+        i = index.ids[node]
+        assert [index.names[p] for p in index.parents(i)] == net.parents[node]
+        assert all(position[p] < position[i] for p in index.parents(i))
+        children = [index.names[c] for c in index.children(i)]
+        assert children == [child for child in net.nodes if node in net.parents[child]]
+        assert [index.names[f] for f in index.factors(i)] == [node] + children
+
+    pool = FactorPool(Factor.from_network(net, node) for node in net.nodes)
+    assert [factor.get_vars()[0] for factor in pool.pop("Fire")] == ["Alarm", "Fire", "Smoke"]
+    assert len(pool) == len(net.nodes) - 3 and pool.pop("Fire") == []
+
+
+@pytest.mark.parametrize(
+    "network_file,query,expected",
+    load_test_cases()
+)
+def test_infer(network_file, query, expected):
+    """
+    infer returns the MAP assignment with its probability, P(e) and posteriors that agree with the junction tree.
+    """
+    net = BayesNet(network_file)
+    evidence = query.get("evidence", {})
+    result = MAP(net).infer(query["map_vars"], evidence, posteriors="all")
+
+    assert result.assignment == expected
+    solver = BranchAndBoundMAP(net)
+    solver.run(query["map_vars"], evidence)
+    assert result.probability == pytest.approx(solver.probability)
+
+    tree = JunctionTree(net)
+    tree.set_evidence(evidence)
+    assert result.evidence_probability == pytest.approx(tree.evidence_probability())
+    marginals = tree.marginals([var for var in net.nodes if var not in evidence])
+    assert result.posteriors.keys() == marginals.keys()
+    for var, posterior in result.posteriors.items():
+        assert posterior == pytest.approx(marginals[var])
+
+
+def test_infer_impossible_evidence(tmp_path):
+    """
+    Contradictory evidence has probability zero, asking for posteriors given it raises instead of returning NaN.
+    """
+    lines = ["network copies {", "}"]
+    for variable in ["A", "B", "C"]:
+        lines += [f"variable {variable} {{", "    type discrete [ 2 ] { 0, 1 };", "}"]
+    lines += ["probability ( A ) {", "    table 0.3, 0.7 ;", "}"]
+    for variable in ["B", "C"]:
+        lines += [f"probability ( {variable} | A ) {{", "    (0) 1.0, 0.0;", "    (1) 0.0, 1.0;", "}"]
+    (tmp_path / "copies.bif").write_text("\n".join(lines) + "\n")
+    net = BayesNet(tmp_path / "copies.bif")
+
+    evidence = {"B": "1", "C": "0"}
+    assert MAP(net).infer(["A"], evidence).evidence_probability == 0
+    for posteriors in [True, "all"]:
+        with pytest.raises(ValueError):
+            MAP(net).infer(["A"], evidence, posteriors=posteriors)
+
+
+def test_run_top_k():
+    """
+    The k best assignments match a brute-force ranking of all assignments to the map variables.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    map_vars, evidence = ["Tampering", "Fire", "Leaving"], {"Report": "1"}
+    ranking = MAP(net).run_top_k(map_vars, evidence, 5)
+
+    solver = BranchAndBoundMAP(net)
+    solver.prepare(map_vars, evidence)
+    brute_force = sorted((solver.exact_value(dict(zip(map_vars, codes))), codes)
+                         for codes in np.ndindex(*[len(net.values[var]) for var in map_vars]))[::-1]
+
+    assert [probability for _, probability in ranking] == pytest.approx([p for p, _ in brute_force[:5]])
+    assert ranking[0][0] == MAP(net).run(map_vars, evidence, factor_backend="numpy")
+    assert len(MAP(net).run_top_k(map_vars, evidence, 100)) == 8
+    assert len({tuple(assignment.items()) for assignment, _ in ranking}) == 5
+
+
+@pytest.mark.parametrize("factor_backend", ["numpy", "numpy_log"])
+def test_memory_budget(tmp_path, monkeypatch, factor_backend):
+    """
+    A budget too small for the intermediate factors spills them to disk without changing the answer.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    map_vars, evidence = ["Tampering", "Fire"], {"Report": "1"}
+    expected = MAP(net).run(map_vars, evidence, factor_backend=factor_backend, prune=False)
+
+    budget = MemoryBudget(16, directory=tmp_path)
+    assert MAP(net).run(map_vars, evidence, factor_backend=factor_backend, prune=False,
+                        memory_budget=budget) == expected
+    assert budget.spilled_factors > 0
+    assert list(tmp_path.iterdir()) == []
+
+    with pytest.raises(ValueError):
+        MAP(net).run(map_vars, evidence, factor_backend="pandas", memory_budget=1024)
+
+    # A failing query still deletes its scratch files
+    budget = MemoryBudget(16, directory=tmp_path)
+    monkeypatch.setattr(MAP, "get_map_instantiation", lambda self, factors: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        MAP(net).run(map_vars, evidence, factor_backend=factor_backend, prune=False, memory_budget=budget)
+    assert budget.spilled_factors > 0 and list(tmp_path.iterdir()) == []
+
+
+def test_shared_network(tmp_path):
+    """
+    Networks attached from shared memory are read-only views with the same probabilities, and batch_runner answers
+    queries with workers that attach to them.
+    """
+    parsed = BayesNet(NETWORK_DIR / "alarm.bif")
+    with SharedNetworkStore() as store:
+        shared = attach(store.publish("alarm", parsed))
+        assert shared.parents == parsed.parents
+        for variable in parsed.nodes:
+            assert (shared.tables[variable] == parsed.tables[variable]).all()
+            assert not shared.tables[variable].flags.writeable
+        query = {"map_vars": ["Tampering", "Fire"], "evidence": {"Report": "1"}}
+        expected = MAP(parsed).run(query["map_vars"], query["evidence"])
+        assert MAP(shared).run(query["map_vars"], query["evidence"], factor_backend="numpy") == expected
+
+    query_file = tmp_path / "queries.json"
+    query_file.write_text(json.dumps({"networks": [{"name": "alarm", "file": "alarm.bif", "queries": [query] * 4}]}))
+    output = io.StringIO()
+    assert run_queries(query_file, output, network_dir=NETWORK_DIR, workers=2, chunk_size=1, shared=True) == 4
+    assert all(json.loads(line)["result"] == expected for line in output.getvalue().splitlines())
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_map_server(use_processes):
+    """
+    Concurrent queries of one shape are answered in a shared batch with the same results as MAP.run.
+    """
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    map_vars = ["Tampering", "Fire"]
+    evidence_list = [{"Report": report, "Smoke": smoke} for report in ("0", "1") for smoke in ("0", "1")]
+
+    async def session():
+        server = MAPServer({"alarm": net}, workers=2, use_processes=use_processes, batch_window=0.05)
+        client = MAPClient(port=await server.start())
+        try:
+            results = await asyncio.gather(*(client.query("alarm", map_vars, evidence)
+                                             for evidence in evidence_list * 2))
+            bad_value = await client.request("POST", "/map", {"network": "alarm", "map_vars": map_vars,
+                                                              "evidence": {"Report": "2"}})
+            unknown = await client.request("POST", "/map", {"network": "asia", "map_vars": map_vars})
+            not_object = await client.request("POST", "/map", [])
+            return results, bad_value, unknown, not_object, await client.stats()
+        finally:
+            await server.close()
+
+    results, bad_value, unknown, not_object, stats = asyncio.run(session())
+    assert results == [MAP(net).run(map_vars, evidence) for evidence in evidence_list * 2]
+    assert bad_value[0] == 400 and unknown[0] == 404 and not_object[0] == 400
+    assert stats["queries"] == 11 and stats["errors"] == 3
+    assert stats["batches"] < 8 and stats["p50"] <= stats["p99"]
+
+
+def parse_bif_line_based(filename):
+    """
+    Line-based .bif parser of the original BayesNet, used as the reference for the tokenized parser. Only handles
+    the layout of the files in Networks: one statement per line and no default entries.
+
+    Returns: the values and parents per variable and the probabilities per variable as a dictionary
+             {(value, parent value, ...): probability}
+    """
+    lines = Path(filename).read_text().splitlines()
+    values, parents, probabilities = {}, {}, {}
+    for i, line in enumerate(lines):
+        if line.startswith("variable"):
+            variable = line.split()[1]
+            declaration = lines[i + 1]
+            values[variable] = [v.strip() for v in declaration[declaration.find("{") + 1:declaration.find("}")]
+                                .split(",")]
+        elif line.startswith("probability"):
+            variables = line[line.find("(") + 1:line.find(")")].strip().split("|")
+            variable = variables[0].strip()
+            parents[variable] = [v.strip() for v in variables[1].split(",")] if len(variables) > 1 else []
+            probabilities[variable] = {}
+            if lines[i + 1].strip().startswith("table"):
+                probs = [float(p) for p in lines[i + 1].split("table")[1].split(";")[0].split(",")]
+                for value, p in zip(values[variable], probs):
+                    probabilities[variable][(value,)] = p
+                continue
+            for row in lines[i + 1:]:
+                if "}" in row:
+                    break
+                parent_values = tuple(v.strip() for v in row.split("(")[1].split(")")[0].split(","))
+                probs = [float(p) for p in row.split(")")[1].split(";")[0].split(",")]
+                for value, p in zip(values[variable], probs):
+                    probabilities[variable][(value,) + parent_values] = p
+    return values, parents, probabilities
+
+
+def cpt_entries(net, variable):
+    """Returns the rows of a CPT of a BayesNet as a dictionary {(value, parent value, ...): probability}"""
+    df = net.probabilities[variable]
+    return {tuple(row[:-1]): row[-1] for row in df[[variable] + net.parents[variable] + ["prob"]].itertuples(
+        index=False)}
+
+
+@pytest.mark.parametrize("network_file", sorted(NETWORK_DIR.glob("*.bif")), ids=lambda path: path.name)
+def test_parser_matches_line_based_parser(network_file):
+    """
+    The tokenized parser reads the same values, parents and probabilities as the original line-based parser.
+    """
+    values, parents, probabilities = parse_bif_line_based(network_file)
+    net = BayesNet(network_file)
+    assert net.values == values
+    assert net.parents == parents
+    for variable, expected in probabilities.items():
+        assert cpt_entries(net, variable) == pytest.approx(expected)
+        for key, p in expected.items():
+            codes = tuple(net.values[var].index(value)
+                          for var, value in zip([variable] + parents[variable], key))
+            assert net.tables[variable][codes] == pytest.approx(p)
+
+
+def test_parser_layouts(tmp_path):
+    """
+    Tables split over several lines, default entries, comments and unusual whitespace are parsed.
+    """
+    bif = tmp_path / "layouts.bif"
+    bif.write_text("""// A network in an unusual layout
+network "layouts" { property author = test ; }
+variable A { type discrete [ 2 ] { yes,no }; }
+/* a block comment
+   spanning lines */
+variable   B
+{
+\ttype discrete [ 3 ] {  low , mid,high  } ;   // trailing comment
+}
+probability ( A ) {
+  table 0.3,
+        0.7 ;
+}
+probability(B|A){
+  (yes) 0.1, 0.2,
+        0.7;
+  default 0.5, 0.25, 0.25;
+}
+""")
+    net = BayesNet(bif)
+    assert net.values == {"A": ["yes", "no"], "B": ["low", "mid", "high"]}
+    assert net.parents == {"A": [], "B": ["A"]}
+    assert cpt_entries(net, "A") == pytest.approx({("yes",): 0.3, ("no",): 0.7})
+    assert cpt_entries(net, "B") == pytest.approx({("low", "yes"): 0.1, ("mid", "yes"): 0.2, ("high", "yes"): 0.7,
+                                                   ("low", "no"): 0.5, ("mid", "no"): 0.25, ("high", "no"): 0.25})
+    assert net.tables["B"][:, 1] == pytest.approx([0.5, 0.25, 0.25])
+
+
+def test_batch_runner(tmp_path):
+    """
+    Queries streamed from a JSON Lines file are answered in input order with their timing, a failing query only
+    produces an error record.
+    """
+    queries = [{"network": "alarm", "name": f"q{i}", "map_vars": ["Tampering", "Fire"],
+                "evidence": {"Report": str(i % 2)}} for i in range(5)]
+    queries[2]["evidence"] = {"Report": "2"}
+    query_file = tmp_path / "queries.jsonl"
+    query_file.write_text("\n".join(json.dumps(line) for line in
+                                    [{"networks": [{"name": "alarm", "file": "alarm.bif"}]}] + queries))
+
+    output = io.StringIO()
+    assert run_queries(query_file, output, network_dir=NETWORK_DIR, workers=2, chunk_size=2) == 5
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [record["index"] for record in records] == list(range(5))
+    assert [record["query"] for record in records] == [query["name"] for query in queries]
+    assert all(record["seconds"] >= 0 for record in records)
+
+    net = BayesNet(NETWORK_DIR / "alarm.bif")
+    assert "error" in records[2] and "result" not in records[2]
+    for record, query in zip(records, queries):
+        if record["index"] != 2:
+            assert record["result"] == MAP(net).run(query["map_vars"], query["evidence"])
+
+
+def write_hidden_chain(path, length):
+    """
+    Writes a chain H0 -> H1 -> ... of hidden variables, each with an observed child E_i that is unlikely to be 1.
+    Given E_i = 1 for all i, P(H0 = 1 | e) is twice P(H0 = 0 | e), but P(e) shrinks by 1e-3 per link.
+    """
+    lines = ["network chain {", "}"]
+    for i in range(length):
+        lines += [f"variable H{i} {{", "    type discrete [ 2 ] { 0, 1 };", "}",
+                  f"variable E{i} {{", "    type discrete [ 2 ] { 0, 1 };", "}"]
+    lines += ["probability ( H0 ) {", "    table 0.5, 0.5 ;", "}",
+              "probability ( E0 | H0 ) {", "    (0) 0.999, 0.001;", "    (1) 0.998, 0.002;", "}"]
+    for i in range(1, length):
+        lines += [f"probability ( H{i} | H{i - 1} ) {{", "    (0) 0.9, 0.1;", "    (1) 0.1, 0.9;", "}",
+                  f"probability ( E{i} | H{i} ) {{", "    (0) 0.999, 0.001;", "    (1) 0.999, 0.001;", "}"]
+    path.write_text("\n".join(lines) + "\n")
+    return {f"E{i}": "1" for i in range(length)}
+
+
+def test_log_backend_deep_chain(tmp_path):
+    """
+    On a long chain the probabilities underflow to zero in the numpy backend, the log-space backend still finds the
+    MAP assignment.
+    """
+    evidence = write_hidden_chain(tmp_path / "short.bif", 5)
+    net = BayesNet(tmp_path / "short.bif")
+    for factor_backend in ["numpy", "numpy_log"]:
+        assert MAP(net).run(["H0"], evidence, factor_backend=factor_backend) == {"H0": "1"}
+
+    evidence = write_hidden_chain(tmp_path / "deep.bif", 150)
+    net = BayesNet(tmp_path / "deep.bif")
+    assert MAP(net).run(["H0"], evidence, factor_backend="numpy_log") == {"H0": "1"}
+
+    # In linear space P(assignment, evidence) underflows to 0 for every state, so they cannot be told apart
+    assert MAP(net).infer(["H0"], evidence).probability == 0
+    assert MAP(net).run(["H0"], evidence, factor_backend="numpy") != {"H0": "1"}
+
+
+@pytest.mark.parametrize("factor_class", [NumpyFactor, LogNumpyFactor])
+def test_fused_sum_product(factor_class):
+    """
+    The fused sum_product and the state-by-state reduce_product agree with multiplying and then marginalizing.
+    """
+    rng = np.random.default_rng(0)
+    states = {var: list(range(size)) for var, size in zip("ABCDE", [2, 3, 2, 4, 3])}
+    scopes = [["A", "B", "C"], ["C", "B", "D"], ["D", "E"], ["B"]]
+    factors = [NumpyFactor(scope, states, rng.random([len(states[var]) for var in scope])) for scope in scopes]
+    if factor_class is LogNumpyFactor:
+        factors = [LogNumpyFactor.from_factor(factor) for factor in factors]
+
+    for variable in ["B", "D"]:
+        to_multiply = [factor for factor in factors if variable in factor.variables]
+        expected = to_multiply[0].copy()
+        for factor in to_multiply[1:]:
+            expected.multiply(factor)
+        expected.marginalize(variable)
+
+        for result in [factor_class.sum_product(to_multiply, variable),
+                       factor_class.reduce_product(to_multiply, variable,
+                                                   np.logaddexp if factor_class is LogNumpyFactor else np.add)]:
+            assert sorted(result.variables) == sorted(expected.variables)
+            assert result.aligned(expected.variables) == pytest.approx(expected.table)